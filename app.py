@@ -1,31 +1,126 @@
 #!/usr/bin/env python
 
-from database import PooledMDB as Database
+import logging
+import os
+import signal
+import sys
+import time
+
+from database import MDB, PooledMDB as Database
+from blobstore import Blobstore
+from executor import Executor
+
+from concurrent.futures import ProcessPoolExecutor
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 
 from tornado.options import define, options
 
 define("port", default=5000, help="port to bind to", type=int)
+define("threads", default=8, help="threads running blocking API work (per process)", type=int)
+define("parsers", default=2, help="processes parsing large payloads (per process, 0: parse on the threads)", type=int)
+define("workers", default=1, help="server processes sharing the port (0: one per CPU)", type=int)
+define("db_connections", default=0, help="database connections of all server processes (0: 80% of the database's limit)", type=int)
+define("max_restarts", default=100, help="restarts of crashed server processes before giving up", type=int)
 
-from config import settings, dbconf, bsconf
+from config import settings, dbconf, bsconf, cacheconf
 from routes import routes
+from handlers import revision_logic
 
 import models
 
+logger = logging.getLogger("tornado.general")
+
+# Seconds to wait for running requests when stopping a server process
+SHUTDOWN_TIMEOUT = 30
+
 class Application(tornado.web.Application):
-    def __init__(self, dbconf, bsconf, handlers=None, **settings):
+    def __init__(self, dbconf, bsconf, handlers=None, threads=8, parsers=2,
+                 **settings):
         super(Application, self).__init__(handlers, **settings)
-        self.blobstore = None # Blobstore(bsconf.nodes, **bsconf.opts)
-        self.database = Database(stale_timeout=599, **dbconf)
+        self.blobstore = Blobstore(bsconf["nodes"], **bsconf["opts"])
+        # One pooled connection per executor thread (and one for the web
+        # handlers running on the IOLoop)
+        self.database = Database(stale_timeout=599,
+            max_connections=threads + 1, **dbconf)
+        self.executor = Executor("executor", self.database, threads)
+        # The processes are started on demand (after forking the workers)
+        self.parsers = parsers and ProcessPoolExecutor(parsers) or None
+
+def get_threads(workers):
+    # Executor threads per worker, so that all workers together stay within
+    # the connections available from the database
+    limit = options.db_connections
+    if not limit:
+        database = MDB(**dbconf)
+        cursor = database.execute_sql("SHOW VARIABLES LIKE 'max_connections'")
+        limit = int(int(cursor.fetchone()[1]) * 0.8)
+        database.close()
+    return max(1, min(options.threads, limit // workers - 1))
+
+def shutdown(server, app, status=0):
+    # Stop accepting connections and exit once the running requests are done
+    # (or after `SHUTDOWN_TIMEOUT`). The parent process forks a replacement
+    # for workers exiting with a non-zero status.
+    server.stop()
+    io_loop = tornado.ioloop.IOLoop.current()
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+
+    def stop():
+        if app.executor.queued + app.executor.running and time.time() < deadline:
+            io_loop.call_later(0.1, stop)
+        else:
+            io_loop.stop()
+            app.executor.shutdown(False)
+            if app.parsers:
+                app.parsers.shutdown(False)
+            sys.exit(status)
+
+    stop()
 
 if __name__ == "__main__":
     tornado.options.parse_command_line()
-    app = Application(dbconf, bsconf, routes, **settings)
+    workers = options.workers or tornado.process.cpu_count()
+    threads = options.threads
+
+    # Bind once, all workers accept connections on the same sockets
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if workers > 1:
+        if settings["debug"]:
+            sys.exit("Multiple workers are not supported in debug mode.")
+        threads = get_threads(workers)
+        logger.info("Starting %d workers with %d threads each", workers,
+                    threads)
+
+        # The parent process restarts crashed workers and forwards SIGTERM
+        # to all of them
+        def terminate(signum, frame):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            os.killpg(0, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, terminate)
+        tornado.process.fork_processes(workers, options.max_restarts)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Connections (and threads) are created after forking
+    app = Application(dbconf, bsconf, routes, threads=threads,
+                      parsers=options.parsers, **settings)
     models.initialize(app.database, app.blobstore)
+    revision_logic.revisions.resize(cacheconf["revisions"])
+    revision_logic.timemaps.resize(cacheconf["timemaps"])
     server = tornado.httpserver.HTTPServer(app)
-    server.listen(tornado.options.options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    server.add_sockets(sockets)
+
+    # SIGTERM stops a process gracefully, SIGHUP restarts a worker
+    io_loop = tornado.ioloop.IOLoop.current()
+    signal.signal(signal.SIGTERM, lambda signum, frame:
+        io_loop.add_callback_from_signal(shutdown, server, app))
+    if workers > 1:
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+            io_loop.add_callback_from_signal(shutdown, server, app, 1))
+    io_loop.start()
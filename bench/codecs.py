@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Compare blob compression codecs on a sample of snapshots of a repository:
+#
+# python bench/codecs.py user/repo [--samples N]
+#
+# Reports the compression ratio as well as compression and decompression
+# throughput (MB/s of uncompressed data) for every available codec and level.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import MDB as Database
+from blobstore import Blobstore
+
+from config import dbconf, bsconf
+from handlers import revision_logic
+
+import compression
+import models
+
+LEVELS = {
+    compression.ZLIB: [1, 6, 9],
+    compression.LZMA: [0, 6, 9],
+    compression.BZ2: [1, 9],
+}
+
+def measure(payloads, codec, level):
+    start = time.time()
+    blobs = [compression.compress(p, codec, level) for p in payloads]
+    ctime = time.time() - start
+
+    start = time.time()
+    for blob in blobs:
+        compression.decompress(blob)
+    dtime = time.time() - start
+
+    return sum(map(len, blobs)), ctime, dtime
+
+def mbps(size, t):
+    return t and size / t / (1 << 20) or float("inf")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("repo", metavar="user/repo")
+    parser.add_argument("--samples", type=int, default=1000,
+        help="number of snapshots sampled")
+    args = parser.parse_args()
+
+    database = Database(**dbconf)
+    blobstore = Blobstore(bsconf["nodes"], **bsconf["opts"])
+    models.initialize(database, blobstore)
+
+    username, reponame = args.repo.split("/")
+    repo = revision_logic.get_repo(username, reponame)
+    if repo == None:
+        sys.exit("Repository %s not found." % args.repo)
+
+    payloads = revision_logic.sample_snapshots(repo, args.samples)
+    size = sum(map(len, payloads))
+    if not size:
+        sys.exit("No snapshots to compress.")
+
+    print "%d snapshots, %d bytes" % (len(payloads), size)
+    print "%-6s %5s %8s %12s %14s" % (
+        "codec", "level", "ratio", "compr. MB/s", "decompr. MB/s")
+
+    for codec, name in sorted(compression.CODECS.items()):
+        if not compression.available(codec):
+            print "%-6s (not available)" % name
+            continue
+        for level in LEVELS[codec]:
+            csize, ctime, dtime = measure(payloads, codec, level)
+            print "%-6s %5d %8.2f %12.1f %14.1f" % (name, level,
+                float(size) / csize, mbps(size, ctime), mbps(size, dtime))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Compare parsing N-Triples with Redland and without it, on the fast path for
+# canonical N-Triples (see `revision_logic.parse_canonical`):
+#
+# python bench/parse.py [FILE ...] [--statements N] [--repeat N]
+#
+# Without files, the inputs are the examples of the tests (converted to
+# N-Triples by Redland), a generated description of a resource and a
+# generated dump of DBpedia-like statements. Reports the throughput (MB/s)
+# of both paths, whether the fast path applied and whether both paths gave
+# the same statements.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers import revision_logic
+
+NTRIPLES = "application/n-triples"
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "test")
+
+EXAMPLE_TYPES = {".ttl": "text/turtle", ".xml": "application/rdf+xml"}
+
+def examples():
+    # The example payloads of the tests as canonical N-Triples
+    for name in sorted(os.listdir(TEST_DIR)):
+        fmt = EXAMPLE_TYPES.get(os.path.splitext(name)[1])
+        if not name.startswith("example") or fmt == None:
+            continue
+        with open(os.path.join(TEST_DIR, name)) as f:
+            stmts = revision_logic.parse(f.read(), fmt)
+        yield name, revision_logic.join(sorted(stmts), "\n")
+
+def dbpedia(n, seed=0):
+    # `n` statements like those of DBpedia resource descriptions (50 per
+    # resource)
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            o = "<http://dbpedia.org/resource/Resource_%d>" % rnd.randint(0, n)
+        elif kind == 1:
+            o = '"Label of resource %d"@en' % i
+        elif kind == 2:
+            o = ('"%d"^^<http://www.w3.org/2001/XMLSchema#integer>' %
+                 rnd.randint(0, 1000000))
+        else:
+            o = '"An \\"abstract\\" of resource %d.\\nSecond line."@en' % i
+        lines.append("<http://dbpedia.org/resource/Resource_%d> "
+                     "<http://dbpedia.org/property/p%d> %s ." % (
+                     i // 50, i % 40, o))
+    return "\n".join(lines) + "\n"
+
+def measure(s, canonical, repeat):
+    # Best time of `repeat` runs and the statements
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        stmts = revision_logic.parse(s, NTRIPLES, canonical)
+        t = time.time() - start
+        best = best == None and t or min(best, t)
+    return best, stmts
+
+def mbps(size, t):
+    return t and size / t / (1 << 20) or float("inf")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", metavar="FILE", nargs="*",
+        help="N-Triples files (default: generated inputs)")
+    parser.add_argument("--statements", type=int, default=100000,
+        help="statements of the generated dump")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="runs per input and path (the best one counts)")
+    args = parser.parse_args()
+
+    if args.files:
+        inputs = [(os.path.basename(path), open(path).read())
+                  for path in args.files]
+    else:
+        inputs = list(examples())
+        inputs.append(("resource", dbpedia(500)))
+        inputs.append(("dump", dbpedia(args.statements)))
+
+    print "%-14s %10s %8s %12s %12s %8s %5s %5s" % ("input", "bytes",
+        "stmts", "redland MB/s", "fast MB/s", "speedup", "fast", "same")
+    for name, s in inputs:
+        rtime, rstmts = measure(s, False, args.repeat)
+        ftime, fstmts = measure(s, True, args.repeat)
+        fast = revision_logic.parse_canonical(s) != None
+        print "%-14s %10d %8d %12.1f %12.1f %8.1f %5s %5s" % (name, len(s),
+            len(rstmts), mbps(len(s), rtime), mbps(len(s), ftime),
+            ftime and rtime / ftime or float("inf"),
+            fast and "yes" or "no", rstmts == fstmts and "yes" or "no")
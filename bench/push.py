@@ -33,6 +33,48 @@ def push(directory, endpoint, token):
 
     s.close()
 
+def push_batches(directory, endpoint, token, size=1000):
+    # Push `size` resources per request as N-Quads (graph name: key), the
+    # files are expected to contain one N-Triples statement per line
+    s = requests.Session()
+    s.headers = {
+        'Content-Type': 'application/n-quads',
+        'Authorization': 'token %s' % token,
+    }
+
+    plen = len(directory) + 1 # prefix: base directory + "/"
+
+    def send(quads):
+        res = s.request('POST', endpoint, data=''.join(quads))
+        if res.status_code != 200:
+            print str(res.status_code) + ' ' + res.reason
+        else:
+            summary = res.json()
+            print '%(saved)d saved, %(unchanged)d unchanged, %(failed)d failed' % summary
+
+    quads = []
+    count = 0
+    for root, subdirs, files in os.walk(directory):
+        for fname in files:
+            path = os.path.join(root, fname)
+            name = os.path.splitext(path[plen:].replace('/', '', 1))[0]
+            key = 'http://dbpedia.org/resource/' + name
+
+            for line in open(path):
+                line = line.strip()
+                if line.endswith('.'):
+                    quads.append('%s <%s> .\n' % (line[:-1].rstrip(), key))
+
+            count += 1
+            if count % size == 0:
+                send(quads)
+                quads = []
+
+    if quads:
+        send(quads)
+
+    s.close()
+
 if __name__ == '__main__':
     directory = './3.8'
     endpoint = 'http://localhost:8080/api/pmeinhardt/test'
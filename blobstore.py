@@ -0,0 +1,544 @@
+import calendar
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from peewee import IntegrityError, JOIN_LEFT_OUTER
+
+# Blobs (compressed snapshots and deltas) are addressed by the same composite
+# key as their changeset: (repo, hkey, time). Two backends are available:
+#
+# - `TableBlobstore` keeps blobs in the database `blob` table (default).
+# - `SegmentBlobstore` appends blobs to local segment files and serves reads
+#   from memory-mapped slices, keeping bulk data out of the database.
+#
+# Use `Blobstore(nodes, **opts)` to construct the store configured in
+# `config.bsconf`. It returns `None` if no nodes are configured, in which case
+# `models.initialize` falls back to the `blob` table.
+#
+# Besides `get_many`, both stores implement `join(repo, sha, query, fields)`,
+# which runs a query for changesets of a single resource and returns its rows
+# (with the given fields) along with the data of their blobs as `data` (None
+# for changesets without a blob). The table store fetches both in one query.
+# `put_many(repo, blobs)` stores many (sha, ts, data) blobs at once. Storing a
+# blob under the key of an existing one raises `IntegrityError`.
+#
+# In `atomic` blocks, changesets are written before their blobs, so that the
+# database rejects changesets (and their blobs) with the key of an existing
+# one. A blob of the segment store found there under the key of a new
+# changeset is left over from a transaction which was never committed (e.g.
+# by a crashed process) and is replaced.
+#
+# Changesets and their blobs are written in `atomic(database)` blocks, a
+# transaction (or savepoint) of the database which the blobs written in it
+# follow: blobs stored in it are removed again if it is rolled back, and
+# blobs deleted in it are only deleted once the outermost transaction has
+# been committed (a deleted blob may be stored again in the meantime).
+
+def Blobstore(nodes, **opts):
+    if not nodes:
+        return None
+    if len(nodes) > 1:
+        raise ValueError("Only a single local blobstore node is supported.")
+    return SegmentBlobstore(nodes[0], **opts)
+
+def _repo_id(repo):
+    return getattr(repo, "id", repo)
+
+def _epoch(ts):
+    return calendar.timegm(ts.utctimetuple())
+
+class TableBlobstore(object):
+    """Stores blobs in a database table."""
+
+    # Max. amount of blob data written per multi-row insert
+    BATCH_BYTES = 1024 * 1024
+
+    def __init__(self, model):
+        self.model = model
+
+    def atomic(self, database):
+        # The blob table is part of the transaction anyway
+        return database.atomic()
+
+    def get_many(self, repo, sha, times):
+        Blob = self.model
+        rows = (Blob
+            .select(Blob.time, Blob.data)
+            .where(
+                (Blob.repo == repo) &
+                (Blob.hkey == sha) &
+                (Blob.time << list(times)))
+            .tuples())
+        found = dict(rows)
+        return [found[ts] for ts in times]
+
+    def join(self, repo, sha, query, fields):
+        Blob = self.model
+        csets = query.model_class
+        return list(query
+            .select(*(tuple(fields) + (Blob.data,)))
+            .join(Blob, JOIN_LEFT_OUTER, on=(
+                (Blob.repo == csets.repo) &
+                (Blob.hkey == csets.hkey) &
+                (Blob.time == csets.time)))
+            .naive())
+
+    def put(self, repo, sha, ts, data):
+        self.model.create(repo=repo, hkey=sha, time=ts, data=data)
+
+    def put_many(self, repo, blobs):
+        rows = []
+        size = 0
+        for sha, ts, data in blobs:
+            rows.append({"repo": repo, "hkey": sha, "time": ts, "data": data})
+            size += len(data)
+            if size >= self.BATCH_BYTES:
+                self.model.insert_many(rows).execute()
+                rows = []
+                size = 0
+        if rows:
+            self.model.insert_many(rows).execute()
+
+    def delete(self, repo, sha, ts):
+        Blob = self.model
+        (Blob
+            .delete()
+            .where((Blob.repo == repo) & (Blob.hkey == sha) & (Blob.time == ts))
+            .execute())
+
+    def delete_key(self, repo, sha):
+        Blob = self.model
+        Blob.delete().where((Blob.repo == repo) & (Blob.hkey == sha)).execute()
+
+    def delete_repo(self, repo):
+        Blob = self.model
+        Blob.delete().where(Blob.repo == repo).execute()
+
+    def items(self):
+        Blob = self.model
+        rows = (Blob
+            .select(Blob.repo, Blob.hkey, Blob.time, Blob.data)
+            .order_by(Blob.repo, Blob.hkey, Blob.time)
+            .tuples())
+        return rows.iterator()
+
+class SegmentBlobstore(object):
+    """Stores blobs in append-only segment files inside a local directory.
+
+    Each record consists of a fixed-size header followed by the blob data,
+    whose checksum is verified on every scan and read.
+    Deletions append tombstone records. The location of the latest record for
+    every (repo, hkey, time) is kept in an in-memory directory which is built
+    on startup and caught up with records appended by other processes before
+    every read and write. `compact` reclaims the space of deleted records.
+
+    The directory of a segment which is no longer appended to is saved in a
+    hint file along with it, so that only the active segment (and segments
+    without hints) is scanned on startup. The directory takes about 200 bytes
+    of memory per blob in every process, i.e. a few GB for tens of millions
+    of blobs, which limits the size of a store.
+    """
+
+    # magic, flags, repo id, hkey, time (epoch seconds), data length, crc32
+    HEADER = struct.Struct("<4sBI20sqIi")
+    MAGIC = "TLRB"
+
+    # Hint files: magic and size of the segment, followed by an entry per
+    # record (flags, repo id, hkey, time, data offset, length, crc32)
+    HINT_HEADER = struct.Struct("<4sQ")
+    HINT = struct.Struct("<BI20sqQIi")
+    HINT_MAGIC = "TLRH"
+
+    TOMBSTONE = 1
+
+    def __init__(self, path, segment_size=1 << 30, sync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # repo id -> hkey -> epoch -> (segment, offset, length, crc32)
+        self.keydir = {}
+        self.maps = {}     # segment -> mmap of the segment file
+        self.scanned = {}  # segment -> offset up to which records are known
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        segments = sorted(self.__segments())
+        self.active = segments and segments[-1] or 1
+        with self.lock:
+            for segment in segments:
+                if segment == self.active or not self.__load_hints(segment):
+                    self.__scan(segment)
+
+    def __segments(self):
+        for name in os.listdir(self.path):
+            if name.endswith(".seg"):
+                yield int(name[:-4])
+
+    def __segment_path(self, segment):
+        return os.path.join(self.path, "%08d.seg" % segment)
+
+    def __hint_path(self, segment):
+        return os.path.join(self.path, "%08d.hint" % segment)
+
+    def __scan(self, segment):
+        # Read records from the last known offset onwards. Scanning stops at the
+        # end of the file or at a truncated or corrupted record (an interrupted
+        # write), which will be cut off before the next append.
+        path = self.__segment_path(segment)
+        offset = self.scanned.get(segment, 0)
+        if not os.path.exists(path) or os.path.getsize(path) <= offset:
+            return
+        size = os.path.getsize(path)
+        # Entries of a hint file, if the whole segment is scanned
+        hints = [] if offset == 0 and segment < self.active else None
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while offset + self.HEADER.size <= size:
+                header = f.read(self.HEADER.size)
+                magic, flags, rid, sha, epoch, length, crc = \
+                    self.HEADER.unpack(header)
+                if magic != self.MAGIC:
+                    raise IOError("Corrupt blobstore segment %s at offset %d" %
+                        (path, offset))
+                start = offset + self.HEADER.size
+                if start + length > size:
+                    break
+                if zlib.crc32(f.read(length)) != crc:
+                    break
+                self.__index(segment, flags, rid, sha, epoch, start, length,
+                    crc)
+                if hints is not None:
+                    hints.append((flags, rid, sha, epoch, start, length, crc))
+                offset = start + length
+        self.scanned[segment] = offset
+        if hints is not None and offset == size:
+            self.__save_hints(segment, size, hints)
+
+    def __index(self, segment, flags, rid, sha, epoch, start, length, crc):
+        if flags & self.TOMBSTONE:
+            self.__forget(rid, sha, epoch)
+        else:
+            (self.keydir
+                .setdefault(rid, {})
+                .setdefault(sha, {}))[epoch] = (segment, start, length, crc)
+
+    def __save_hints(self, segment, size, hints):
+        # Written to a temporary file first, so that a hint file is complete
+        path = self.__hint_path(segment)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(self.HINT_HEADER.pack(self.HINT_MAGIC, size))
+            for hint in hints:
+                f.write(self.HINT.pack(*hint))
+        os.rename(tmp, path)
+
+    def __load_hints(self, segment):
+        # Index a segment from its hint file. Returns False if there is no
+        # hint file (or none matching the segment).
+        path = self.__hint_path(segment)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            size = os.path.getsize(self.__segment_path(segment))
+        except EnvironmentError:
+            return False
+        if len(data) < self.HINT_HEADER.size:
+            return False
+        magic, hinted = self.HINT_HEADER.unpack_from(data)
+        entries = len(data) - self.HINT_HEADER.size
+        if (magic != self.HINT_MAGIC or hinted != size or
+                entries % self.HINT.size):
+            return False
+        for offset in xrange(self.HINT_HEADER.size, len(data), self.HINT.size):
+            self.__index(segment, *self.HINT.unpack_from(data, offset))
+        self.scanned[segment] = size
+        return True
+
+    def __forget(self, rid, sha, epoch):
+        shas = self.keydir.get(rid)
+        epochs = shas and shas.get(sha)
+        if epochs and epochs.pop(epoch, None) and not epochs:
+            del shas[sha]
+            if not shas:
+                del self.keydir[rid]
+
+    def __location(self, key):
+        rid, sha, epoch = key
+        return self.keydir.get(rid, {}).get(sha, {}).get(epoch)
+
+    def __keys(self, rid, sha=None):
+        shas = self.keydir.get(rid, {})
+        if sha != None:
+            shas = {sha: shas.get(sha, {})}
+        return [(rid, hkey, epoch)
+            for hkey, epochs in shas.iteritems() for epoch in epochs]
+
+    def __refresh(self):
+        # Catch up with records appended by other processes.
+        self.__scan(self.active)
+        while os.path.exists(self.__segment_path(self.active + 1)):
+            self.active += 1
+            self.__scan(self.active)
+
+    def __map(self, segment, end):
+        m = self.maps.get(segment)
+        if m is None or len(m) < end:
+            if m is not None:
+                m.close()
+            with open(self.__segment_path(segment), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = m
+        return m
+
+    def __read(self, location):
+        segment, start, length, crc = location
+        m = self.__map(segment, start + length)
+        data = m[start:start + length]
+        if zlib.crc32(data) != crc:
+            raise IOError("Corrupt blob in segment %s at offset %d" %
+                (self.__segment_path(segment), start))
+        return data
+
+    def __get(self, key):
+        # The data of a blob, None if there is none
+        location = self.__location(key)
+        if location == None:
+            return None
+        try:
+            return self.__read(location)
+        except EnvironmentError:
+            # The segment was compacted by another process meanwhile, which
+            # appended the blob again
+            self.__refresh()
+            location = self.__location(key)
+            return location and self.__read(location) or None
+
+    def __append(self, records):
+        # Append records of (repo id, hkey, epoch, flags, data) to the active
+        # segment. An exclusive lock on the segment file serializes appends of
+        # concurrent processes. `records` may be a function returning them,
+        # which is called with the lock held (and the directory caught up).
+        with self.lock:
+            while True:
+                segment = self.active
+                fd = os.open(self.__segment_path(segment),
+                    os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    self.__refresh()
+                    if segment != self.active:
+                        # Another process started a new segment meanwhile.
+                        continue
+                    size = self.scanned.get(segment, 0)
+                    if os.fstat(fd).st_size > size:
+                        # Cut off a truncated record left by a crashed writer.
+                        os.ftruncate(fd, size)
+                    if size >= self.segment_size:
+                        self.active += 1
+                        continue
+                    if callable(records):
+                        records = records()
+                    chunks = []
+                    for rid, sha, epoch, flags, data in records:
+                        chunks.append(self.HEADER.pack(self.MAGIC, flags, rid,
+                            sha, epoch, len(data), zlib.crc32(data)))
+                        chunks.append(data)
+                    buf = "".join(chunks)
+                    while buf:
+                        buf = buf[os.write(fd, buf):]
+                    if self.sync:
+                        os.fsync(fd)
+                    self.__scan(segment)
+                    return
+                finally:
+                    os.close(fd)
+
+    def get_many(self, repo, sha, times):
+        rid = _repo_id(repo)
+        with self.lock:
+            self.__refresh()
+            blobs = [self.__get((rid, sha, _epoch(ts))) for ts in times]
+        if None in blobs:
+            raise KeyError("Blob of %r not found." % times[blobs.index(None)])
+        return blobs
+
+    def join(self, repo, sha, query, fields):
+        rows = list(query.select(*fields).naive())
+        rid = _repo_id(repo)
+        with self.lock:
+            self.__refresh()
+            for row in rows:
+                row.data = self.__get((rid, sha, _epoch(row.time)))
+        return rows
+
+    @contextlib.contextmanager
+    def atomic(self, database):
+        journals = self.__journals()
+        journal = _Journal()
+        journals.append(journal)
+        try:
+            with database.atomic():
+                yield
+        except BaseException:
+            journals.pop()
+            self.__undo(journal)
+            raise
+        journals.pop()
+        if journals:
+            journals[-1].merge(journal)
+        elif journal.deletes:
+            self.__append([key + (self.TOMBSTONE, "")
+                for key in journal.deletes])
+
+    def __journals(self):
+        # Journals of the `atomic` blocks of this thread, innermost last
+        return self.local.__dict__.setdefault("journals", [])
+
+    def __undo(self, journal):
+        # Restore the records replaced by the puts of a rolled back journal
+        # (in reverse order), resp. delete the blobs stored anew
+        with self.lock:
+            records = []
+            for key, previous, owner in reversed(journal.puts):
+                if previous == None:
+                    records.append(key + (self.TOMBSTONE, ""))
+                else:
+                    records.append(key + (0, self.__read(previous)))
+                if owner != None and owner is not journal:
+                    # The delete cancelled by the put is deferred again
+                    owner.deletes.add(key)
+            if records:
+                self.__append(records)
+
+    def put(self, repo, sha, ts, data):
+        self.put_many(repo, [(sha, ts, data)])
+
+    def put_many(self, repo, blobs):
+        rid = _repo_id(repo)
+        records = [(rid, sha, _epoch(ts), 0, data) for sha, ts, data in blobs]
+        if not records:
+            return
+        with self.lock:
+            self.__refresh()
+            journals = self.__journals()
+            puts = []
+            for record in records:
+                key = record[:3]
+                previous = self.__location(key)
+                owner = None
+                if previous != None:
+                    # Only blobs deleted in the current transaction can be
+                    # stored again
+                    owner = next((j for j in reversed(journals)
+                        if key in j.deletes), None)
+                    if owner == None and not journals:
+                        raise IntegrityError("Duplicate blob %r." % (key,))
+                    elif owner == None:
+                        # Left over from a transaction which was never
+                        # committed (see above): replaced like a new blob
+                        previous = None
+                puts.append((key, previous, owner))
+            for key, previous, owner in puts:
+                if owner != None:
+                    owner.deletes.discard(key)
+            self.__append(records)
+            if journals:
+                journals[-1].puts += puts
+
+    def delete(self, repo, sha, ts):
+        self.__delete([(_repo_id(repo), sha, _epoch(ts))])
+
+    def delete_key(self, repo, sha):
+        with self.lock:
+            self.__refresh()
+            self.__delete(self.__keys(_repo_id(repo), sha))
+
+    def delete_repo(self, repo):
+        with self.lock:
+            self.__refresh()
+            self.__delete(self.__keys(_repo_id(repo)))
+
+    def __delete(self, keys):
+        journals = self.__journals()
+        if journals:
+            journals[-1].deletes.update(keys)
+        elif keys:
+            self.__append([key + (self.TOMBSTONE, "") for key in keys])
+
+    def compact(self, min_garbage=0.5, batch_bytes=64 * 1024 * 1024):
+        """Reclaim the space of deleted and replaced records.
+
+        If at least `min_garbage` of the segments before the active one is
+        taken by such records, their remaining blobs are appended to the
+        active segment again and the segments are removed (tombstones in them
+        only refer to records in the same or earlier segments). Returns the
+        number of bytes reclaimed.
+        """
+        with self.lock:
+            self.__refresh()
+            sealed = set(s for s in self.__segments() if s < self.active)
+            size = sum(os.path.getsize(self.__segment_path(s))
+                for s in sealed)
+            live = sum(location[2] + self.HEADER.size
+                for shas in self.keydir.itervalues()
+                for epochs in shas.itervalues()
+                for location in epochs.itervalues()
+                if location[0] in sealed)
+            if not sealed or size - live < min_garbage * size:
+                return 0
+
+            def batch():
+                # Next blobs still in the sealed segments (picked with the
+                # lock held, so that blobs deleted meanwhile are left out)
+                records = []
+                total = 0
+                for rid, shas in self.keydir.iteritems():
+                    for sha, epochs in shas.iteritems():
+                        for epoch, location in epochs.iteritems():
+                            if location[0] not in sealed:
+                                continue
+                            records.append((rid, sha, epoch, 0,
+                                self.__read(location)))
+                            total += location[2]
+                            if total >= batch_bytes:
+                                return records
+                return records
+
+            copied = True
+            while copied:
+                copied = []
+                self.__append(lambda: copied.extend(batch()) or copied)
+
+            for segment in sealed:
+                m = self.maps.pop(segment, None)
+                if m is not None:
+                    m.close()
+                self.scanned.pop(segment, None)
+                if os.path.exists(self.__hint_path(segment)):
+                    os.remove(self.__hint_path(segment))
+                os.remove(self.__segment_path(segment))
+            return size - live
+
+class _Journal(object):
+    # Blob changes of an `atomic` block of the segment store: the puts along
+    # with the record each one replaced (None for new blobs) and the journal
+    # whose deferred delete of that record it cancelled, and the keys of the
+    # blobs to delete after the commit
+
+    def __init__(self):
+        self.puts = []
+        self.deletes = set()
+
+    def merge(self, journal):
+        # Take over the changes of a committed nested block
+        self.puts += map(lambda (key, previous, owner): (key, previous,
+            owner is journal and self or owner), journal.puts)
+        self.deletes |= journal.deletes
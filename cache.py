@@ -0,0 +1,78 @@
+import collections
+import threading
+
+import metrics
+
+class LRUCache(object):
+    """In-process cache bounded by the total size of its entries.
+
+    The size of each entry is given by the caller. Once the total exceeds
+    `max_bytes`, the least recently used entries are evicted. Hits, misses
+    and evictions are counted as `<name>.hits` etc. in `metrics`.
+    """
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (value, size)
+        self.size = 0
+
+        metrics.gauge(name + ".bytes", lambda: self.size)
+        metrics.gauge(name + ".entries", lambda: len(self.entries))
+        metrics.gauge(name + ".hit_rate", lambda: metrics.ratio(
+            metrics.value(name + ".hits"),
+            metrics.value(name + ".hits") + metrics.value(name + ".misses")))
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry != None:
+                # Move to the most recently used end
+                self.entries[key] = entry
+        if entry == None:
+            metrics.incr(self.name + ".misses")
+            return default
+        metrics.incr(self.name + ".hits")
+        return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.__pop(key)
+            self.entries[key] = (value, size)
+            self.size += size
+            evicted = self.__evict()
+        if evicted:
+            metrics.incr(self.name + ".evictions", evicted)
+
+    def delete(self, key):
+        with self.lock:
+            self.__pop(key)
+
+    def delete_matching(self, predicate):
+        # Delete all entries whose key matches (scans the whole cache)
+        with self.lock:
+            for key in filter(predicate, self.entries.keys()):
+                self.__pop(key)
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            evicted = self.__evict()
+        if evicted:
+            metrics.incr(self.name + ".evictions", evicted)
+
+    def __pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            self.size -= entry[1]
+
+    def __evict(self):
+        evicted = 0
+        while self.size > self.max_bytes:
+            key, (value, size) = self.entries.popitem(last=False)
+            self.size -= size
+            evicted += 1
+        return evicted
@@ -0,0 +1,215 @@
+import bz2
+import collections
+import struct
+import zlib
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
+# Blobs are stored in a versioned envelope recording how they were compressed:
+# version byte (2), codec id and dictionary version (0: none), followed by the
+# compressed data.
+#
+# Blobs written before the envelope was introduced are plain zlib streams
+# without any header. The first byte of a zlib stream always has 8 in its
+# lower four bits, so it is never mistaken for an envelope version.
+ENVELOPE = struct.Struct("<BBH")
+
+# Codecs
+ZLIB = 0
+LZMA = 1
+BZ2 = 2
+
+CODECS = {
+    ZLIB: "zlib",
+    LZMA: "lzma",
+    BZ2: "bz2",
+}
+
+# Valid compression levels per codec
+LEVELS = {
+    ZLIB: range(0, 10),
+    LZMA: range(0, 10),
+    BZ2: range(1, 10),
+}
+
+# Most resources are small, so zlib compresses each of their blobs without any
+# useful history. A preset dictionary provides that history: it is fed to the
+# compressor before the data, and back-references into it are resolved by the
+# decompressor, which is primed with the same dictionary.
+#
+# The zlib module of Python 2 does not support preset dictionaries directly.
+# `PresetDictionary` emulates them with raw deflate streams: the dictionary is
+# compressed once and flushed to a byte boundary, and every blob continues a
+# copy of that compressor state. Only the continuation is stored.
+
+# Deflate can only refer back 32 KiB, so larger dictionaries are pointless
+MAX_DICT_SIZE = 32768
+
+class PresetDictionary(object):
+    """Raw deflate compression with a preset dictionary."""
+
+    def __init__(self, data, level=None):
+        if level == None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        self.data = data
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        prefix = c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+        d.decompress(prefix)
+        self.compressor = c
+        self.decompressor = d
+
+    def compress(self, s):
+        c = self.compressor.copy()
+        return c.compress(s) + c.flush()
+
+    def decompress(self, s):
+        d = self.decompressobj()
+        return d.decompress(s) + d.flush()
+
+    def decompressobj(self):
+        # A raw deflate decompressor primed with the dictionary
+        return self.decompressor.copy()
+
+def available(codec):
+    return codec in CODECS and (codec != LZMA or lzma != None)
+
+def _lzma():
+    if lzma == None:
+        raise ValueError("The lzma codec requires backports.lzma.")
+    return lzma
+
+def compress(s, codec=ZLIB, level=None, dictionary=None):
+    """Compress `s` into an enveloped blob.
+
+    `dictionary` is an optional pair of version and `PresetDictionary`, which
+    must have been created with the same `level`. Only zlib supports
+    dictionaries.
+    """
+    version = 0
+    if codec == ZLIB:
+        if dictionary:
+            version, d = dictionary
+            data = d.compress(s)
+        elif level == None:
+            data = zlib.compress(s)
+        else:
+            data = zlib.compress(s, level)
+    elif codec == LZMA:
+        data = _lzma().compress(s, format=lzma.FORMAT_ALONE, preset=level)
+    elif codec == BZ2:
+        data = bz2.compress(s, level or 9)
+    else:
+        raise ValueError("Unknown codec %r" % codec)
+    return ENVELOPE.pack(2, codec, version) + data
+
+def decompress(blob, dictionaries=None):
+    """Decompress a blob (with or without an envelope).
+
+    `dictionaries` maps a dictionary version to its `PresetDictionary`; it is
+    required for blobs compressed with a dictionary.
+    """
+    first = blob[:1]
+    if first == "\x02":
+        _, codec, version = ENVELOPE.unpack_from(blob)
+        data = blob[ENVELOPE.size:]
+    else:
+        return zlib.decompress(blob)
+
+    if codec == ZLIB:
+        if version:
+            return dictionaries(version).decompress(data)
+        return zlib.decompress(data)
+    elif codec == LZMA:
+        return _lzma().decompress(data)
+    elif codec == BZ2:
+        return bz2.decompress(data)
+    raise ValueError("Unknown codec %r" % codec)
+
+def decompress_chunks(blob, dictionaries=None, size=65536):
+    """Like `decompress`, but yield the data in chunks of about `size` bytes,
+    without holding all of it in memory at once.
+    """
+    first = blob[:1]
+    if first == "\x02":
+        _, codec, version = ENVELOPE.unpack_from(blob)
+        data = buffer(blob, ENVELOPE.size)
+    else:
+        return _zlib_chunks(zlib.decompressobj(), blob, size)
+
+    if codec == ZLIB:
+        if version:
+            return _zlib_chunks(dictionaries(version).decompressobj(), data,
+                size)
+        return _zlib_chunks(zlib.decompressobj(), data, size)
+    elif codec == LZMA:
+        return _fed_chunks(_lzma().LZMADecompressor(), data, size)
+    elif codec == BZ2:
+        return _fed_chunks(bz2.BZ2Decompressor(), data, size)
+    raise ValueError("Unknown codec %r" % codec)
+
+def _zlib_chunks(d, data, size):
+    # The output of a zlib decompressor is bounded directly
+    while data:
+        chunk = d.decompress(data, size)
+        data = d.unconsumed_tail
+        if chunk:
+            yield chunk
+    chunk = d.flush()
+    if chunk:
+        yield chunk
+
+def _fed_chunks(d, data, size):
+    # Other decompressors are fed a fraction of `size` at a time (data of
+    # statements rarely compresses better than 1:8), but bz2 still yields
+    # whole blocks of up to 900 kB
+    step = max(size // 8, 1)
+    for i in range(0, len(data), step):
+        chunk = d.decompress(data[i:i + step])
+        if chunk:
+            yield chunk
+
+def zlib_stream(blob):
+    """The zlib stream of a blob compressed with zlib and no dictionary, or
+    None for other blobs.
+
+    The stream can be decompressed by any zlib implementation, e.g. by HTTP
+    clients as the `deflate` content-coding.
+    """
+    first = blob[:1]
+    if first == "\x02":
+        _, codec, version = ENVELOPE.unpack_from(blob)
+        if codec != ZLIB or version:
+            return None
+        return blob[ENVELOPE.size:]
+    return blob
+
+def train(samples, tokens, size=MAX_DICT_SIZE):
+    """Build a preset dictionary from sample data.
+
+    `tokens` splits a sample into the substrings worth sharing between
+    samples (e.g. the terms of N-Triples statements). Tokens occurring in
+    more than one sample are picked by the number of bytes they cover in all
+    samples, and the most valuable ones are placed at the end of the
+    dictionary, where they are cheapest to refer to.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(tokens(sample)))
+
+    scored = sorted(
+        ((count * len(token), token)
+            for token, count in counts.iteritems() if count > 1),
+        reverse=True)
+
+    picked = []
+    total = 0
+    for score, token in scored:
+        if total + len(token) <= size:
+            picked.append(token)
+            total += len(token)
+    picked.reverse()
+    return "".join(picked)
@@ -39,5 +39,23 @@ settings = dict(
 dbconf = playhouse.db_url.parse(env["DATABASE_URL"])
 
 # Blob store configuration
+#
+# Snapshots and deltas are stored in the database `blob` table by default.
+# To keep them in append-only segment files on the local disk instead, set
+# BLOBSTORE_PATH="/path/to/blobs" (see `blobstore.py`).
+
+bsconf = dict(
+    nodes               = filter(None, [env.get("BLOBSTORE_PATH")]),
+    opts                = {},
+)
 
-bsconf = dict(nodes=[], opts={})
+# In-process caches
+#
+# REVISION_CACHE_SIZE bounds the memory (in bytes, approximately) used for
+# caching reconstructed revisions in each server process, TIMEMAP_CACHE_SIZE
+# the memory used for caching serialized timemap pages.
+
+cacheconf = dict(
+    revisions           = int(env.get("REVISION_CACHE_SIZE", 64 * 1024 * 1024)),
+    timemaps            = int(env.get("TIMEMAP_CACHE_SIZE", 16 * 1024 * 1024)),
+)
@@ -3,6 +3,7 @@
 # Load application environment and initialize models
 
 from database import MDB as Database
+from blobstore import Blobstore
 
 from config import settings, dbconf, bsconf
 from models import *
@@ -10,7 +11,7 @@ from models import *
 import models
 
 database = Database(**dbconf)
-blobstore = None # Blobstore(bsconf.nodes, **bsconf.opts)
+blobstore = Blobstore(bsconf["nodes"], **bsconf["opts"])
 models.initialize(database, blobstore)
 
 # Drop into IPython
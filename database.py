@@ -1,4 +1,4 @@
-from peewee import MySQLDatabase, SQL
+from peewee import MySQLDatabase, SQL, OperationalError
 from peewee import Field, BlobField, DateTimeField, IntegerField
 from playhouse.pool import PooledDatabase
 
@@ -95,7 +95,38 @@ class MSQLMediumBlobField(BlobField):
 class MSQLLongBlobField(BlobField):
     db_field = "longblob"
 
-class MDB(MySQLDatabase): pass
+# Number of named locks acquired per query
+LOCK_BATCH_SIZE = 500
+
+class MDB(MySQLDatabase):
+    def lock(self, names, timeout):
+        # Acquire named locks (GET_LOCK, several per session require MySQL
+        # 5.7), which are held by the connection until released with
+        # `unlock`, even beyond transactions. Returns the acquired names.
+        # Raises OperationalError (releasing the acquired ones) if a lock is
+        # not acquired within `timeout` seconds.
+        locked = []
+        for i in range(0, len(names), LOCK_BATCH_SIZE):
+            batch = names[i:i + LOCK_BATCH_SIZE]
+            try:
+                row = self.execute_sql(
+                    "SELECT " + ", ".join(["GET_LOCK(%s, %s)"] * len(batch)),
+                    [v for name in batch for v in (name, timeout)]).fetchone()
+            except:
+                self.unlock(locked + batch)
+                raise
+            locked += [name for name, ok in zip(batch, row) if ok == 1]
+            if len(locked) < i + len(batch):
+                self.unlock(locked)
+                raise OperationalError("Lock wait timeout exceeded.")
+        return locked
+
+    def unlock(self, names):
+        for i in range(0, len(names), LOCK_BATCH_SIZE):
+            batch = names[i:i + LOCK_BATCH_SIZE]
+            self.execute_sql(
+                "SELECT " + ", ".join(["RELEASE_LOCK(%s)"] * len(batch)),
+                batch)
 
 MDB.register_fields({
     "binary": "BINARY",
@@ -0,0 +1,82 @@
+import sys
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+
+class Executor(object):
+    """Runs blocking work (queries, parsing, diffing) on a bounded pool of
+    threads, off the IOLoop.
+
+    Each task gets a database connection from the (pooled) `database` for
+    its duration. Tasks submitted with the same serialization keys run one
+    after another in the order they were submitted, e.g. writes of the same
+    resource. `<name>.queued` counts the tasks waiting for a thread (or for
+    a preceding task) and `<name>.running` the tasks being run in `metrics`.
+    """
+
+    def __init__(self, name, database, max_workers):
+        self.database = database
+        self.threads = ThreadPoolExecutor(max_workers)
+        self.lock = threading.Lock()
+        self.tails = {}  # serialization key -> future of its latest task
+        self.queued = 0
+        self.running = 0
+
+        metrics.gauge(name + ".queued", lambda: self.queued)
+        metrics.gauge(name + ".running", lambda: self.running)
+
+    def submit(self, fn, *args, **kwargs):
+        # Run `fn(*args, **kwargs)` on a thread, returns a future of its
+        # result (which can be yielded by coroutines)
+        return self.serialize((), fn, *args, **kwargs)
+
+    def serialize(self, keys, fn, *args, **kwargs):
+        # Like `submit`, but run after the tasks submitted before with any of
+        # the same `keys`
+        future = Future()
+        with self.lock:
+            self.queued += 1
+            waiting = set(filter(None, map(self.tails.get, keys)))
+            for key in keys:
+                self.tails[key] = future
+        pending = [len(waiting)]
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        self.database.connect()
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException:
+                        future.set_exception_info(*sys.exc_info()[1:])
+                    finally:
+                        if not self.database.is_closed():
+                            self.database.close()
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    for key in keys:
+                        if self.tails.get(key) is future:
+                            del self.tails[key]
+
+        def ready(_):
+            with self.lock:
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+            self.threads.submit(run)
+
+        if waiting:
+            for f in waiting:
+                f.add_done_callback(ready)
+        else:
+            self.threads.submit(run)
+        return future
+
+    def shutdown(self, wait=True):
+        self.threads.shutdown(wait)
@@ -1,3 +1,4 @@
+import binascii
 import datetime
 import functools
 import string
@@ -5,7 +6,8 @@ import string
 import json
 import traceback
 
-from tornado.web import HTTPError
+from tornado import gen
+from tornado.web import HTTPError, stream_request_body
 from tornado.escape import url_escape, json_encode
 #from peewee import IntegrityError, SQL, fn
 from peewee import IntegrityError
@@ -14,6 +16,7 @@ from RDF import RedlandError
 from models import User, Token, Repo, HMap, CSet, Blob
 from handlers import RequestHandler
 import revision_logic
+import metrics
 
 import logging
 logger = logging.getLogger('debug')
@@ -33,6 +36,25 @@ QSDATEFMT = "%Y-%m-%d-%H:%M:%S"
 # RFC 1123 date format, e.g. `Mon, 11 May 2015 16:56:21 GMT`
 RFC1123DATEFMT = "%a, %d %b %Y %H:%M:%S GMT"
 
+# Seconds that clients and proxies may cache mementos which are not the
+# latest one (these only change when the history is edited, which changes
+# their ETags)
+MEMENTO_MAX_AGE = 365 * 24 * 60 * 60
+
+# Media types of N-Quads payloads (of batch pushes)
+NQUADS_TYPES = ("application/n-quads", "text/x-nquads")
+
+# Media types of N-Triples payloads
+NTRIPLES_TYPES = ("application/n-triples",)
+
+# Max. size of N-Triples/N-Quads payloads in bytes, which are parsed while
+# they arrive (payloads of other formats are buffered, up to the server's
+# `max_body_size`)
+MAX_STREAMED_BODY_SIZE = 1024 * 1024 * 1024
+
+# Payloads from this size on (in bytes) are parsed by the parser processes
+PARSE_POOL_THRESHOLD = 256 * 1024
+
 def date(s, fmt):
     return datetime.datetime.strptime(s, fmt)
 
@@ -41,27 +63,99 @@ def now():
     # inconsitencies when comparing to datetimes that are exact to the second only
     return datetime.datetime.utcnow().replace(microsecond=0)
 
-# TODO: Tune zlib compression parameters `level`, `wbits`, `bufsize`?
-
 def join(parts, sep):
     return string.joinfields(parts, sep)
 
+def accepts_encoding(header, coding):
+    # Whether an `Accept-Encoding` header value accepts the content-coding
+    # (without a quality of zero). Codings not listed get the quality of "*"
+    # if given; "identity" is acceptable unless excluded (RFC 7231, section
+    # 5.3.4).
+    qualities = {}
+    for part in header.split(","):
+        params = part.split(";")
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[name] = q
+    if coding in qualities:
+        return qualities[coding] > 0
+    if "*" in qualities:
+        return qualities["*"] > 0
+    return coding == "identity"
+
 
 class BaseHandler(RequestHandler):
-    """Base class for all web API handlers."""
+    """Base class for all web API handlers.
+
+    API handlers are coroutines running their queries, parsing and diffing
+    on the application's executor (see `run`), so that the IOLoop stays
+    free for other requests. Database connections are only used by the
+    executor's threads.
+    """
+
+    @gen.coroutine
+    def prepare(self):
+        header = self.request.headers.get("Authorization")
+        self.current_user = header and (yield self.run(self.__get_user, header))
 
     def get_current_user(self):
+        return None
+
+    def __get_user(self, header):
         try:
-            header = self.request.headers["Authorization"]
             method, value = header.split(" ")
             if method == "token":
                 user = User.select().join(Token).where(Token.value == value)
                 return user.get()
             else:
                 return None
-        except (KeyError, ValueError, User.DoesNotExist):
+        except (ValueError, User.DoesNotExist):
             return None
 
+    def run(self, fn, *args, **kwargs):
+        # Run `fn(*args, **kwargs)` on the executor, returns a future of its
+        # result
+        return self.application.executor.submit(fn, *args, **kwargs)
+
+    def parse(self, s, fmt=None):
+        # Parse a payload into a set of statements (or sets per key without
+        # `fmt`, see `revision_logic.parse_graphs`) on the executor. Large
+        # payloads are handed on to the application's parser processes.
+        parsers = self.application.parsers
+        if parsers != None and len(s) >= PARSE_POOL_THRESHOLD:
+            return self.run(self.__parse_pooled, parsers, s, fmt)
+        elif fmt == None:
+            return self.run(revision_logic.parse_graphs, s)
+        else:
+            return self.run(revision_logic.parse, s, fmt)
+
+    def __parse_pooled(self, parsers, s, fmt):
+        # Waiting for the result keeps the thread busy, so that the number of
+        # payloads being parsed is bounded by the threads
+        metrics.incr("parsers.payloads")
+        if fmt == None:
+            graphs = parsers.submit(revision_logic.parse_graphs_joined, s)
+            return dict((key, revision_logic.split(joined))
+                for key, joined in graphs.result().iteritems())
+        else:
+            joined = parsers.submit(revision_logic.parse_joined, s, fmt)
+            return revision_logic.split(joined.result())
+
+    def run_serialized(self, repo, keys, fn, *args, **kwargs):
+        # Like `run`, but after all writes submitted before to any of `keys`
+        # of `repo` (by this process)
+        return self.application.executor.serialize(
+            [(repo.id, key) for key in keys], fn, *args, **kwargs)
+
     def check_xsrf_cookie(self):
         pass
 
@@ -87,16 +181,22 @@ class BaseHandler(RequestHandler):
                 }
             }))
 
+class StatsHandler(BaseHandler):
+    """Reports the internal counters of this server process"""
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json_encode(metrics.snapshot()))
+
 class UserHandler(BaseHandler):
     """Processes user-regarding requests, such as the index page for a user"""
+    @gen.coroutine
     def get(self, username):
         try:
-            user = User.select().where(User.name == username).get()
+            repos = yield self.run(self.__get_repos, username)
         except User.DoesNotExist:
             raise HTTPError(reason="User not found.", status_code=404)
-        
-        repos = Repo.select().where(Repo.user == user)
-        reposit = repos.iterator()
+
+        reposit = iter(repos)
 
         # TODO: Paginate?
 
@@ -132,6 +232,11 @@ class UserHandler(BaseHandler):
 
         # TODO other return formats
 
+    def __get_repos(self, username):
+        user = User.select().where(User.name == username).get()
+        return list(Repo.select().where(Repo.user == user))
+
+@stream_request_body
 class RepoHandler(BaseHandler):
 
 # Memento/Timegate Notes:
@@ -141,6 +246,46 @@ class RepoHandler(BaseHandler):
 
 
     """Processes repository calls: Push, timegate, memento, timemap etc."""
+    @gen.coroutine
+    def prepare(self):
+        # Pushed N-Triples and N-Quads are parsed while they arrive, other
+        # payloads are buffered
+        yield super(RepoHandler, self).prepare()
+        self.parser = self.chunks = None
+        if self.request.method not in ("PUT", "POST"):
+            return
+        if not self.current_user:
+            # Before receiving the payload
+            raise HTTPError(401)
+
+        fmt = self.request.headers.get("Content-Type", "")
+        fmt = fmt.split(";")[0].strip()
+        if self.request.method == "PUT" and fmt in NTRIPLES_TYPES + ("",):
+            self.parser = revision_logic.StreamParser(NTRIPLES_TYPES[0])
+        elif self.request.method == "POST" and fmt in NQUADS_TYPES + ("",):
+            self.parser = revision_logic.StreamParser()
+        else:
+            self.chunks = []
+        if self.parser != None:
+            self.request.connection.set_max_body_size(MAX_STREAMED_BODY_SIZE)
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self.parser != None:
+            lines = self.parser.feed(chunk)
+            if lines:
+                # Not receiving more before the lines are parsed
+                yield self.run(self.parser.parse, lines)
+        elif self.chunks != None:
+            self.chunks.append(chunk)
+
+    def __parse_body(self, fmt=None):
+        # Statements of the payload (see `BaseHandler.parse`)
+        if self.parser != None:
+            return self.run(self.parser.close)
+        return self.parse(join(self.chunks, ""), fmt)
+
+    @gen.coroutine
     def get(self, username, reponame):
         timemap = self.get_query_argument("timemap", "false") == "true"
         index = self.get_query_argument("index", "false") == "true"
@@ -175,12 +320,12 @@ class RepoHandler(BaseHandler):
             ts = now()
 
         #load repo
-        repo = revision_logic.get_repo(username, reponame)
+        repo = yield self.run(revision_logic.get_repo, username, reponame)
         if repo == None:
             raise HTTPError(reason="Repo not found.", status_code=404)
 
         if key and not timemap and not delta and not delta_ts:
-            self.__get_revision(repo, key, ts)
+            yield self.__get_revision(repo, key, ts)
             # # currently no need to query next and prev through api. Link-Field in Header should contain them
             # if self.get_query_argument("next", None) == "true":
             #     self.__get_next_memento(repo,key,ts)
@@ -189,16 +334,17 @@ class RepoHandler(BaseHandler):
             # else:
             #     self.__get_revision(repo, key, ts)
         elif key and timemap:
-            self.__get_timemap(repo, key)
+            yield self.__get_timemap(repo, key)
         elif key and delta:
-            self.__get_delta_of_memento(repo, key, ts)
+            yield self.__get_delta_of_memento(repo, key, ts)
         elif key and delta_ts:
-            self.__get_delta_between_mementos(repo, key, ts, delta_ts)
+            yield self.__get_delta_between_mementos(repo, key, ts, delta_ts)
         elif index:
-            self.__get_index(repo, ts)
+            yield self.__get_index(repo, ts)
         else:
             raise HTTPError(reason="Missing arguments.", status_code=400)
 
+    @gen.coroutine
     def __get_revision(self, repo, key, ts, header_only=False):
         # Recreate the resource for the given key
         # - in its latest state (if no `datetime` was provided) or
@@ -206,9 +352,13 @@ class RepoHandler(BaseHandler):
 
         if not header_only:
             self.set_header("Content-Type", "application/n-quads")
-            self.set_header("Vary", "accept-datetime")
+            self.set_header("Vary", "accept-datetime, accept-encoding")
 
-        chain = revision_logic.get_chain_at_ts(repo, key, ts)
+        # The chain and all neighbors in one go. The blobs of the chain are
+        # only fetched when the body is produced, unless the revision is
+        # cached already.
+        memento = yield self.run(revision_logic.get_memento, repo, key, ts)
+        chain = memento.chain
         if len(chain) == 0:
             raise HTTPError(reason="Resource not found in repo.", status_code=404)
 
@@ -226,39 +376,39 @@ class RepoHandler(BaseHandler):
                         ', <%s>; rel="timemap"'
                         % (key, timegate_url, timemap_url))
 
-        cs_first = revision_logic.get_first_cset_of_repo(repo, key)
-        cs_last = revision_logic.get_last_cset_of_repo(repo, key)
-        cs_prev = revision_logic.get_cset_prev_before_ts(repo, key, ts)
-        cs_next = revision_logic.get_cset_next_after_ts(repo, key, ts)
+        cs_first = memento.first
+        cs_last = memento.last
+        cs_prev = memento.prev
+        cs_next = memento.next
 
-        cs_first_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_first.time.strftime(QSDATEFMT)
+        cs_first_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_first.strftime(QSDATEFMT)
 
-        if cs_first.time == cs_last.time:
+        if cs_first == cs_last:
             # only one CSet
-            link_header += (', <%s>; rel="first last memento"; datetime="%s"' % (cs_first_url, cs_first.time.strftime(RFC1123DATEFMT)))
+            link_header += (', <%s>; rel="first last memento"; datetime="%s"' % (cs_first_url, cs_first.strftime(RFC1123DATEFMT)))
         else:
             # more than one CSet --> first != last
-            cs_last_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_last.time.strftime(QSDATEFMT)
+            cs_last_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_last.strftime(QSDATEFMT)
 
             if cs_prev:
-                cs_prev_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_prev.time.strftime(QSDATEFMT)
-                if cs_prev.time == cs_first.time:
-                    link_header += (', <%s>; rel="prev first memento"; datetime="%s"' % (cs_prev_url, cs_prev.time.strftime(RFC1123DATEFMT)))
+                cs_prev_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_prev.strftime(QSDATEFMT)
+                if cs_prev == cs_first:
+                    link_header += (', <%s>; rel="prev first memento"; datetime="%s"' % (cs_prev_url, cs_prev.strftime(RFC1123DATEFMT)))
                 else:
-                    link_header += (', <%s>; rel="first memento"; datetime="%s"' % (cs_first_url, cs_first.time.strftime(RFC1123DATEFMT)))
-                    link_header += (', <%s>; rel="prev memento"; datetime="%s"' % (cs_prev_url, cs_prev.time.strftime(RFC1123DATEFMT)))
+                    link_header += (', <%s>; rel="first memento"; datetime="%s"' % (cs_first_url, cs_first.strftime(RFC1123DATEFMT)))
+                    link_header += (', <%s>; rel="prev memento"; datetime="%s"' % (cs_prev_url, cs_prev.strftime(RFC1123DATEFMT)))
             else: 
-                link_header += (', <%s>; rel="first memento"; datetime="%s"' % (cs_first_url, cs_first.time.strftime(RFC1123DATEFMT)))
+                link_header += (', <%s>; rel="first memento"; datetime="%s"' % (cs_first_url, cs_first.strftime(RFC1123DATEFMT)))
 
             if cs_next:
-                cs_next_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_next.time.strftime(QSDATEFMT)
-                if cs_next.time == cs_last.time:
-                    link_header += (', <%s>; rel="next last memento"; datetime="%s"' % (cs_next_url, cs_next.time.strftime(RFC1123DATEFMT)))
+                cs_next_url = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_next.strftime(QSDATEFMT)
+                if cs_next == cs_last:
+                    link_header += (', <%s>; rel="next last memento"; datetime="%s"' % (cs_next_url, cs_next.strftime(RFC1123DATEFMT)))
                 else:
-                    link_header += (', <%s>; rel="next memento"; datetime="%s"' % (cs_next_url, cs_next.time.strftime(RFC1123DATEFMT)))
-                    link_header += (', <%s>; rel="last memento"; datetime="%s"' % (cs_last_url, cs_last.time.strftime(RFC1123DATEFMT)))
+                    link_header += (', <%s>; rel="next memento"; datetime="%s"' % (cs_next_url, cs_next.strftime(RFC1123DATEFMT)))
+                    link_header += (', <%s>; rel="last memento"; datetime="%s"' % (cs_last_url, cs_last.strftime(RFC1123DATEFMT)))
             else:
-                link_header += (', <%s>; rel="last memento"; datetime="%s"' % (cs_last_url, cs_last.time.strftime(RFC1123DATEFMT)))
+                link_header += (', <%s>; rel="last memento"; datetime="%s"' % (cs_last_url, cs_last.strftime(RFC1123DATEFMT)))
 
 
         self.set_header("Memento-Datetime",
@@ -266,19 +416,91 @@ class RepoHandler(BaseHandler):
 
         self.set_header("Link", link_header)
 
-        if not header_only:
-            if chain[0].type == CSet.DELETE:
+        # Single zlib-compressed snapshots are served as stored to clients
+        # accepting `deflate`, other revisions gzip-compressed if accepted
+        # (resp. deflate-compressed, if that is the only acceptable coding).
+        # Each content-coding has its own ETag, and deflate-compressed
+        # revisions another one than those served as stored. Whether a
+        # snapshot can be served as stored depends on the settings it was
+        # written with, so it is fetched before the ETag is set.
+        accept = self.request.headers.get("Accept-Encoding", "")
+        stream = None
+        if (accepts_encoding(accept, "deflate") and
+                revision_logic.stores_deflate(repo, chain)):
+            stream = yield self.run(revision_logic.get_deflate_stream, repo,
+                                    key, chain)
+        if stream != None:
+            coding = "deflate"
+        elif accepts_encoding(accept, "gzip"):
+            coding = "gzip"
+        elif accepts_encoding(accept, "identity"):
+            coding = None
+        elif accepts_encoding(accept, "deflate"):
+            coding = "deflate"
+        else:
+            raise HTTPError(reason="No acceptable content-coding.", status_code=406)
+
+        etag = revision_logic.get_memento_etag(repo, key, memento)
+        if coding == "deflate" and stream == None:
+            etag = etag[:-1] + '-deflate-recompressed"'
+        elif coding:
+            etag = etag[:-1] + "-" + coding + '"'
+        self.set_header("ETag", etag)
+        self.set_header("Last-Modified",
+                        chain[-1].time.strftime(RFC1123DATEFMT))
+        if cs_next:
+            self.set_header("Cache-Control",
+                            "public, max-age=%d" % MEMENTO_MAX_AGE)
+        else:
+            # The latest memento changes with the next push
+            self.set_header("Cache-Control", "no-cache")
+
+        if chain[0].type == CSet.DELETE:
+            if not header_only:
                 # The last change was a delete. Return a 404 response with
                 # appropriate "Link" and "Memento-Datetime" headers.
                 raise HTTPError(reason="Resource does not exist at that time (has been deleted).", status_code=404)
+        elif self.__not_modified(chain[-1].time):
+            # HEAD requests are answered like GET requests
+            self.set_status(304)
+            return
 
-            stmts = revision_logic.get_revision(repo, key, chain)
-
-            self.write(join(stmts, "\n"))
-
+        if not header_only:
+            if coding:
+                self.set_header("Content-Encoding", coding)
+
+            # The body is written (and reconstructed, for large revisions)
+            # in chunks on the executor. Flushing waits for each chunk to be
+            # sent, so only about one chunk is held at a time. Bodies of a
+            # single chunk are not flushed, to keep their Content-Length.
+            chunks = yield self.run(revision_logic.get_revision_chunks, repo,
+                                    key, chain, coding, stream)
+            chunk = yield self.run(next, chunks, None)
+            while chunk != None:
+                self.write(chunk)
+                chunk = yield self.run(next, chunks, None)
+                if chunk != None:
+                    yield self.flush()
+
+
+    def __not_modified(self, time):
+        # Whether the client's copy of the memento (with the ETag set and
+        # last modified at `time`) is still valid. If-None-Match takes
+        # precedence over If-Modified-Since.
+        if "If-None-Match" in self.request.headers:
+            return self.check_etag_header()
+        datestr = self.request.headers.get("If-Modified-Since")
+        if datestr == None:
+            return False
+        try:
+            return time <= date(datestr, RFC1123DATEFMT)
+        except ValueError:
+            return False
 
+    @gen.coroutine
     def __get_delta_of_memento(self, repo, key, ts):
-        added, deleted = revision_logic.get_delta_of_memento(repo, key, ts)
+        added, deleted = yield self.run(revision_logic.get_delta_of_memento,
+                                        repo, key, ts)
 
         accept = self.request.headers.get("Accept", "")
         self.set_header("Vary", "accept-datetime")
@@ -305,12 +527,13 @@ class RepoHandler(BaseHandler):
             self.write(join(deleted, "\n"))
 
 
+    @gen.coroutine
     def __get_delta_between_mementos(self, repo, key, ts, delta_ts):
         try:
             if ts > delta_ts:
-                added, deleted = revision_logic.get_delta_between_mementos(repo, key, ts, delta_ts)
+                added, deleted = yield self.run(revision_logic.get_delta_between_mementos, repo, key, ts, delta_ts)
             else:
-                added, deleted = revision_logic.get_delta_between_mementos(repo, key, delta_ts, ts)
+                added, deleted = yield self.run(revision_logic.get_delta_between_mementos, repo, key, delta_ts, ts)
         except ValueError:
             raise HTTPError(reason="No delta possible for given timestamps", status_code=400)
 
@@ -321,97 +544,177 @@ class RepoHandler(BaseHandler):
             self.write("\n")
         self.write(join(deleted, "\n"))
 
+    @gen.coroutine
     def __get_timemap(self, repo, key, header_only=False):
         if not header_only:
             # Generate a timemap containing historic change information
             # for the requested key. The timemap is in the default link-format
             # or as JSON (http://mementoweb.org/guide/timemap-json/).
-
-            csets = revision_logic.get_csets(repo, key)
-            csit = csets.iterator()
-            number_of_csets = revision_logic.get_csets_count(repo, key)
-
-            # TODO: Paginate?
+            #
+            # Timemaps are paged (newest mementos first). Further pages are
+            # linked with rel="next" (older) and rel="prev" (newer) and
+            # selected by the `before` resp. `after` query argument.
             # TODO Header only request
 
+            before = after = None
             try:
-                last_cset = csit.next()
-            except StopIteration:
-                # Resource for given key does not exist.
-                raise HTTPError(reason="Resource not found in repo.", status_code=404)
+                if self.get_query_argument("before", None):
+                    before = date(self.get_query_argument("before"), QSDATEFMT)
+                if self.get_query_argument("after", None):
+                    after = date(self.get_query_argument("after"), QSDATEFMT)
+            except ValueError:
+                raise HTTPError(reason="Invalid format of before/after param", status_code=400)
+
+            accept = self.request.headers.get("Accept", "")
+            if "application/json" in accept or "*/*" in accept:
+                fmt = "application/json"
+            elif "application/link-format" in accept:
+                fmt = "application/link-format"
+            else:
+                raise HTTPError(reason="Requested timemap format not supported.", status_code=400)
 
             timemap_url = (self.request.protocol + "://" +
                            self.request.host + self.request.uri)
             timegate_url = (self.request.protocol + "://" +
                             self.request.host + self.request.path + "?key=" + key)
-            accept = self.request.headers.get("Accept", "")
-
-            if "application/json" in accept or "*/*" in accept:
-                self.set_header("Content-Type", "application/json")
+            page_url = timegate_url + "&timemap=true"
+
+            self.set_header("Content-Type", fmt)
+
+            # Pages of closed time ranges are cached (by everything they
+            # are made of)
+            page = (fmt, timemap_url, before, after)
+            cached, edits = yield self.run(
+                revision_logic.get_cached_timemap_page, repo, key, page)
+            if cached != None:
+                links, body = cached
+                if links:
+                    self.set_header("Link", links)
+                self.write(body)
+                return
 
-                self.write('{"original_uri": ' + json_encode(key))
-                self.write(', "timegate_uri": "' + timegate_url + '"')
-                self.write(', "timemap_uri": "' + timemap_url + '"')
+            times, newer, older = yield self.run(
+                revision_logic.get_timemap_page, repo, key, before, after)
+            if len(times) == 0 and not newer and not older:
+                # Resource for given key does not exist.
+                raise HTTPError(reason="Resource not found in repo.", status_code=404)
 
-                self.write(', "mementos": {"list":[')
+            prev_url = next_url = None
+            if newer and times:
+                prev_url = page_url + "&after=" + times[0].isoformat().replace("T", "-")
+            if older and times:
+                next_url = page_url + "&before=" + times[-1].isoformat().replace("T", "-")
+
+            links = []
+            if prev_url:
+                links.append('<%s>; rel="prev"; type="%s"' % (prev_url, fmt))
+            if next_url:
+                links.append('<%s>; rel="next"; type="%s"' % (next_url, fmt))
+            links = ", ".join(links)
+            if links:
+                self.set_header("Link", links)
+
+            body = []
+            if fmt == "application/json":
+                body.append('{"original_uri": ' + json_encode(key))
+                body.append(', "timegate_uri": "' + timegate_url + '"')
+                body.append(', "timemap_uri": "' + timemap_url + '"')
+                if prev_url or next_url:
+                    body.append(', "pages": ' + json_encode(
+                        {"prev": prev_url, "next": next_url}))
+
+                body.append(', "mementos": {"list":[')
 
                 m = ('{{"datetime": "{0}", "uri": "' + timegate_url +
                      '&datetime={1}"}}')
 
-                self.write(m.format(last_cset.time.isoformat(),
-                                    last_cset.time.strftime(QSDATEFMT)))
-
-                for cs in csit:
-                    self.write(', ' + m.format(cs.time.isoformat(),
-                                               cs.time.strftime(QSDATEFMT)))
-
-                self.write(']}')
-                self.write('}')
-            elif "application/link-format" in accept:
-                self.set_header("Content-Type", "application/link-format")
+                # QSDATEFMT is the ISO format with "-" as the date-time
+                # separator (timestamps have no fractional seconds)
+                body.append(", ".join(
+                    m.format(iso, iso.replace("T", "-"))
+                    for iso in (t.isoformat() for t in times)))
 
+                body.append(']}')
+                body.append('}')
+            else:
                 m = (',\n' +
                      '<' + timegate_url + '&datetime={0}>\n' +
                      '  ; rel="memento{1}"' +
                      '; datetime="{2}"' +
                      '; type="application/n-quads"')
 
-                self.write('<' + key + '>\n  ; rel="original"')
-                self.write(',\n<' + timemap_url + '>\n  ; rel="self"')
-                self.write(',\n<' + timegate_url + '>\n  ; rel="timegate"')
-                self.write(m.format(last_cset.time.strftime(QSDATEFMT)," last", 
-                                    last_cset.time.strftime(RFC1123DATEFMT)))
-
-                count = 0
-                for cs in csit:
-                    # index starts at 0, first element already skipped -> -2
-                    if count == number_of_csets - 2:
-                        self.write(m.format(cs.time.strftime(QSDATEFMT)," first",
-                                        cs.time.strftime(RFC1123DATEFMT)))
-                    else:
-                        self.write(m.format(cs.time.strftime(QSDATEFMT),"",
-                                        cs.time.strftime(RFC1123DATEFMT)))
-                    count += 1
-            else:
-                raise HTTPError(reason="Requested timemap format not supported.", status_code=400)
-
+                body.append('<' + key + '>\n  ; rel="original"')
+                body.append(',\n<' + timemap_url + '>\n  ; rel="self"')
+                body.append(',\n<' + timegate_url + '>\n  ; rel="timegate"')
+                if prev_url:
+                    body.append(',\n<' + prev_url + '>\n  ; rel="prev"' +
+                                '; type="application/link-format"')
+                if next_url:
+                    body.append(',\n<' + next_url + '>\n  ; rel="next"' +
+                                '; type="application/link-format"')
+
+                for i, t in enumerate(times):
+                    rel = ""
+                    if i == 0 and not newer:
+                        rel += " last"
+                    if i == len(times) - 1 and not older:
+                        rel += " first"
+                    body.append(m.format(t.isoformat().replace("T", "-"), rel,
+                                         t.strftime(RFC1123DATEFMT)))
+
+            body = "".join(body)
+            if newer:
+                revision_logic.cache_timemap_page(repo, key, page,
+                    (links, body), len(links) + len(body), edits)
+            self.write(body)
+
+    @gen.coroutine
     def __get_index(self, repo, ts):
         # Generate an index of all URIs contained in the dataset at the
         # provided point in time or in its current state.
+        #
+        # Pages are either numbered (`page`) or, for keyset pagination, start
+        # after a cursor (`after`) taken from the rel="next" link of the
+        # previous page.
         self.set_header("Vary", "accept-datetime")
 
         accept = self.request.headers.get("Accept", "")
 
         page = int(self.get_query_argument("page", "1"))
-        hm = revision_logic.get_repo_index(repo, ts, page)
-        
+        after = self.get_query_argument("after", None)
+        if after:
+            try:
+                after = binascii.unhexlify(after)
+            except TypeError:
+                raise HTTPError(reason="Invalid format of after param", status_code=400)
+        hm = yield self.run(lambda: list(
+            revision_logic.get_repo_index(repo, ts, page, after=after)))
+        hm = iter(hm)
+
+        # Link to the next page (if this one is full)
+        def next_url(last, count):
+            if count < revision_logic.INDEX_PAGE_SIZE:
+                return None
+            url = (self.request.protocol + "://" + self.request.host +
+                   self.request.path + "?index=true&after=" +
+                   binascii.hexlify(last.sha))
+            if self.get_query_argument("datetime", None):
+                url += "&datetime=" + self.get_query_argument("datetime")
+            self.set_header("Link", '<%s>; rel="next"' % url)
+            return url
+
         if "text/plain" in accept:
             self.set_header("Content-Type", "text/plain")
+            count = 0
+            h = None
             for h in hm:
                 self.write(h.val + "\n")
+                count += 1
+            next_url(h, count)
         elif "application/json" in accept or "*/*" in accept:
             self.set_header("Content-Type", "application/json")
-            repo_url = (self.request.protocol + "://" + self.request.host + "/" + repo.user.name + "/" + repo.name)
+            username = yield self.run(lambda: repo.user.name)
+            repo_url = (self.request.protocol + "://" + self.request.host + "/" + username + "/" + repo.name)
 
             first = None
             try:
@@ -421,16 +724,23 @@ class RepoHandler(BaseHandler):
                 # No need to raise an error, just return empty list in json
                 pass
 
-            self.write('{"username": ' + json_encode(repo.user.name))
+            self.write('{"username": ' + json_encode(username))
             self.write(', "repository": '+json_encode(repo.name))
             self.write(', "keys": {"list":[')
 
             m = ('{{"key": "{0}", "uri": "'+repo_url+'?key={0}"}}')
+            count = 0
+            h = first
             if first:
                 self.write(m.format(first.val))
+                count += 1
             for h in hm:
                 self.write("," + m.format(h.val))
+                count += 1
             self.write(']}')
+            url = next_url(h, count)
+            if url:
+                self.write(', "next": ' + json_encode(url))
             self.write('}')
 
         # TODO information of number of all pages
@@ -462,6 +772,7 @@ class RepoHandler(BaseHandler):
 
 
     @authenticated
+    @gen.coroutine
     def put(self, username, reponame):
         # Create a new revision of the resource specified by `key`.
         fmt = self.request.headers.get("Content-Type", "application/n-triples")
@@ -476,7 +787,7 @@ class RepoHandler(BaseHandler):
         if not key:
             raise HTTPError(reason="Missing argument 'key'.", status_code=400)
 
-        repo = revision_logic.get_repo(username, reponame)
+        repo = yield self.run(revision_logic.get_repo, username, reponame)
         if repo == None:
             raise HTTPError(reason="Repo not found.", status_code=404)
 
@@ -486,27 +797,86 @@ class RepoHandler(BaseHandler):
 
         # Parse and normalize into a set of N-Quad lines
         try:
-            stmts = revision_logic.parse(self.request.body, fmt)
+            stmts = yield self.__parse_body(fmt)
         except RedlandError, e:
             # TODO decide about error code. This is actual a client side error (4XX), but also not a bad request as such
             raise HTTPError(reason="Error while parsing payload: " + e.value, status_code=500)
 
+        if commit_message:
+            commit_message = commit_message.replace('\n', '. ').replace('\r', '. ')
+
         try:
-            prev_state = revision_logic.insert_revision(repo, key, stmts, ts)
+            prev_state = yield self.run_serialized(repo, [key],
+                self.__insert_revision, repo, key, stmts, ts, commit_message)
         except ValueError:
             # raise HTTPError(reason="Timestamps must be monotonically increasing.", status_code=400)
             raise HTTPError(reason="Error while saving revision.", status_code=500)
         except IntegrityError:
             raise HTTPError(500)
-        else:
-            if commit_message:
-                revision_logic.add_commit_message(repo, key, ts, commit_message.replace('\n', '. ').replace('\r', '. '))
         if prev_state == None:
             self.finish()
 
+    def __insert_revision(self, repo, key, stmts, ts, commit_message):
+        # Run serialized per key (by `put`)
+        prev_state = revision_logic.insert_revision(repo, key, stmts, ts)
+        if commit_message:
+            revision_logic.add_commit_message(repo, key, ts, commit_message)
+        return prev_state
+
+    @authenticated
+    @gen.coroutine
+    def post(self, username, reponame):
+        # Create new revisions of many resources at once, given as N-Quads
+        # with the key of each resource as the graph name of its statements.
+        # All revisions are saved at the same time in a single transaction.
+        fmt = self.request.headers.get("Content-Type", "application/n-quads")
+        commit_message = self.get_query_argument("m", None)
+
+        if username != self.current_user.name:
+            raise HTTPError(403)
+        if fmt.split(";")[0].strip() not in NQUADS_TYPES:
+            raise HTTPError(reason="Payload must be N-Quads.", status_code=415)
+
+        repo = yield self.run(revision_logic.get_repo, username, reponame)
+        if repo == None:
+            raise HTTPError(reason="Repo not found.", status_code=404)
+
+        datestr = self.get_query_argument("datetime", None)
+        ts = datestr and date(datestr, QSDATEFMT) or now()
+
+        try:
+            graphs = yield self.__parse_body()
+        except RedlandError, e:
+            raise HTTPError(reason="Error while parsing payload: " + e.value, status_code=500)
+        except ValueError, e:
+            raise HTTPError(reason=str(e), status_code=400)
+
+        if commit_message:
+            commit_message = commit_message.replace('\n', '. ').replace('\r', '. ')
+        results = yield self.run_serialized(repo, graphs.keys(),
+            revision_logic.save_revisions, repo, graphs, ts, commit_message)
+
+        # Status of each key: "saved", "unchanged" or "failed"
+        keys = {}
+        summary = {"saved": 0, "unchanged": 0, "failed": 0}
+        for key, result in results.iteritems():
+            if result == 0:
+                status = "saved"
+            elif result == None:
+                status = "unchanged"
+            else:
+                status = "failed"
+            keys[key] = status
+            summary[status] += 1
+
+        self.set_header("Content-Type", "application/json")
+        self.write(json_encode(dict(summary,
+            datetime=ts.strftime(QSDATEFMT), keys=keys)))
+
             
         # def setHeader(self, key, timemap):
 
+    @gen.coroutine
     def head(self, username, reponame):
     
         timemap = self.get_query_argument("timemap", "false") == "true"
@@ -529,15 +899,15 @@ class RepoHandler(BaseHandler):
             ts = now()
 
         #load repo
-        repo = revision_logic.get_repo(username, reponame)
+        repo = yield self.run(revision_logic.get_repo, username, reponame)
         if repo == None:
             raise HTTPError(reason="Repo not found.", status_code=404)
 
 
         if key and not timemap:
-            self.__get_revision(repo, key, ts, True)
+            yield self.__get_revision(repo, key, ts, True)
         elif key and timemap:
-            self.__get_timemap(repo, key, True)
+            yield self.__get_timemap(repo, key, True)
         else:
             raise HTTPError(reason="Malformed HEAD request.", status_code=400)
 
@@ -601,13 +971,14 @@ class RepoHandler(BaseHandler):
 
 
     @authenticated
+    @gen.coroutine
     def delete(self, username, reponame):
         # Check whether the key exists and if maybe the last change already is
         # a delete, else insert a `CSet.DELETE` entry without any blob data.
 
         key = self.get_query_argument("key")
         update = self.get_query_argument("update", "false") == "true"
-        repo = revision_logic.get_repo(username, reponame)
+        repo = yield self.run(revision_logic.get_repo, username, reponame)
         commit_message = self.get_query_argument("m", None)
 
         if username != self.current_user.name:
@@ -622,17 +993,31 @@ class RepoHandler(BaseHandler):
 
         if update:
             # When update-param is set and the ts is the exact one of an existing cset (ts does not need to be increasing)
-            if revision_logic.get_cset_at_ts(repo, key, ts):
-                revision_logic.remove_revision(repo, key, ts)
+            removed = yield self.run_serialized(repo, [key],
+                self.__remove_revision, repo, key, ts)
+            if removed:
                 self.finish()
                 return
             else:
                 raise HTTPError(reason="No memento exists for given timestamp. When 'update' is set this must apply", status_code=400)
         else:
+            if commit_message:
+                commit_message = commit_message.replace('\n', '. ').replace('\r', '. ')
             try:
-                revision_logic.save_revision_delete(repo, key, ts)
+                yield self.run_serialized(repo, [key],
+                    self.__save_revision_delete, repo, key, ts, commit_message)
             except LookupError:
                 raise HTTPError(reason="Resource does not exist at given time.", status_code=404)
-            else:
-                if commit_message:
-                    revision_logic.add_commit_message(repo, key, ts, commit_message.replace('\n', '. ').replace('\r', '. '))
+
+    def __remove_revision(self, repo, key, ts):
+        # Run serialized per key (by `delete`)
+        if revision_logic.get_cset_at_ts(repo, key, ts):
+            revision_logic.remove_revision(repo, key, ts)
+            return True
+        return False
+
+    def __save_revision_delete(self, repo, key, ts, commit_message):
+        # Run serialized per key (by `delete`)
+        revision_logic.save_revision_delete(repo, key, ts)
+        if commit_message:
+            revision_logic.add_commit_message(repo, key, ts, commit_message)
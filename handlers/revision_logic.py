@@ -1,8 +1,20 @@
+import array
+import collections
+import contextlib
 import hashlib
-import zlib
+import itertools
+import re
+import sys
 import string
+import zlib
 
-from models import User, Token, Repo, HMap, CSet, Blob, CommitMessage
+from models import User, Token, Repo, HMap, Term, CSet, Head, Version, Span, Counter, CommitMessage, ZDict
+from models import dbproxy as database
+from models import bsproxy as blobstore
+from compression import PresetDictionary, MAX_DICT_SIZE, ZLIB, train
+import compression
+import metrics
+from cache import LRUCache
 from peewee import IntegrityError, SQL, fn
 import RDF
 import datetime
@@ -23,14 +35,125 @@ logger = logging.getLogger('debug')
 # TODO: Empirically determine a good value with real data/statistics.
 SNAPF = 10.0
 
+# Whether a snapshot or a delta compresses smaller is estimated from the ratio
+# of their uncompressed sizes (delta / snapshot): below ESTIMATE_DELTA only the
+# delta and above ESTIMATE_SNAPSHOT only the snapshot is compressed. In between
+# both are compressed and compared.
+ESTIMATE_DELTA = 0.8
+ESTIMATE_SNAPSHOT = 1.25
+
+# Repositories using the skip-delta layout (`Repo.SKIP`) do not store each
+# delta against the directly preceding revision. Instead, the revision at
+# position `n` after the base snapshot is stored as a delta against the
+# revision at position `n & (n - 1)` (`n` with its lowest set bit cleared).
+# Reconstructing any revision then takes at most log2(n) + 1 blobs, while
+# deltas get somewhat larger as they span more changes.
+#
+# Repositories using the reverse-delta layout (`Repo.REVERSE`) always keep
+# the latest revision as a snapshot. Older revisions are stored as deltas
+# against the following revision, so their delta-chains run forward in time:
+# the next snapshot followed by the deltas back to the requested revision.
+# Reading the latest revision takes a single blob.
+
+# Repositories using the term encoding (`Repo.TERMS`) do not store statements
+# as text in their blobs. Every term (IRI, blank node or literal) is assigned
+# an id in the repository's term dictionary, and blobs hold the statements as
+# packed tuples of term ids. Revisions are reconstructed and compared on these
+# tuples; text is only rebuilt when statements leave this module.
+
 # Pagination size for indexes (number of resource URIs per page)
 INDEX_PAGE_SIZE = 1000
 
-def compress(s):
-    return zlib.compress(s)
+# Pagination size for timemaps (number of mementos per page)
+TIMEMAP_PAGE_SIZE = 1000
+
+# Default max. size of the revision cache in bytes (see `config.cacheconf`)
+REVISION_CACHE_SIZE = 64 * 1024 * 1024
+
+# Size of the chunks of served revisions in bytes (uncompressed)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Revisions whose delta-chain has at least this many (compressed) bytes are
+# served while they are reconstructed, without building (and caching) them
+STREAM_THRESHOLD = 1024 * 1024
+
+# Compression level of revisions served gzip- (or deflate-) encoded
+GZIP_LEVEL = 6
+
+# Default max. size of the timemap page cache in bytes
+TIMEMAP_CACHE_SIZE = 16 * 1024 * 1024
+
+# Seconds to wait for the lock of a resource written by another process
+LOCK_TIMEOUT = 30
+
+# Number of terms looked up or inserted per query
+TERM_BATCH_SIZE = 500
+
+# Number of statements of a served revision decoded at a time (the unknown
+# terms of which are looked up in a single query)
+DECODE_BATCH_SIZE = 8192
+
+# Number of rows written per multi-row insert (resp. looked up per query)
+# when saving revisions of many resources at once
+INSERT_BATCH_SIZE = 500
+
+# Max. number of cached term ids and values (per process)
+TERM_CACHE_SIZE = 200000
+
+# Bytes of N-Triples/N-Quads parsed at a time while a payload arrives
+PARSE_BATCH_SIZE = 256 * 1024
+
+# Number of snapshots sampled for training a compression dictionary
+DICT_SAMPLES = 1000
+
+# Tokens of N-Triples/N-Quads text (terms with their trailing separator)
+STMT_TOKEN_RE = re.compile(r"\S+\s?")
+
+# Terms of a statement in N-Triples/N-Quads syntax
+TERM_RE = re.compile(
+    r'<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?')
+
+# Lines of N-Triples/N-Quads with terms exactly as written by Redland, which
+# are parsed without it (see `parse_canonical`). To be on the safe side,
+# this only covers absolute IRIs and literals of printable ASCII characters
+# (or escaped tabs, line breaks, quotes and backslashes), lowercase language
+# tags and datatypes other than xsd:string. Blank nodes are left to Redland.
+CANONICAL_IRI = r'[A-Za-z][A-Za-z0-9+.-]*:[^\x00-\x20<>"{}|^`\\\x7f-\xff]*'
+CANONICAL_STMT_RE = re.compile(
+    r'[ \t]*(<{0}>)[ \t]+(<{0}>)[ \t]+'
+    r'(<{0}>|"[^\x00-\x1f"\\\x7f-\xff]*(?:\\[tnr"\\][^\x00-\x1f"\\\x7f-\xff]*)*"'
+    r'(?:@[a-z]+(?:-[a-z0-9]+)*'
+    r'|\^\^<(?!http://www\.w3\.org/2001/XMLSchema#string>){0}>)?)'
+    r'(?:[ \t]+<({0})>)?[ \t]*\.[ \t]*\r?$'.format(CANONICAL_IRI))
+
+def compress(s, codec=ZLIB, level=None):
+    return compression.compress(s, codec, level)
 
 def decompress(s):
-    return zlib.decompress(s)
+    return compression.decompress(s)
+
+__dicts = {}  # (repo id, version, level) -> PresetDictionary
+
+def __get_dictionary(repo, version, level=None):
+    # Dictionaries never change once created, so they can be cached for good
+    d = __dicts.get((repo.id, version, level))
+    if d == None:
+        data = (ZDict
+            .select(ZDict.data)
+            .where((ZDict.repo == repo) & (ZDict.version == version))
+            .scalar())
+        d = __dicts[(repo.id, version, level)] = PresetDictionary(str(data), level)
+    return d
+
+def __compress(repo, s):
+    # Compress with the codec of the repo (and its current dictionary, if any)
+    dictionary = None
+    if repo.codec == ZLIB and repo.zdict:
+        dictionary = repo.zdict, __get_dictionary(repo, repo.zdict, repo.level)
+    return compression.compress(s, repo.codec, repo.level, dictionary)
+
+def __decompress(repo, blob):
+    return compression.decompress(blob, lambda v: __get_dictionary(repo, v))
 
 def __shasum(s):
     return hashlib.sha1(s).digest()
@@ -40,21 +163,303 @@ def __get_shasum(key):
     return sha
 
 '''parse serialized RDF'''
-def parse(s, fmt):
+def parse(s, fmt, canonical=True):
     # Parse serialized RDF:
     #
     # RDF/XML:      application/rdf+xml
     # N-Triples:    application/n-triples
     # Turtle:       text/turtle
+    #
+    # N-Triples in canonical form are parsed without Redland (unless not
+    # `canonical`), which is a lot faster
+    if canonical and fmt.split(";")[0].strip() == "application/n-triples":
+        stmts = parse_canonical(s)
+        if stmts != None:
+            return stmts
     stmts = set()
     parser = RDF.Parser(mime_type=fmt)
     for st in parser.parse_string_as_stream(s, "urn:x-default:tailr"):
         stmts.add(str(st) + " .")
     return stmts
 
+def parse_graphs(s, canonical=True):
+    # Parse N-Quads into sets of statements (N-Triples) per graph name, which
+    # is the key of the resource described by the statements
+    if canonical:
+        graphs = parse_canonical(s, True)
+        if graphs != None:
+            return graphs
+    graphs = collections.defaultdict(set)
+    parser = RDF.Parser(name="nquads")
+    stream = parser.parse_string_as_stream(s, "urn:x-default:tailr")
+    for st in stream:
+        context = stream.context()
+        if context == None or not context.is_resource():
+            raise ValueError("Statement without graph name: %s ." % st)
+        graphs[unicode(str(context.uri), "utf-8")].add(str(st) + " .")
+    return graphs
+
+def parse_canonical(s, graphs=False):
+    # Parse N-Triples (or N-Quads with `graphs`, see `parse_graphs`) in
+    # canonical form without Redland. Returns None if any statement is not
+    # canonical (or invalid), to leave the payload to Redland.
+    if graphs:
+        stmts = collections.defaultdict(set)
+    else:
+        stmts = set()
+    match = CANONICAL_STMT_RE.match
+    for line in s.split("\n"):
+        m = match(line)
+        if m == None:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            return None
+        subject, predicate, object, graph = m.groups()
+        stmt = subject + " " + predicate + " " + object + " ."
+        if graphs and graph != None:
+            stmts[unicode(graph, "utf-8")].add(stmt)
+        elif not graphs and graph == None:
+            stmts.add(stmt)
+        else:
+            return None
+    return stmts
+
+def parse_joined(s, fmt):
+    # `parse` run by a process pool: the statements joined into one string
+    # are much cheaper to pickle than a set of strings (see `split`)
+    try:
+        return join(parse(s, fmt), "\n")
+    except RDF.RedlandError, e:
+        raise __picklable(e)
+
+def parse_graphs_joined(s):
+    # `parse_graphs` run by a process pool (see `parse_joined`)
+    try:
+        graphs = parse_graphs(s)
+    except RDF.RedlandError, e:
+        raise __picklable(e)
+    return dict((key, join(stmts, "\n")) for key, stmts in graphs.iteritems())
+
+def __picklable(e):
+    # Redland errors don't pass their value on to `Exception`, so they can't
+    # be unpickled (by the process pool) without it in `args`
+    e.args = (e.value,)
+    return e
+
+def split(joined):
+    # Set of the statements joined by `parse_joined`
+    return joined and set(joined.split("\n")) or set()
+
+class StreamParser(object):
+    """Parses N-Triples (or N-Quads without `fmt`, see `parse_graphs`) from
+    the chunks of a payload while they arrive, a batch of complete lines at
+    a time. Only the statements and a batch of the payload are kept in
+    memory, along with the batches containing blank nodes: Redland names
+    blank nodes anew on every parse, so these are parsed at once by `close`
+    to keep a label used in several batches the same node. Errors are raised
+    by `close`.
+
+    `feed` is cheap, `parse` and `close` do the actual parsing.
+    """
+
+    def __init__(self, fmt=None):
+        self.fmt = fmt
+        self.pending = []
+        self.size = 0
+        self.blank = []
+        self.error = None
+        if fmt == None:
+            self.stmts = collections.defaultdict(set)
+        else:
+            self.stmts = set()
+
+    def feed(self, chunk):
+        # Complete lines to `parse` (once a batch has arrived) or None
+        self.pending.append(chunk)
+        self.size += len(chunk)
+        if self.size < PARSE_BATCH_SIZE:
+            return None
+        data = join(self.pending, "")
+        end = data.rfind("\n") + 1
+        self.pending = [data[end:]]
+        self.size = len(data) - end
+        return end and data[:end] or None
+
+    def parse(self, lines):
+        if self.error != None:
+            return
+        if "_:" in lines:
+            self.blank.append(lines)
+            return
+        self.__parse(lines)
+
+    def __parse(self, lines):
+        try:
+            if self.fmt == None:
+                for key, stmts in parse_graphs(lines).iteritems():
+                    self.stmts[key] |= stmts
+            else:
+                self.stmts |= parse(lines, self.fmt)
+        except (RDF.RedlandError, ValueError):
+            self.error = sys.exc_info()
+
+    def close(self):
+        # All statements of the payload
+        self.parse(join(self.pending, ""))
+        self.pending = []
+        if self.blank and self.error == None:
+            self.__parse(join(self.blank, ""))
+        self.blank = []
+        if self.error != None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.stmts
+
 def join(parts, sep):
     return string.joinfields(parts, sep)
 
+#### Term dictionary ####
+
+__term_ids = {}   # (repo id, term) -> term id
+__term_vals = {}  # term id -> term
+
+def __cache_term(repo, term, id):
+    if len(__term_vals) >= TERM_CACHE_SIZE:
+        __term_ids.clear()
+        __term_vals.clear()
+    __term_ids[(repo.id, term)] = id
+    __term_vals[id] = term
+
+def __split_stmt(stmt):
+    terms = TERM_RE.findall(stmt)
+    if len(terms) not in (3, 4) or join(terms, " ") + " ." != stmt:
+        # Keep statements not in canonical form as a single term
+        return (stmt,)
+    return tuple(terms)
+
+def __join_stmt(terms):
+    if len(terms) == 1:
+        return terms[0]
+    return join(terms, " ") + " ."
+
+def __get_term_ids(repo, terms):
+    # Map terms to ids, adding unknown terms to the repo's dictionary
+    ids = {}
+    missing = {}
+    for term in terms:
+        id = __term_ids.get((repo.id, term))
+        if id == None:
+            missing[__shasum(term)] = term
+        else:
+            ids[term] = id
+
+    shas = missing.keys()
+    for i in range(0, len(shas), TERM_BATCH_SIZE):
+        batch = shas[i:i + TERM_BATCH_SIZE]
+        found = dict(__select_term_ids(repo, batch))
+        rows = [{"repo": repo, "sha": sha, "val": missing[sha]}
+            for sha in batch if sha not in found]
+        if rows:
+            try:
+                Term.insert_many(rows).execute()
+            except IntegrityError:
+                # Terms were added concurrently, insert the remaining ones
+                for row in rows:
+                    try:
+                        Term.insert(**row).execute()
+                    except IntegrityError:
+                        pass
+            found = dict(__select_term_ids(repo, batch))
+        for sha in batch:
+            ids[missing[sha]] = found[sha]
+            __cache_term(repo, missing[sha], found[sha])
+    return ids
+
+def __select_term_ids(repo, shas):
+    return (Term
+        .select(Term.sha, Term.id)
+        .where((Term.repo == repo) & (Term.sha << shas))
+        .tuples())
+
+def __get_terms(repo, ids, batch_size=TERM_BATCH_SIZE):
+    # Map term ids to terms, looking up `batch_size` unknown ones per query
+    vals = {}
+    missing = []
+    for id in ids:
+        term = __term_vals.get(id)
+        if term == None:
+            missing.append(id)
+        else:
+            vals[id] = term
+
+    for i in range(0, len(missing), batch_size):
+        rows = (Term
+            .select(Term.id, Term.val)
+            .where(
+                (Term.repo == repo) &
+                (Term.id << missing[i:i + batch_size]))
+            .tuples())
+        for id, term in rows:
+            term = str(term)
+            vals[id] = term
+            __cache_term(repo, term, id)
+    return vals
+
+def __encode_stmts(repo, stmts):
+    # Statements to tuples of term ids (for repos using the term encoding)
+    return __encode_revisions(repo, [stmts])[0]
+
+def __encode_revisions(repo, revisions):
+    # Encode the statements of many revisions, looking up their terms together
+    if repo.encoding != Repo.TERMS:
+        return revisions
+    splits = map(lambda stmts: map(__split_stmt, stmts), revisions)
+    ids = __get_term_ids(repo,
+        set(t for split in splits for terms in split for t in terms))
+    return map(lambda split: set(map(lambda terms: tuple(map(ids.get, terms)),
+        split)), splits)
+
+def __decode_stmts(repo, stmts):
+    # Tuples of term ids to statements (for repos using the term encoding)
+    if repo.encoding != Repo.TERMS:
+        return stmts
+    vals = __get_terms(repo, set(id for ids in stmts for id in ids))
+    return map(lambda ids: __join_stmt(map(vals.get, ids)), stmts)
+
+def __pack(records):
+    # Records of (deleted, term ids) to little-endian unsigned 32 bit
+    # integers: a header (number of ids, shifted left, and the deleted flag)
+    # followed by the ids.
+    a = array.array("I")
+    for deleted, ids in records:
+        a.append(len(ids) << 1 | deleted)
+        a.extend(ids)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tostring()
+
+def __unpack(s):
+    return __unpack_chunks((s,))
+
+def __unpack_chunks(chunks):
+    # Like `__unpack`, for packed records split into chunks anywhere
+    rest = ""
+    for chunk in chunks:
+        s = rest + chunk
+        a = array.array("I")
+        a.fromstring(s[:len(s) - len(s) % 4])
+        if sys.byteorder == "big":
+            a.byteswap()
+        i = 0
+        while i < len(a):
+            header = a[i]
+            end = i + 1 + (header >> 1)
+            if end > len(a):
+                break
+            yield header & 1, tuple(a[i + 1:end])
+            i = end
+        rest = s[4 * i:]
+
 
 def __create_hmap_entry(sha, key):
     try:
@@ -79,60 +484,184 @@ def get_repo(username, reponame):
         repo = None
     return repo
 
-def get_chain_at_ts(repo, key, ts):
+# Fields of the csets of a delta-chain
+CHAIN_FIELDS = (CSet.time, CSet.type, CSet.len)
+
+def get_chain_at_ts(repo, key, ts, data=False):
     sha = __get_shasum(key)
-    return __get_chain_at_ts(repo, sha, ts)
+    return __get_chain_at_ts(repo, sha, ts, data)
+
+def __get_chain_at_ts(repo, sha, ts, data=False):
+    query = __chain_at_ts_query(repo, sha, ts)
+    return __fetch_chain(repo, sha, query, data)
 
-def __get_chain_at_ts(repo, sha, ts):
-    # Fetch all relevant changes from the last "non-delta" onwards,
-    # ordered by time. The returned delta-chain consists of either:
+def __chain_at_ts_query(repo, sha, ts):
+    # Fetch all relevant changes sharing the base of the last change at or
+    # before `ts` (a range of the (repo, hkey, base, time) index). The
+    # returned delta-chain consists of either:
     # a snapshot followed by 0 or more deltas, or
     # a single delete.
-    chain = list(CSet
-        .select(CSet.time, CSet.type, CSet.len)
-        .where(
-            (CSet.repo == repo) &
-            (CSet.hkey == sha) &
-            (CSet.time <= ts) &
-            (CSet.time >= SQL(
-                "COALESCE((SELECT time FROM cset "
-                "WHERE repo_id = %s "
-                "AND hkey_id = %s "
-                "AND time <= %s "
-                "AND type != %s "
-                "ORDER BY time DESC "
-                "LIMIT 1), 0)",
-                repo.id, sha, ts, CSet.DELTA
-            )))
-        .order_by(CSet.time)
-        .naive())
-    
-    return chain
+    base = SQL(
+        "(SELECT base FROM cset "
+        "WHERE repo_id = %s "
+        "AND hkey_id = %s "
+        "AND time <= %s "
+        "ORDER BY time DESC "
+        "LIMIT 1)",
+        repo.id, sha, ts)
+
+    if repo.layout == Repo.REVERSE:
+        # The chain runs from the base (the next snapshot) back to the last
+        # change at or before `ts`, in reverse order of time.
+        query = (CSet
+            .select(*CHAIN_FIELDS)
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey == sha) &
+                (CSet.base == base) &
+                (CSet.time >= SQL(
+                    "(SELECT MAX(time) FROM cset "
+                    "WHERE repo_id = %s "
+                    "AND hkey_id = %s "
+                    "AND time <= %s)",
+                    repo.id, sha, ts)))
+            .order_by(CSet.time.desc()))
+    else:
+        # Ordered by time, from the base up to `ts`
+        query = (CSet
+            .select(*CHAIN_FIELDS)
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey == sha) &
+                (CSet.base == base) &
+                (CSet.time <= ts))
+            .order_by(CSet.time))
 
-def get_chain_tail(repo, key):
+    return query
+
+def get_chain_tail(repo, key, data=False):
     sha = __get_shasum(key)
-    return __get_chain_tail(repo, sha)
+    return __get_chain_tail(repo, sha, data)
+
+def __get_chain_tail(repo, sha, data=False):
+    if repo.layout == Repo.REVERSE:
+        # The latest cset is never a delta
+        query = (CSet
+            .select(*CHAIN_FIELDS)
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey == sha))
+            .order_by(CSet.time.desc())
+            .limit(1))
+        return __fetch_chain(repo, sha, query, data)
 
-def __get_chain_tail(repo, sha):
-    chain = list(CSet
-            .select(CSet.time, CSet.type, CSet.len)
+    query = (CSet
+            .select(*CHAIN_FIELDS)
             .where(
                 (CSet.repo == repo) &
                 (CSet.hkey == sha) &
-                (CSet.time >= SQL(
-                    "COALESCE((SELECT time FROM cset "
+                (CSet.base == SQL(
+                    "(SELECT base FROM cset "
                     "WHERE repo_id = %s "
                     "AND hkey_id = %s "
-                    "AND type != %s "
                     "ORDER BY time DESC "
-                    "LIMIT 1), 0)",
-                    repo.id, sha, CSet.DELTA
+                    "LIMIT 1)",
+                    repo.id, sha
                 )))
-            .order_by(CSet.time)
-            .naive())
-
+            .order_by(CSet.time))
+
+    return __fetch_chain(repo, sha, query, data)
+
+def __fetch_chain(repo, sha, query, data=False, fields=CHAIN_FIELDS):
+    # Run a delta-chain query. With `data`, the blobs of the chain are
+    # fetched along with it (in the same round trip, see `blobstore.join`).
+    # With the skip-delta layout only the blobs on the path to the last cset
+    # are needed, which are fetched once the path is known. The edit counter
+    # of the resource is selected along with each cset (see `__fingerprint`).
+    fields = fields + (SQL("(SELECT edits FROM " + Version._meta.db_table +
+        " WHERE repo_id = %s AND hkey_id = %s)", repo.id, sha).alias("edits"),)
+    if not data:
+        return __get_chain_path(repo, list(query.select(*fields).naive()))
+    if repo.layout != Repo.SKIP:
+        return __get_chain_path(repo,
+            blobstore.join(repo, sha, query, fields))
+
+    chain = __get_chain_path(repo, list(query.select(*fields).naive()))
+    if len(chain) > 0 and chain[0].type != CSet.DELETE:
+        for e, blob in zip(chain, __get_blobs(repo, sha, chain)):
+            e.data = blob
     return chain
 
+def __get_chain_path(repo, chain):
+    # Number the csets of a delta-chain by their position after the base.
+    # For the skip-delta layout, reduce the chain to the csets on the path
+    # from the base to the last cset; only those are needed to reconstruct it.
+    for i, e in enumerate(chain):
+        e.seq = i
+
+    if repo.layout != Repo.SKIP or len(chain) == 0:
+        return chain
+
+    path = []
+    n = len(chain) - 1
+    while n > 0:
+        path.append(chain[n])
+        n &= n - 1
+    path.append(chain[0])
+    path.reverse()
+    return path
+
+# Memento of a resource at some time along with its delta-chain, the times of
+# the first, last, previous and next memento (None if there is none) and its
+# commit message
+Memento = collections.namedtuple("Memento",
+    "chain first last prev next message edits")
+
+def get_memento(repo, key, ts):
+    sha = __get_shasum(key)
+    return __get_memento(repo, sha, ts)
+
+def __get_memento(repo, sha, ts):
+    # The neighbors and the commit message are selected as (uncorrelated)
+    # subqueries along with the delta-chain, all in a single query.
+    key = "WHERE repo_id = %s AND hkey_id = %s "
+    memento_time = "(SELECT MAX(time) FROM cset " + key + "AND time <= %s)"
+    fields = CHAIN_FIELDS + (
+        SQL("(SELECT MIN(time) FROM cset " + key + ")",
+            repo.id, sha).alias("first"),
+        SQL("(SELECT MAX(time) FROM cset " + key + ")",
+            repo.id, sha).alias("last"),
+        SQL("(SELECT MAX(time) FROM cset " + key +
+            "AND time < " + memento_time + ")",
+            repo.id, sha, repo.id, sha, ts).alias("prev"),
+        SQL("(SELECT MIN(time) FROM cset " + key + "AND time > %s)",
+            repo.id, sha, ts).alias("next"),
+        SQL("(SELECT message FROM " + CommitMessage._meta.db_table + " " +
+            key + "AND time = " + memento_time + ")",
+            repo.id, sha, repo.id, sha, ts).alias("message"),
+    )
+
+    chain = __fetch_chain(repo, sha, __chain_at_ts_query(repo, sha, ts),
+        False, fields)
+    if len(chain) == 0:
+        # No memento at `ts` (but maybe later ones)
+        cset_next = __get_cset_next_after_ts(repo, sha, ts)
+        return Memento(chain, None, None, None,
+            cset_next and cset_next.time, None, None)
+
+    e = chain[-1]
+    t = CSet.time.python_value
+    return Memento(chain, t(e.first), t(e.last), t(e.prev), t(e.next),
+        e.message, e.edits or 0)
+
+def get_memento_etag(repo, key, memento):
+    # Strong validator of a memento: it only changes with the memento time
+    # (for the latest state, with every appended revision) and with edits of
+    # the history of the resource
+    return '"%s"' % hashlib.sha1("%d %s %s %d" % (repo.id,
+        __get_shasum(key).encode("hex"), memento.chain[-1].time.isoformat(),
+        memento.edits)).hexdigest()
+
 def get_chain_last_cset(repo, key):
     sha = __get_shasum(key)
     return __get_chain_last_cset(repo, sha)
@@ -152,30 +681,36 @@ def __get_chain_last_cset(repo, sha):
         return None
     return last
 
-def __get_blob_list(repo, sha, chain):
-    return list(__get_blobs(repo, sha, chain))
-
 def __get_blobs(repo, sha, chain):
-    #logger.info(":: get_blobs")
+    # Blob data for each cset of the chain, in chain order (unless fetched
+    # along with the chain already)
+    if len(chain) > 0 and hasattr(chain[0], "data"):
+        return map(lambda e: e.data, chain)
+    return blobstore.get_many(repo, sha, map(lambda e: e.time, chain))
 
-    blobs = (Blob
-        .select(Blob.data)
-        .where(
-            (Blob.repo == repo) &
-            (Blob.hkey == sha) &
-            (Blob.time << map(lambda e: e.time, chain)))
-        .order_by(Blob.time)
-        .naive())
-    return blobs
+# Reconstructed revisions (statement sets, not to be modified by callers,
+# and their gzip-compressed N-Quads once requested) by (repo id, hkey, cset
+# time). Changes to a cset invalidate its entry.
+revisions = LRUCache("revisions", REVISION_CACHE_SIZE)
 
 '''get revision as set of statements'''
 def get_revision(repo, key, chain):
     #logger.info(":: get_revision")
 
     sha = __get_shasum(key)
-    return __get_revision(repo, sha, chain)
+    return set(__decode_stmts(repo, __get_revision(repo, sha, chain)))
 
 def __get_revision(repo, sha, chain):
+    if len(chain) == 0 or chain[0].type == CSet.DELETE:
+        # Deleted resources have no statements (and no blobs)
+        return set()
+
+    key = (repo.id, sha, chain[-1].time)
+    fingerprint = __fingerprint(chain)
+    cached = revisions.get(key)
+    if cached != None and cached[0] == fingerprint:
+        return cached[1]
+
     blobs = __get_blobs(repo, sha, chain)
     #if len(chain) == 1:
          # Special case, where we can simply return
@@ -183,21 +718,232 @@ def __get_revision(repo, sha, chain):
     #     snap = blobs.first().data
     #     return decompress(snap)
 
-    stmts = set()
+    stmts = frozenset(__build_revision(repo, blobs))
+    revisions.put(key, (fingerprint, stmts, None), __mem_size(repo, stmts))
+    return stmts
 
-    for i, blob in enumerate(blobs.iterator()):
-        data = decompress(blob.data)
+def __fingerprint(chain):
+    # Reconstructed revisions are cached along with their delta-chain, which
+    # must still be the same, and the edit counter of the resource. Other
+    # processes invalidate the entries of their own caches only, but the
+    # revisions they change are edited (or their chains change).
+    return (getattr(chain[-1], "edits", None) or 0,
+        map(lambda e: (e.time, e.type, e.len), chain))
+
+def stores_deflate(repo, chain):
+    # Whether the revision of `chain` is stored as a single zlib-compressed
+    # snapshot of its N-Quads, which can be served as is with the `deflate`
+    # content-coding (see `get_deflate_stream`)
+    return (len(chain) == 1 and chain[0].type == CSet.SNAPSHOT and
+        repo.encoding != Repo.TERMS and repo.codec == ZLIB and not repo.zdict)
+
+def get_deflate_stream(repo, key, chain):
+    # The stored zlib stream of the revision of `chain` (if `stores_deflate`),
+    # None if the revision has to be compressed anew, e.g. if its snapshot
+    # was written with other compression settings of the repo
+    if not stores_deflate(repo, chain):
+        return None
+    sha = __get_shasum(key)
+    return compression.zlib_stream(__get_blobs(repo, sha, chain)[0])
+
+def get_revision_chunks(repo, key, chain, coding=None, stream=None):
+    # The N-Quads of a revision (joined by line breaks) in chunks of about
+    # `STREAM_CHUNK_SIZE` bytes, compressed with the `deflate` or `gzip`
+    # content-coding if given. The `deflate` one passes the `stream` of
+    # `get_deflate_stream` through if given. The chunks of large revisions
+    # are produced while they are consumed (see `__stream_revision`).
+    if stream != None:
+        metrics.incr("revisions.passthrough")
+        return __slices(stream)
+    sha = __get_shasum(key)
+    if coding == "deflate":
+        return __compress_chunks(__body_chunks(repo,
+            __iter_revision(repo, sha, chain)), zlib.MAX_WBITS)
+    elif coding == "gzip":
+        return __gzip_chunks(repo, sha, chain)
+    return __body_chunks(repo, __iter_revision(repo, sha, chain))
+
+def __gzip_chunks(repo, sha, chain):
+    # Revisions which are cached are cached along with their gzip format
+    if __is_large(chain):
+        return __compress_chunks(__body_chunks(repo,
+            __iter_revision(repo, sha, chain)), 16 + zlib.MAX_WBITS)
+
+    key = (repo.id, sha, chain[-1].time)
+    fingerprint = __fingerprint(chain)
+    cached = revisions.get(key)
+    if cached != None and cached[0] == fingerprint and cached[2] != None:
+        return __slices(cached[2])
+
+    stmts = __get_revision(repo, sha, chain)
+    body = "".join(__compress_chunks(__body_chunks(repo, stmts),
+        16 + zlib.MAX_WBITS))
+    if chain[0].type != CSet.DELETE:
+        revisions.put(key, (fingerprint, stmts, body),
+            __mem_size(repo, stmts) + len(body))
+    return __slices(body)
+
+def __is_large(chain):
+    return reduce(lambda s, e: s + e.len, chain, 0) >= STREAM_THRESHOLD
+
+def __iter_revision(repo, sha, chain):
+    # The (encoded) statements of a revision, unordered
+    if __is_large(chain) and chain[0].type != CSet.DELETE:
+        return __stream_revision(repo, __get_blobs(repo, sha, chain))
+    return __get_revision(repo, sha, chain)
 
-        if i == 0:
-            # Base snapshot for the delta chain
-            stmts.update(data.splitlines())
-        else:
-            for line in data.splitlines():
-                mode, stmt = line[0], line[2:]
-                if mode == "A":
-                    stmts.add(stmt)
-                else:
-                    stmts.discard(stmt)
+def __stream_revision(repo, blobs):
+    # Like `__build_revision`, but only the changes of the deltas are held
+    # in memory: the statements of the snapshot are passed on as they are
+    # decompressed (unless changed by a delta), followed by those added
+    changes = {}
+    for blob in blobs[1:]:
+        for deleted, stmt in __read_delta(repo, blob):
+            changes[stmt] = deleted
+    for stmt in __iter_snapshot(repo, blobs[0]):
+        if stmt not in changes:
+            yield stmt
+    for stmt, deleted in changes.iteritems():
+        if not deleted:
+            yield stmt
+
+def __body_chunks(repo, stmts):
+    # Statements joined by line breaks, in chunks of about
+    # `STREAM_CHUNK_SIZE` bytes
+    if repo.encoding == Repo.TERMS:
+        stmts = __decode_batches(repo, stmts)
+    lines = []
+    size = 0
+    sep = ""
+    for stmt in stmts:
+        lines.append(stmt)
+        size += len(stmt) + 1
+        if size >= STREAM_CHUNK_SIZE:
+            yield sep + join(lines, "\n")
+            lines = []
+            size = 0
+            sep = "\n"
+    if lines:
+        yield sep + join(lines, "\n")
+
+def __decode_batches(repo, stmts):
+    # `__decode_stmts` while the statements are streamed, with one query for
+    # the terms of each batch of DECODE_BATCH_SIZE statements (which are not
+    # cached already)
+    stmts = iter(stmts)
+    while True:
+        batch = list(itertools.islice(stmts, DECODE_BATCH_SIZE))
+        if not batch:
+            return
+        ids = set(id for ids in batch for id in ids)
+        vals = __get_terms(repo, ids, len(ids))
+        for ids in batch:
+            yield __join_stmt(map(vals.get, ids))
+
+def __compress_chunks(chunks, wbits):
+    # zlib (or with `wbits` > 16, gzip) compressed chunks
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        chunk = c.compress(chunk)
+        if chunk:
+            yield chunk
+    yield c.flush()
+
+def __slices(s):
+    return (s[i:i + STREAM_CHUNK_SIZE]
+        for i in xrange(0, len(s), STREAM_CHUNK_SIZE))
+
+def __mem_size(repo, stmts):
+    # Approximate memory used by a set of statements (object overhead of
+    # strings resp. tuples and integers included)
+    if repo.encoding == Repo.TERMS:
+        return sum(map(len, stmts)) * 32 + len(stmts) * 80
+    return sum(map(len, stmts)) + len(stmts) * 64
+
+def __build_revision(repo, blobs):
+    # Base snapshot for the delta chain
+    stmts = __read_snapshot(repo, blobs[0])
+    return __apply_deltas(repo, stmts, blobs[1:])
+
+def __snapshot(repo, stmts):
+    if repo.encoding == Repo.TERMS:
+        return __compress(repo, __pack(map(lambda s: (0, s), stmts)))
+    return __compress(repo, join(stmts, "\n"))
+
+def __changes(base, stmts):
+    # Changes from the `base` state to the `stmts` state (deleted, added)
+    return base - stmts, stmts - base
+
+def __patch(repo, changes):
+    deleted, added = changes
+    if repo.encoding == Repo.TERMS:
+        return __compress(repo, __pack(
+            map(lambda s: (1, s), deleted) +
+            map(lambda s: (0, s), added)))
+    return __compress(repo, join(
+        map(lambda s: "D " + s, deleted) +
+        map(lambda s: "A " + s, added), "\n"))
+
+def __raw_size(repo, stmts, delta=False):
+    # Uncompressed size of statements in a snapshot (or delta) blob
+    if repo.encoding == Repo.TERMS:
+        return 4 * (sum(map(len, stmts)) + len(stmts))
+    return sum(map(len, stmts)) + (delta and 3 or 1) * len(stmts)
+
+def __estimate(repo, stmts, changes):
+    # Estimate whether the delta for `changes` compresses smaller (True) than
+    # the snapshot of `stmts` (False), or None if it is too close to call.
+    # Deltas and snapshots consist of the same kind of statements and
+    # compress at similar ratios, so their uncompressed sizes are compared.
+    deleted, added = changes
+    ratio = (float(__raw_size(repo, deleted, True) + __raw_size(repo, added, True)) /
+        max(__raw_size(repo, stmts), 1))
+    if ratio < ESTIMATE_DELTA:
+        metrics.incr("estimate.hits")
+        return True
+    if ratio > ESTIMATE_SNAPSHOT:
+        metrics.incr("estimate.hits")
+        return False
+    metrics.incr("estimate.fallbacks")
+    return None
+
+def __read_snapshot(repo, blob):
+    if repo.encoding == Repo.TERMS:
+        return set(map(lambda r: r[1], __unpack(__decompress(repo, blob))))
+    return set(__decompress(repo, blob).splitlines())
+
+def __iter_snapshot(repo, blob):
+    # Like `__read_snapshot`, but decompressed in chunks
+    chunks = compression.decompress_chunks(blob,
+        lambda v: __get_dictionary(repo, v), STREAM_CHUNK_SIZE)
+    if repo.encoding == Repo.TERMS:
+        return itertools.imap(lambda r: r[1], __unpack_chunks(chunks))
+    return __split_lines(chunks)
+
+def __split_lines(chunks):
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+def __read_delta(repo, blob):
+    # Changes of a delta as (deleted, statement) pairs
+    if repo.encoding == Repo.TERMS:
+        return __unpack(__decompress(repo, blob))
+    return map(lambda line: (line[0] != "A", line[2:]),
+        __decompress(repo, blob).splitlines())
+
+def __apply_deltas(repo, stmts, blobs):
+    for blob in blobs:
+        for deleted, stmt in __read_delta(repo, blob):
+            if deleted:
+                stmts.discard(stmt)
+            else:
+                stmts.add(stmt)
     return stmts
 
 def get_csets(repo, key):
@@ -240,6 +986,80 @@ def get_last_cset_of_repo(repo, key):
 def get_csets_count(repo, key):
     return get_csets(repo, key).count()
 
+def get_timemap_page(repo, key, before=None, after=None,
+        size=TIMEMAP_PAGE_SIZE):
+    # Times of up to `size` mementos, newest first, using keyset pagination:
+    # the latest ones, the latest ones before `before` or the earliest ones
+    # after `after`. Returns the times and whether there are newer resp.
+    # older mementos than those of the page.
+    sha = __get_shasum(key)
+
+    query = (CSet
+        .select(CSet.time)
+        .where((CSet.repo == repo) & (CSet.hkey == sha)))
+
+    if after != None:
+        times = [t for t, in query
+            .where(CSet.time > after)
+            .order_by(CSet.time)
+            .limit(size + 1)
+            .tuples()]
+        newer = len(times) > size
+        times = times[:size]
+        times.reverse()
+        older = query.where(CSet.time <= after).limit(1).exists()
+        return times, newer, older
+
+    newer = False
+    if before != None:
+        query = query.where(CSet.time < before)
+        newer = (CSet
+            .select(CSet.time)
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey == sha) &
+                (CSet.time >= before))
+            .limit(1)
+            .exists())
+    times = [t for t, in query
+        .order_by(CSet.time.desc())
+        .limit(size + 1)
+        .tuples()]
+    return times[:size], newer, len(times) > size
+
+# Serialized timemap pages by (repo id, hkey), each the edit counter of the
+# resource and a dict of pages (and their sizes) by an arbitrary key of the
+# caller. Only pages of closed time ranges (with newer mementos) should be
+# cached, which only change with edits of the history. Changes to a resource
+# invalidate its pages (edits by other processes outdate them).
+timemaps = LRUCache("timemaps", TIMEMAP_CACHE_SIZE)
+
+def get_cached_timemap_page(repo, key, page):
+    # A cached page (None if there is none) and the edit counter of the
+    # resource, to cache the page with otherwise
+    sha = __get_shasum(key)
+    edits = __get_edits(repo, sha)
+    cached = timemaps.get((repo.id, sha))
+    if cached == None or cached[0] != edits:
+        return None, edits
+    return cached[1].get(page, (None, 0))[0], edits
+
+def cache_timemap_page(repo, key, page, value, size, edits):
+    sha = __get_shasum(key)
+    cached = timemaps.get((repo.id, sha))
+    pages = {}
+    if cached != None and cached[0] == edits:
+        pages = dict(cached[1])
+    pages[page] = (value, size)
+    timemaps.put((repo.id, sha), (edits, pages),
+        sum(map(lambda p: p[1], pages.values())))
+
+def __get_edits(repo, sha):
+    return (Version
+        .select(Version.edits)
+        .where((Version.repo == repo) & (Version.hkey == sha))
+        .scalar() or 0)
+
 def get_cset_at_ts(repo, key, ts):
     sha = __get_shasum(key)
     return __get_cset_at_ts(repo, sha, ts)
@@ -277,7 +1097,7 @@ def get_cset_prev_before_ts(repo, key, ts):
 def __get_cset_prev_before_ts(repo, sha, ts):
     try:
         cset = (CSet
-                .select(CSet.time, CSet.type)
+                .select(CSet.time, CSet.type, CSet.base)
                 .where((CSet.repo == repo) & (CSet.hkey == sha) & (CSet.time < ts))
                 .order_by(CSet.time.desc())
                 .limit(1)
@@ -288,44 +1108,62 @@ def __get_cset_prev_before_ts(repo, sha, ts):
 
     return cset
 
-def get_repo_index(repo, ts, page, limit=None):
-    # Subquery for selecting max. time per hkey group
-    mx = (CSet
-        .select(CSet.hkey, fn.Max(CSet.time).alias("maxtime"))
-        .where((CSet.repo == repo) & (CSet.time <= ts))
-        .group_by(CSet.hkey)
-        .order_by(CSet.hkey)
-        .paginate(page, INDEX_PAGE_SIZE)
-        .alias("mx"))
-
-    # Query for all the relevant csets (those with max. time values)
-    if not limit:
-        cs = (CSet
-            .select(CSet.hkey, CSet.time)
-            .join(mx, on=(
-                (CSet.hkey == mx.c.hkey_id) &
-                (CSet.time == mx.c.maxtime)))
-            .where((CSet.repo == repo) & (CSet.type != CSet.DELETE))
-            .alias("cs")
-            .naive())
+def get_repo_index(repo, ts, page, limit=None, after=None):
+    # Keys of the resources existing at `ts` (those with a lifetime spanning
+    # `ts`) ordered by hkey: a page of INDEX_PAGE_SIZE keys or, for keyset
+    # pagination, the keys following the hkey `after` (which is the `sha` of
+    # the last key of the previous page). Each key comes with the time of its
+    # latest change at or before `ts`.
+    sp = (Span
+        .select(HMap.sha, HMap.val)
+        .join(HMap, on=(Span.hkey == HMap.sha))
+        .where(
+            (Span.repo == repo) &
+            (Span.since <= ts) &
+            ((Span.until > ts) | (Span.until >> None)))
+        .order_by(Span.hkey))
+    if after != None:
+        sp = sp.where(Span.hkey > after).limit(INDEX_PAGE_SIZE)
     else:
-        cs = (CSet
-            .select(CSet.hkey, CSet.time)
-            .join(mx, on=(
-                (CSet.hkey == mx.c.hkey_id) &
-                (CSet.time == mx.c.maxtime)))
-            .where((CSet.repo == repo) & (CSet.type != CSet.DELETE))
-            .limit(limit)
-            .alias("cs")
-            .naive())
-        
-    # Join with the hmap table to retrieve the plain key values
-    hm = (HMap
-        .select(HMap.val, cs.c.time)
-        .join(cs, on=(HMap.sha == cs.c.hkey_id))
-        .naive())
+        sp = sp.paginate(page, INDEX_PAGE_SIZE)
+    if limit:
+        sp = sp.limit(limit)
+    hm = list(sp.naive())
+
+    if hm:
+        times = dict(CSet
+            .select(CSet.hkey, fn.Max(CSet.time))
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey << map(lambda h: h.sha, hm)) &
+                (CSet.time <= ts))
+            .group_by(CSet.hkey)
+            .tuples())
+        for h in hm:
+            h.time = times.get(h.sha)
+
+    return iter(hm)
+
+def get_key_count(repo, ts):
+    # Number of resources existing at `ts`
+    if not (Head
+            .select(Head.hkey)
+            .where((Head.repo == repo) & (Head.time > ts))
+            .limit(1)
+            .exists()):
+        # The heads are the state of the repo at `ts` (no later csets)
+        return (Head
+            .select()
+            .where((Head.repo == repo) & (Head.type != CSet.DELETE))
+            .count())
 
-    return hm.iterator()
+    return (Span
+        .select()
+        .where(
+            (Span.repo == repo) &
+            (Span.since <= ts) &
+            ((Span.until > ts) | (Span.until >> None)))
+        .count())
 
 
 # Is Obsolete. insert_revision() now handles saving revisions (at any time)
@@ -333,7 +1171,7 @@ def get_repo_index(repo, ts, page, limit=None):
 # No usecase for calling save_revision from outside. 
 def save_revision(repo, key, stmts, ts):
     sha = __get_shasum(key)
-    chain = get_chain_tail(repo, key)
+    chain = get_chain_tail(repo, key, True)
 
     # TODO transfer this to dedicated function. This is not in the right place here
     if chain == None or len(chain) == 0:
@@ -342,89 +1180,501 @@ def save_revision(repo, key, stmts, ts):
         except IntegrityError:
             raise IntegrityError
 
+    stmts = __encode_stmts(repo, stmts)
     return __save_revision(repo, sha, chain, stmts, ts)
 
-def __save_revision(repo, sha, chain, stmts, ts):
+def __save_revision(repo, sha, chain, stmts, ts, force=False):
     # this checks if timestamp is after the last cset of the chain, not if its after all csets for key.
     # this allows pushing to any timestamp, if the chain is right
     if chain and len(chain) > 0 and not ts > chain[-1].time:
         # Appended timestamps must be monotonically increasing!
         raise ValueError
 
-    if len(chain) == 0 or chain[0].type == CSet.DELETE:
-        # Provide dummy value for `patch` which is never stored.
-        # If we get here, we always store a snapshot later on!
-        patch = ""
-    else:
+    if repo.layout == Repo.REVERSE:
+        return __save_revision_reverse(repo, sha, chain, stmts, ts)
+
+    cset = __encode_revision(repo, sha, chain, stmts, force)
+    if cset == None:
+        return None
+    type, data, base = cset
+    __store_cset(repo, sha, ts, type, data, base)
+    return 0
+
+def __encode_revision(repo, sha, chain, stmts, force=False):
+    # The cset (type, data, base) to append to the chain for the new state
+    # `stmts` (None if nothing changed), unless the reverse-delta layout is
+    # used and the chain is not empty.
+    if len(chain) > 0 and chain[0].type != CSet.DELETE:
         # Reconstruct the previous state of the resource
-        prev = __get_revision(repo, sha, chain)
+        blobs = __get_blobs(repo, sha, chain)
+
+        if repo.layout == Repo.SKIP:
+            # The delta base is always part of the path to the previous cset,
+            # so the previous state is reached by applying the remaining deltas.
+            n = chain[-1].seq + 1
+            chain = filter(lambda e: e.seq <= n & (n - 1), chain)
+            base = __build_revision(repo, blobs[:len(chain)])
+            if len(chain) < len(blobs):
+                prev = __apply_deltas(repo, set(base), blobs[len(chain):])
+            else:
+                prev = base
+        else:
+            base = prev = __build_revision(repo, blobs)
 
-        if stmts == prev:
+        if stmts == prev and not force:
             # No changes, nothing to be done. Bail out.
             return None
 
-        patch = compress(join(
-            map(lambda s: "D " + s, prev - stmts) +
-            map(lambda s: "A " + s, stmts - prev), "\n"))
-
-    snapc = compress(join(stmts, "\n"))
-
-    # Calculate the accumulated size of the delta chain including
-    # the (potential) patch from the previous to the pushed state.
-    accumulated_len = reduce(lambda s, e: s + e.len, chain[1:], 0) + len(patch)
+    # Calculate the accumulated size of the delta chain (without the
+    # potential patch from the previous to the pushed state).
+    accumulated_len = reduce(lambda s, e: s + e.len, chain[1:], 0)
 
     base_len = len(chain) > 0 and chain[0].len or 0 # base length
 
     if (len(chain) == 0 or
         chain[0].type == CSet.DELETE or
-        len(snapc) <= len(patch) or
         SNAPF * base_len <= accumulated_len):
         # Store the current state as a new snapshot
-        Blob.create(repo=repo, hkey=sha, time=ts, data=snapc)
-        CSet.create(repo=repo, hkey=sha, time=ts, type=CSet.SNAPSHOT,
-            len=len(snapc))
+        return CSet.SNAPSHOT, __snapshot(repo, stmts), None
+
+    # Only compress the representation which is estimated to be smaller,
+    # unless the estimate is too close to call.
+    changes = __changes(base, stmts)
+    delta = __estimate(repo, stmts, changes)
+    patch = snapc = None
+    if delta != False:
+        patch = __patch(repo, changes)
+        if SNAPF * base_len <= accumulated_len + len(patch):
+            delta = False
+    if delta != True:
+        snapc = __snapshot(repo, stmts)
+        if delta == None:
+            delta = len(snapc) > len(patch)
+
+    if not delta:
+        # Store the current state as a new snapshot
+        return CSet.SNAPSHOT, snapc, None
     else:
         # Store a directed delta between the previous and current state
-        Blob.create(repo=repo, hkey=sha, time=ts, data=patch)
-        CSet.create(repo=repo, hkey=sha, time=ts, type=CSet.DELTA,
-            len=len(patch))
+        return CSet.DELTA, patch, chain[0].time
+
+def __save_revision_reverse(repo, sha, chain, stmts, ts):
+    # The new state always becomes the snapshot at the head. The previous
+    # head is rewritten into a delta against it, unless the delta is not
+    # smaller than the old snapshot or the deltas preceding the old head
+    # (including the new one) would get too long compared to the new head.
+    snapc = __snapshot(repo, stmts)
+
+    if len(chain) == 0 or chain[0].type == CSet.DELETE:
+        __store_cset(repo, sha, ts, CSet.SNAPSHOT, snapc)
+        return 0
+
+    head = chain[-1]
+    prev = __build_revision(repo, __get_blobs(repo, sha, chain))
+    if stmts == prev:
+        # No changes, nothing to be done. Bail out.
+        return None
+
+    __store_cset(repo, sha, ts, CSet.SNAPSHOT, snapc)
+
+    accumulated_len = reduce(lambda s, e: s + e.len,
+        __get_csets_preceding(repo, sha, head.time), 0)
+    if SNAPF * len(snapc) <= accumulated_len:
+        return 0
+
+    changes = __changes(stmts, prev)
+    if __estimate(repo, prev, changes) == False:
+        # The old snapshot is estimated to be smaller than the delta
+        return 0
+
+    patch = __patch(repo, changes)
+    if len(patch) < head.len and SNAPF * len(snapc) > accumulated_len + len(patch):
+        # The old head and the deltas preceding it join the new head's chain
+        __remove_cset(repo, sha, head.time)
+        __store_cset(repo, sha, head.time, CSet.DELTA, patch, ts)
+        __rebase(repo, sha, head.time, head.time, ts)
     return 0
 
+def __store_reverse(repo, sha, ts, stmts):
+    # Store the state at `ts` of a reverse-delta repository in front of the
+    # later csets: as a delta against the next state if the resulting chain
+    # stays short enough, otherwise as a snapshot. Returns the base of the
+    # stored cset.
+    snapc = None
+
+    cset_next = __get_cset_next_after_ts(repo, sha, ts)
+    if cset_next != None and cset_next.type != CSet.DELETE:
+        chain = __get_chain_at_ts(repo, sha, cset_next.time, True)
+        accumulated_len = reduce(lambda s, e: s + e.len, chain[1:], 0)
+        if SNAPF * chain[0].len > accumulated_len:
+            changes = __changes(__get_revision(repo, sha, chain), stmts)
+            delta = __estimate(repo, stmts, changes)
+            if delta != False:
+                patch = __patch(repo, changes)
+                if SNAPF * chain[0].len > accumulated_len + len(patch):
+                    if delta == None:
+                        snapc = __snapshot(repo, stmts)
+                        delta = len(patch) < len(snapc)
+                    if delta:
+                        return __store_cset(repo, sha, ts, CSet.DELTA, patch,
+                            chain[0].time)
+
+    return __store_cset(repo, sha, ts, CSet.SNAPSHOT,
+        snapc or __snapshot(repo, stmts))
+
+def __get_state_before(repo, sha, ts):
+    # The cset directly before `ts` and its statements (None if there is no
+    # such cset or it is a delete).
+    cset_prev = __get_cset_prev_before_ts(repo, sha, ts)
+    if cset_prev == None or cset_prev.type == CSet.DELETE:
+        return cset_prev, None
+    chain = __get_chain_at_ts(repo, sha, cset_prev.time, True)
+    return cset_prev, __get_revision(repo, sha, chain)
+
+def __reencode_before(repo, sha, cset_prev, stmts_prev):
+    # With the reverse-delta layout, a delta directly before a changed cset
+    # was stored against the old state and has to be stored again. The
+    # deltas preceding it follow it into its new chain.
+    if cset_prev != None and cset_prev.type == CSet.DELTA:
+        __remove_cset(repo, sha, cset_prev.time)
+        base = __store_reverse(repo, sha, cset_prev.time, stmts_prev)
+        __rebase(repo, sha, cset_prev.time, cset_prev.base, base)
+
+def __rebase(repo, sha, ts, old, new, following=False):
+    # Move the deltas before `ts` (resp. after it) from the chain based at
+    # `old` to `new`
+    if old != new:
+        if following:
+            where = CSet.time > ts
+        else:
+            where = CSet.time < ts
+        # `time` is kept explicitly, in case its column of a database not
+        # migrated yet still updates itself (see `models.TIMESTAMP_DEFAULT`)
+        (CSet
+            .update(base=new, time=CSet.time)
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey == sha) &
+                (CSet.base == old) &
+                where &
+                (CSet.type == CSet.DELTA))
+            .execute())
+
+def __get_state_after(repo, sha, ts, snapshot=False):
+    # The cset directly after `ts` (along with its `base`) and its statements
+    # if it is a delta (or, with `snapshot`, a snapshot), None otherwise
+    cset_next = __get_cset_next_after_ts(repo, sha, ts)
+    if cset_next == None or cset_next.type == CSet.DELETE or (
+            cset_next.type == CSet.SNAPSHOT and not snapshot):
+        return cset_next, None
+    chain = __get_chain_at_ts(repo, sha, cset_next.time, True)
+    cset_next.base = chain[0].time
+    return cset_next, __get_revision(repo, sha, chain)
+
+def __reencode_after(repo, sha, cset_next, stmts_next, force=False):
+    # A forward delta directly after a changed cset was stored against the
+    # old state and has to be stored again. The deltas following it in its
+    # old chain are still valid (they continue its state), but move to its
+    # new chain. Unless forced, a cset no longer changing anything is
+    # dropped (as long as no deltas follow it).
+    if stmts_next == None:
+        return
+    old = cset_next.base
+    __remove_cset(repo, sha, cset_next.time)
+    chain = __get_chain_at_ts(repo, sha, cset_next.time, True)
+    cset = __encode_revision(repo, sha, chain, stmts_next,
+        force or __has_following(repo, sha, cset_next.time, old))
+    if cset == None:
+        return
+    type, data, base = cset
+    new = __store_cset(repo, sha, cset_next.time, type, data, base)
+    __rebase(repo, sha, cset_next.time, old, new, True)
+
+def __has_following(repo, sha, ts, base):
+    return (CSet
+        .select(CSet.time)
+        .where(
+            (CSet.repo == repo) &
+            (CSet.hkey == sha) &
+            (CSet.base == base) &
+            (CSet.time > ts) &
+            (CSet.type == CSet.DELTA))
+        .exists())
+
+def __atomic():
+    # A transaction (or savepoint) of the database which the blobs written in
+    # it follow (see `blobstore.atomic`)
+    return blobstore.atomic(database)
+
+@contextlib.contextmanager
+def __writing(repo, shas):
+    # A transaction (see `__atomic`) changing the given resources, which
+    # holds their locks: `Executor.serialize` only orders the writes of a
+    # resource within a process. The locks are acquired (in a fixed order)
+    # before anything is read in the transaction, and released after it
+    # ended.
+    names = sorted(set("%d:%s" % (repo.id, sha.encode("hex")) for sha in shas))
+    locked = []
+    try:
+        with __atomic():
+            locked = database.lock(names, LOCK_TIMEOUT)
+            yield
+    finally:
+        database.unlock(locked)
+
+def __store_cset(repo, sha, ts, type, data=None, base=None):
+    # Blob data goes to the blobstore, changeset metadata to the database.
+    # Deletes do not carry any blob data. Deltas are stored with the base of
+    # their chain, "non-deltas" are their own base. Returns the base.
+    revisions.delete((repo.id, sha, ts))
+    timemaps.delete((repo.id, sha))
+    if base == None or type != CSet.DELTA:
+        base = ts
+    length = data is not None and len(data) or 0
+    with __atomic():
+        CSet.create(repo=repo, hkey=sha, time=ts, type=type, base=base,
+            len=length)
+        if data is not None:
+            blobstore.put(repo, sha, ts, data)
+        __update_state(repo, sha, ts, type)
+        __count(repo, bytes=length, **{CSET_COUNTERS[type]: 1})
+    return base
+
+def __update_state(repo, sha, ts, type, removed=False):
+    # Maintain the head and the lifetimes of a resource after storing (or
+    # removing) its cset at `ts`
+    last = __get_chain_last_cset(repo, sha)
+    if last == None:
+        Head.delete().where((Head.repo == repo) & (Head.hkey == sha)).execute()
+        Span.delete().where((Span.repo == repo) & (Span.hkey == sha)).execute()
+        __count(repo, resources=-1)
+        return
+
+    head = (Head
+        .select(Head.time, Head.type)
+        .where((Head.repo == repo) & (Head.hkey == sha))
+        .first())
+    if head == None:
+        Head.create(repo=repo, hkey=sha, time=last.time, type=last.type)
+        __count(repo, resources=1)
+    elif head.time != last.time or head.type != last.type:
+        (Head
+            .update(time=last.time, type=last.type)
+            .where((Head.repo == repo) & (Head.hkey == sha))
+            .execute())
+
+    # `since` is kept explicitly when updating lifetimes (see `__rebase`)
+    if removed and ts > last.time:
+        # The latest cset was removed: a delete no longer ends the current
+        # lifetime, resp. a lifetime starting with it is gone.
+        if type == CSet.DELETE:
+            Span.update(until=None, since=Span.since).where(
+                (Span.repo == repo) & (Span.hkey == sha) & (Span.until == ts)
+            ).execute()
+        else:
+            Span.delete().where(
+                (Span.repo == repo) & (Span.hkey == sha) & (Span.since == ts)
+            ).execute()
+    elif not removed and ts == last.time:
+        # A cset was appended: a delete ends the current lifetime, other
+        # csets start a new one (unless the resource exists already).
+        if type == CSet.DELETE:
+            Span.update(until=ts, since=Span.since).where(
+                (Span.repo == repo) & (Span.hkey == sha) & (Span.until >> None)
+            ).execute()
+        elif not (Span
+                .select(Span.since)
+                .where(
+                    (Span.repo == repo) &
+                    (Span.hkey == sha) &
+                    (Span.until >> None))
+                .exists()):
+            Span.create(repo=repo, hkey=sha, since=ts, until=None)
+    else:
+        # Changes in the middle of the history: recompute all lifetimes
+        __rebuild_spans(repo, sha)
+
+def __count_edit(repo, sha, ts=None):
+    # Changes at or before the latest cset of a resource (unlike appended
+    # csets), resp. any change without `ts`, may change its existing mementos
+    head = (Head
+        .select(Head.time)
+        .where((Head.repo == repo) & (Head.hkey == sha))
+        .first())
+    if head == None or ts != None and ts > head.time:
+        return
+    where = (Version.repo == repo) & (Version.hkey == sha)
+    if Version.update(edits=Version.edits + 1).where(where).execute() == 0:
+        try:
+            Version.create(repo=repo, hkey=sha, edits=1)
+        except IntegrityError:
+            # created concurrently
+            Version.update(edits=Version.edits + 1).where(where).execute()
+
+# Counters of the csets of each type
+CSET_COUNTERS = {
+    CSet.SNAPSHOT: "snapshots",
+    CSet.DELTA: "deltas",
+    CSet.DELETE: "deletes",
+}
+
+def __count(repo, **counts):
+    # Add to the counters of a repo (in the transaction of the change which
+    # is counted)
+    counts = dict((k, v) for k, v in counts.iteritems() if v)
+    if not counts:
+        return
+    changes = dict((k, getattr(Counter, k) + v) for k, v in counts.iteritems())
+    if Counter.update(**changes).where(Counter.repo == repo.id).execute() == 0:
+        # No changes counted so far: create the counter
+        try:
+            Counter.create(repo=repo.id, **counts)
+        except IntegrityError:
+            # created concurrently
+            Counter.update(**changes).where(Counter.repo == repo.id).execute()
+
+def __get_totals(where):
+    # Counter values of the csets matching `where` (without resources)
+    totals = collections.defaultdict(int)
+    csets = (CSet
+        .select(CSet.type, fn.Count(SQL("*")), fn.Sum(CSet.len))
+        .where(where)
+        .group_by(CSet.type)
+        .tuples())
+    for type, count, length in csets:
+        totals[CSET_COUNTERS[type]] += count
+        totals["bytes"] += int(length or 0)
+    return totals
+
+def __get_spans(csets):
+    # Lifetimes [since, until) from the (time, type) of csets ordered by time
+    spans = []
+    since = None
+    for ts, type in csets:
+        if type == CSet.DELETE:
+            if since != None:
+                spans.append((since, ts))
+            since = None
+        elif since == None:
+            since = ts
+    if since != None:
+        spans.append((since, None))
+    return spans
+
+def __rebuild_spans(repo, sha):
+    csets = (CSet
+        .select(CSet.time, CSet.type)
+        .where((CSet.repo == repo) & (CSet.hkey == sha))
+        .order_by(CSet.time)
+        .tuples())
+    Span.delete().where((Span.repo == repo) & (Span.hkey == sha)).execute()
+    rows = map(lambda (since, until): {"repo": repo, "hkey": sha,
+        "since": since, "until": until}, __get_spans(csets))
+    if rows:
+        Span.insert_many(rows).execute()
+
+def __get_csets_following(repo, sha, ts):
+    # All deltas after `ts` up to the next "non-delta", i.e. the remainder
+    # of the delta-chain `ts` belongs to.
+    end = (CSet
+        .select(CSet.time)
+        .where(
+            (CSet.repo == repo) &
+            (CSet.hkey == sha) &
+            (CSet.time > ts) &
+            (CSet.type != CSet.DELTA))
+        .order_by(CSet.time)
+        .limit(1)
+        .scalar())
+
+    query = (CSet
+        .select(CSet.time, CSet.type, CSet.len)
+        .where(
+            (CSet.repo == repo) &
+            (CSet.hkey == sha) &
+            (CSet.time > ts)))
+    if end:
+        query = query.where(CSet.time < end)
+    return list(query.order_by(CSet.time).naive())
+
+def __get_csets_preceding(repo, sha, ts):
+    # All deltas before `ts` back to the previous "non-delta"
+    start = (CSet
+        .select(CSet.time)
+        .where(
+            (CSet.repo == repo) &
+            (CSet.hkey == sha) &
+            (CSet.time < ts) &
+            (CSet.type != CSet.DELTA))
+        .order_by(CSet.time.desc())
+        .limit(1)
+        .scalar())
+
+    query = (CSet
+        .select(CSet.time, CSet.type, CSet.len)
+        .where(
+            (CSet.repo == repo) &
+            (CSet.hkey == sha) &
+            (CSet.time < ts)))
+    if start:
+        query = query.where(CSet.time > start)
+    return list(query.order_by(CSet.time).naive())
+
+def __detach_following(repo, sha, ts):
+    # With the skip-delta layout, the delta base of a cset depends on its
+    # position in the chain. Changing the history at `ts` therefore requires
+    # re-encoding all following deltas of the chain: reconstruct and remove
+    # them here, then store them again with `__reattach` (in the same
+    # transaction).
+    following = map(
+        lambda cs: (cs.time, __get_revision(repo, sha,
+            __get_chain_at_ts(repo, sha, cs.time, True))),
+        __get_csets_following(repo, sha, ts))
+
+    for ts_next, stmts in following:
+        __remove_cset(repo, sha, ts_next)
+    return following
+
+def __reattach(repo, sha, following, force=False):
+    # Unless forced, csets no longer changing anything are dropped
+    for ts, stmts in following:
+        chain = __get_chain_at_ts(repo, sha, ts, True)
+        __save_revision(repo, sha, chain, stmts, ts, force)
+
 def save_revision_delete(repo, key, ts):
     sha = __get_shasum(key)
-    return __save_revision_delete(repo, sha, ts)
+    with __writing(repo, [sha]):
+        return __save_revision_delete(repo, sha, ts)
 
 def __save_revision_delete(repo, sha, ts):
+    __count_edit(repo, sha, ts)
     chain = __get_chain_at_ts(repo, sha, ts)
     if chain[-1]:
-        if not chain[-1].type == CSet.DELETE:
-            # only if there are csets before and the last is no delete
-            stmts_next = set()
+        if not chain[-1].type == CSet.DELETE and repo.layout == Repo.REVERSE:
+            cset_prev, stmts_prev = __get_state_before(repo, sha, ts)
+            __remove_cset(repo, sha, ts)
+            __store_cset(repo, sha, ts, CSet.DELETE)
             cset_next = __get_cset_next_after_ts(repo, sha, ts)
-            if cset_next != None:
-                if cset_next.type == CSet.DELTA:
-                    # If next changeset is Delta, keep next revision statements
-                    chain_next = __get_chain_at_ts(repo, sha, cset_next.time)
-                    stmts_next = __get_revision(repo, sha, chain_next)
-                elif cset_next.type == CSet.DELETE:
-                    # If next changeset is Delete, remove it
-                    __remove_cset(repo, sha, cset_next.time)
-                # Nothing to be done if next changeset is a Snapshot
-
-                if __get_cset_at_ts(repo, sha, ts):
-                    # If there is a cset at the exact time, delete it 
-                    # (reconstruction of next Cset already happened)
-                    __remove_revision(repo, sha, ts) 
-
+            if cset_next != None and cset_next.type == CSet.DELETE:
+                # A directly following delete has become redundant
+                __remove_cset(repo, sha, cset_next.time)
+            __reencode_before(repo, sha, cset_prev, stmts_prev)
+        elif not chain[-1].type == CSet.DELETE:
+            # only if there are csets before and the last is no delete.
+            # A following delta is reconstructed after the delete.
+            following = []
+            if repo.layout == Repo.SKIP:
+                following = __detach_following(repo, sha, ts)
+            cset_next, stmts_next = __get_state_after(repo, sha, ts)
+            # If there is a cset at the exact time, replace it
+            __remove_cset(repo, sha, ts)
             # Insert the new "delete" change
-            CSet.create(repo=repo, hkey=sha, time=ts, type=CSet.DELETE, len=0)
-
-            if cset_next != None:
-                if cset_next.type == CSet.DELTA:
-                    # If next changeset is Delta, reconstruct
-                    __remove_cset(repo, sha, cset_next.time)
-                    chain = __get_chain_at_ts(repo, sha, cset_next.time)
-                    __save_revision(repo, sha, chain, stmts_next, cset_next.time)
+            __store_cset(repo, sha, ts, CSet.DELETE)
+            if cset_next != None and cset_next.type == CSet.DELETE:
+                # A directly following delete has become redundant
+                __remove_cset(repo, sha, cset_next.time)
+            __reencode_after(repo, sha, cset_next, stmts_next)
+            __reattach(repo, sha, following)
         else:
             # Nothing happens. Resource is already deleted. This is legitimate, so no exception needed
             # TODO should this be announced to client somehow?
@@ -434,41 +1684,48 @@ def __save_revision_delete(repo, sha, ts):
 
 def insert_revision(repo, key, stmts, ts):
     sha = __get_shasum(key)
-    return __insert_revision(repo, key, sha, stmts, ts)
+    stmts = __encode_stmts(repo, stmts)
+    with __writing(repo, [sha]):
+        return __insert_revision(repo, key, sha, stmts, ts)
 
 def __insert_revision(repo, key, sha, stmts, ts):
-    # keep next revision statements
-    stmts_next = set()
+    __count_edit(repo, sha, ts)
     cset_next = __get_cset_next_after_ts(repo, sha, ts)
 
-    if cset_next != None:
-        if cset_next.type == CSet.DELTA or cset_next.type == CSet.SNAPSHOT:
-            chain_next = __get_chain_at_ts(repo, sha, cset_next.time)
-            stmts_next = __get_revision(repo, sha, chain_next)
-            # If next cset is Delete, no need to reconstruct 
-
-        if __get_cset_at_ts(repo, sha, ts):
-            # check if there is a revision at this ts. If so remove it for replacement
-            # (reconstruction of next Cset already happened)
-            __remove_revision(repo, sha, ts)
-        
-        chain_current = __get_chain_at_ts(repo, sha, ts)
+    if cset_next != None and repo.layout == Repo.REVERSE:
+        # replace a revision at this ts, store the inserted one in front of
+        # the next cset and re-encode the directly preceding one
+        cset_prev, stmts_prev = __get_state_before(repo, sha, ts)
+        __remove_cset(repo, sha, ts)
+        if stmts == stmts_prev:
+            result = None
+        else:
+            __store_reverse(repo, sha, ts, stmts)
+            result = 0
+        __reencode_before(repo, sha, cset_prev, stmts_prev)
+        return result
+    elif cset_next != None:
+        # keep the following revisions of the chain (even if the next one
+        # does not differ from the inserted one)
+        following = []
+        if repo.layout == Repo.SKIP:
+            following = __detach_following(repo, sha, ts)
+        cset_next, stmts_next = __get_state_after(repo, sha, ts)
+        # check if there is a revision at this ts. If so remove it for replacement
+        __remove_cset(repo, sha, ts)
+        chain_current = __get_chain_at_ts(repo, sha, ts, True)
         # save inserted revision
-        return __save_revision(repo, sha, chain_current, stmts, ts)
-
-        if cset_next.type == CSet.DELTA or cset_next.type == CSet.SNAPSHOT:
-            # delete next revision
-            __remove_cset(repo, sha, cset_next.time)
-            # reconstruct next revision
-            chain = __get_chain_at_ts(repo, sha, cset_next.time)
-            return __save_revision(repo, sha, chain, stmts_next, cset_next.time)
+        result = __save_revision(repo, sha, chain_current, stmts, ts)
+        __reencode_after(repo, sha, cset_next, stmts_next, True)
+        __reattach(repo, sha, following, True)
+        return result
     else:
         if __get_cset_at_ts(repo, sha, ts):
             # check if there is a revision at this ts, which is the latest one. 
             # If so remove it for replacement (no reconstruction needed, as there is no next Cset)
             __remove_revision(repo, sha, ts)
         
-        chain_current = __get_chain_at_ts(repo, sha, ts)
+        chain_current = __get_chain_at_ts(repo, sha, ts, True)
 
         # check if the resource exists
         if chain_current == None or len(chain_current) == 0:
@@ -480,6 +1737,288 @@ def __insert_revision(repo, key, sha, stmts, ts):
         # If there is no cset following, just save the new statements
         return __save_revision(repo, sha, chain_current, stmts, ts)
 
+def save_revisions(repo, graphs, ts, message=None):
+    # Save revisions of many resources (a dict key -> statements) at the same
+    # time `ts` in a single transaction. Revisions appended to the history of
+    # their resource are written with multi-row inserts, others are inserted
+    # one by one. Returns a dict key -> result of insert_revision(), resp. the
+    # error which prevented saving a revision.
+    results = {}
+    keys = graphs.keys()
+    # Terms are added outside of the transaction (their ids are cached)
+    encoded = dict(zip(keys,
+        __encode_revisions(repo, map(graphs.get, keys))))
+
+    with __writing(repo, map(__get_shasum, keys)):
+        shas, heads = __map_keys(repo, keys, results)
+        csets = []
+        for sha, key in shas.iteritems():
+            head = heads.get(sha)
+            if head != None and (head.time >= ts or
+                    repo.layout == Repo.REVERSE and head.type != CSet.DELETE):
+                # Not appended (or the reverse-delta layout rewrites the
+                # previous head): save the revision on its own
+                results[key] = __try_revision(repo, key, sha, ts,
+                    encoded[key])
+                continue
+
+            chain = []
+            if head != None and head.type != CSet.DELETE:
+                chain = __get_chain_at_ts(repo, sha, ts, True)
+            cset = __encode_revision(repo, sha, chain, encoded[key])
+            if cset == None:
+                results[key] = None
+                continue
+            csets.append((sha, key, ts) + cset)
+            results[key] = 0
+
+        __store_csets(repo, csets, heads)
+
+        saved = [sha for sha, key in shas.iteritems() if results[key] == 0]
+        if message and saved:
+            # replaces messages of revisions replaced at `ts`
+            for batch in __batches(saved):
+                (CommitMessage
+                    .delete()
+                    .where(
+                        (CommitMessage.repo == repo) &
+                        (CommitMessage.hkey << batch) &
+                        (CommitMessage.time == ts))
+                    .execute())
+            __insert_many(CommitMessage, [{"repo": repo, "hkey": sha,
+                "time": ts, "message": message} for sha in saved])
+    return results
+
+def import_revisions(repo, histories):
+    # Import the histories of many resources (a dict key -> list of (time,
+    # statements or None for a delete) in the order of time) in a single
+    # transaction. Histories of resources without csets are encoded in
+    # memory and written with multi-row inserts. Other resources get the
+    # revisions after their latest cset appended one by one, earlier ones
+    # are skipped (so that an interrupted import can simply be repeated).
+    # Returns a dict key -> number of stored revisions, resp. the error which
+    # prevented storing them.
+    results = {}
+    keys = histories.keys()
+    # Terms are added outside of the transaction (their ids are cached)
+    revs = [(key, i) for key in keys for i, (ts, stmts)
+        in enumerate(histories[key]) if stmts != None]
+    encoded = dict(zip(revs, __encode_revisions(repo,
+        map(lambda (key, i): histories[key][i][1], revs))))
+    histories = dict((key, [(ts, stmts != None and encoded[(key, i)] or None)
+        for i, (ts, stmts) in enumerate(histories[key])]) for key in keys)
+
+    with __writing(repo, map(__get_shasum, keys)):
+        shas, heads = __map_keys(repo, keys, results)
+        csets = []
+        for sha, key in shas.iteritems():
+            head = heads.get(sha)
+            if head == None:
+                history = __encode_history(repo, sha, histories[key])
+                csets += map(lambda cset: (sha, key) + cset, history)
+                results[key] = len(history)
+                continue
+
+            results[key] = 0
+            for ts, stmts in histories[key]:
+                if ts <= head.time:
+                    continue
+                if stmts == None:
+                    result = __try_delete(repo, key, sha, ts)
+                else:
+                    result = __try_revision(repo, key, sha, ts, stmts)
+                if isinstance(result, Exception):
+                    results[key] = result
+                    break
+                if result == 0:
+                    results[key] += 1
+
+        __store_csets(repo, csets, heads)
+    return results
+
+def __map_keys(repo, keys, errors):
+    # Look up the hashes and heads of many keys (which are mapped to their
+    # hashes if they are new). Hash collisions are reported in `errors`.
+    shas = dict(zip(map(__get_shasum, keys), keys))
+    known = {}
+    heads = {}
+    for batch in __batches(shas.keys()):
+        known.update((str(sha), val) for sha, val in HMap
+            .select(HMap.sha, HMap.val)
+            .where(HMap.sha << batch)
+            .tuples())
+        heads.update((str(h.hkey_id), h) for h in Head
+            .select(Head.hkey, Head.time, Head.type)
+            .where((Head.repo == repo) & (Head.hkey << batch)))
+    for sha, key in shas.items():
+        if sha in known and known[sha] != key:
+            errors[key] = IntegrityError("Key hash collision.")
+            del shas[sha]
+    __insert_many(HMap, [{"sha": sha, "val": key}
+        for sha, key in shas.iteritems() if sha not in known])
+    return shas, heads
+
+def __try_revision(repo, key, sha, ts, stmts):
+    # Insert a single revision within a batch, returns the error if failed
+    try:
+        with __atomic():
+            return __insert_revision(repo, key, sha, stmts, ts)
+    except (ValueError, IntegrityError), e:
+        revisions.delete_matching(lambda k: k[0] == repo.id and k[1] == sha)
+        return e
+
+def __try_delete(repo, key, sha, ts):
+    # Delete a resource within a batch (0 if it existed), returns the error
+    # if failed
+    try:
+        with __atomic():
+            __save_revision_delete(repo, sha, ts)
+            return 0
+    except LookupError:
+        return None
+    except (ValueError, IntegrityError), e:
+        revisions.delete_matching(lambda k: k[0] == repo.id and k[1] == sha)
+        return e
+
+def __encode_history(repo, sha, history):
+    # The csets (time, type, data, base) of the history of a resource without
+    # csets so far, following the same policy as saving one revision after
+    # another (but with the delta-chains kept in memory)
+    csets = []
+    chain = []
+    prev = last = None
+    for ts, stmts in history:
+        if last != None and ts <= last:
+            # Timestamps must be increasing, skip anything else
+            continue
+        last = ts
+        if stmts == None:
+            if prev == None:
+                # Not existing, nothing to delete
+                continue
+            cset = [ts, CSet.DELETE, None, ts]
+            prev = None
+        elif repo.layout == Repo.REVERSE:
+            cset = __encode_reverse(repo, csets, prev, stmts, ts)
+            if cset == None:
+                continue
+            prev = stmts
+        else:
+            cset = __encode_revision(repo, sha,
+                __get_chain_path(repo, chain), stmts)
+            if cset == None:
+                continue
+            cset = [ts, cset[0], cset[1], cset[2] or ts]
+            prev = stmts
+
+        csets.append(cset)
+        e = CSet(time=ts, type=cset[1], len=cset[2] and len(cset[2]) or 0)
+        e.data = cset[2]
+        chain = e.type == CSet.DELTA and chain + [e] or [e]
+    return map(tuple, csets)
+
+def __encode_reverse(repo, csets, prev, stmts, ts):
+    # __save_revision_reverse() for the history encoded so far: the new state
+    # becomes a snapshot, the previous one may be rewritten into a delta
+    if prev == None:
+        return [ts, CSet.SNAPSHOT, __snapshot(repo, stmts), ts]
+    if stmts == prev:
+        return None
+
+    snapc = __snapshot(repo, stmts)
+    head = csets[-1]
+    preceding = []
+    for cset in reversed(csets[:-1]):
+        if cset[1] != CSet.DELTA:
+            break
+        preceding.append(cset)
+    accumulated_len = sum(map(lambda cset: len(cset[2]), preceding))
+    if SNAPF * len(snapc) <= accumulated_len:
+        return [ts, CSet.SNAPSHOT, snapc, ts]
+
+    changes = __changes(stmts, prev)
+    if __estimate(repo, prev, changes) == False:
+        return [ts, CSet.SNAPSHOT, snapc, ts]
+
+    patch = __patch(repo, changes)
+    if (len(patch) < len(head[2]) and
+        SNAPF * len(snapc) > accumulated_len + len(patch)):
+        # The old head and the deltas preceding it join the new head's chain
+        head[1:] = [CSet.DELTA, patch, ts]
+        for cset in preceding:
+            cset[3] = ts
+    return [ts, CSet.SNAPSHOT, snapc, ts]
+
+def __store_csets(repo, csets, heads):
+    # Append csets, given as (sha, key, time, type, data, base) in the order
+    # of time, to the histories of their resources with multi-row inserts
+    # (`heads` are the previous heads of the resources, if any)
+    for sha, key, ts, type, data, base in csets:
+        revisions.delete((repo.id, sha, ts))
+        timemaps.delete((repo.id, sha))
+
+    __insert_many(CSet, [{"repo": repo, "hkey": sha, "time": ts, "type": type,
+        "base": type == CSet.DELTA and base or ts,
+        "len": data is not None and len(data) or 0}
+        for sha, key, ts, type, data, base in csets])
+    blobstore.put_many(repo, [(sha, ts, data)
+        for sha, key, ts, type, data, base in csets if data is not None])
+
+    # Heads, lifetimes and counters of the resources
+    keys = {}
+    history = collections.defaultdict(list)
+    counts = collections.defaultdict(int)
+    for sha, key, ts, type, data, base in csets:
+        keys[sha] = key
+        history[sha].append((ts, type))
+        counts[CSET_COUNTERS[type]] += 1
+        counts["bytes"] += data is not None and len(data) or 0
+
+    __insert_many(Head, [{"repo": repo, "hkey": sha, "time": history[sha][-1][0],
+        "type": history[sha][-1][1]} for sha in keys if sha not in heads])
+    updated = collections.defaultdict(list)
+    for sha in keys:
+        if sha in heads:
+            updated[history[sha][-1]].append(sha)
+    for (ts, type), shas in updated.iteritems():
+        for batch in __batches(shas):
+            (Head
+                .update(time=ts, type=type)
+                .where((Head.repo == repo) & (Head.hkey << batch))
+                .execute())
+
+    spans = []
+    for sha, key in keys.iteritems():
+        head = heads.get(sha)
+        if head != None and head.type != CSet.DELETE:
+            # The current lifetime goes on up to the first delete (if any)
+            lifetimes = __get_spans([(head.time, head.type)] + history[sha])
+            since, until = lifetimes.pop(0)
+            if until != None:
+                (Span
+                    .update(until=until, since=Span.since)
+                    .where(
+                        (Span.repo == repo) &
+                        (Span.hkey == sha) &
+                        (Span.until >> None))
+                    .execute())
+        else:
+            lifetimes = __get_spans(history[sha])
+        spans += map(lambda (since, until): {"repo": repo, "hkey": sha,
+            "since": since, "until": until}, lifetimes)
+    __insert_many(Span, spans)
+
+    counts["resources"] = len(filter(lambda sha: sha not in heads, keys))
+    __count(repo, **counts)
+
+def __batches(items):
+    for i in range(0, len(items), INSERT_BATCH_SIZE):
+        yield items[i:i + INSERT_BATCH_SIZE]
+
+def __insert_many(model, rows):
+    for batch in __batches(rows):
+        model.insert_many(batch).execute()
+
 
 def add_commit_message(repo, key, ts, message):
     sha = __get_shasum(key)
@@ -522,41 +2061,40 @@ def __get_delta_of_memento(repo, sha, ts):
     added = set()
     deleted = set()
 
-    chain = __get_chain_at_ts(repo, sha, ts)
+    chain = __get_chain_at_ts(repo, sha, ts, True)
 
     if len(chain) > 0:
         cset = chain[-1]
         if cset.type == CSet.DELETE:
             # everything was deleted and is a delta here
             # get the chain before the delete, therefore decrease timestamp of current memento
-            prev_chain = __get_chain_at_ts(repo, sha, cset.time - datetime.timedelta(seconds=1))
+            prev_chain = __get_chain_at_ts(repo, sha, cset.time - datetime.timedelta(seconds=1), True)
             if len(prev_chain) > 0:
                 prev_data = __get_revision(repo, sha, prev_chain)
-                deleted = map(lambda s: "" + s, prev_data)
-        elif cset.type == CSet.DELTA:
+                deleted = list(prev_data)
+        elif cset.type == CSet.DELTA and repo.layout == Repo.FORWARD:
             # If Memento is a delta, we just need to deliver the delta itself
-            data = decompress(__get_blob_list(repo, sha, chain)[-1].data)
-            for line in data.splitlines():
-                if line[0] == "A":
-                    # cutoff 'A '
-                    added.add(line[2:])
+            blob = __get_blobs(repo, sha, chain[-1:])[0]
+            for is_deleted, stmt in __read_delta(repo, blob):
+                if is_deleted:
+                    deleted.add(stmt)
                 else:
-                    # cutoff 'D '
-                    deleted.add(line[2:])
+                    added.add(stmt)
         else:
-            # CSet is Snapshot => Calculate Delta from snapshot to last delta
+            # CSet is Snapshot (or a skip-delta against an older revision)
+            # => Calculate Delta from snapshot to last delta
             current_data = __get_revision(repo, sha, chain)
             # get the chain before the snashot, therefore decrease timestamp of current memento
-            prev_chain = __get_chain_at_ts(repo, sha, cset.time - datetime.timedelta(seconds=1))
+            prev_chain = __get_chain_at_ts(repo, sha, cset.time - datetime.timedelta(seconds=1), True)
             if len(prev_chain) > 0:
                 prev_data = __get_revision(repo, sha, prev_chain)
-                added = map(lambda s: "" + s, current_data - prev_data)
-                deleted = map(lambda s: "" + s, prev_data - current_data)
+                added = list(current_data - prev_data)
+                deleted = list(prev_data - current_data)
             else:
                 # No Memento before this snapshot, everything was added
-                added = map(lambda s: "" + s, current_data)
+                added = list(current_data)
 
-    return added, deleted
+    return __decode_stmts(repo, added), __decode_stmts(repo, deleted)
 
 def get_delta_between_mementos(repo, key, ts, delta_ts):
     sha = __get_shasum(key)
@@ -566,14 +2104,16 @@ def __get_delta_between_mementos(repo, sha, ts, delta_ts):
     added = set()
     deleted = set()
 
-    chain = __get_chain_at_ts(repo, sha, ts)
-    prev_chain = __get_chain_at_ts(repo, sha, delta_ts)
+    chain = __get_chain_at_ts(repo, sha, ts, True)
+    prev_chain = __get_chain_at_ts(repo, sha, delta_ts, True)
 
     if len(chain) > 0 and len(prev_chain) > 0:
         data = __get_revision(repo, sha, chain)
         prev_data = __get_revision(repo, sha, prev_chain)
-        added = map(lambda s: "A " + s, data - prev_data)
-        deleted = map(lambda s: "D " + s, prev_data - data)
+        added = map(lambda s: "A " + s,
+            __decode_stmts(repo, data - prev_data))
+        deleted = map(lambda s: "D " + s,
+            __decode_stmts(repo, prev_data - data))
     else:
         # In any other case at least at one time there is no resource. 
         raise ValueError
@@ -581,6 +2121,168 @@ def __get_delta_between_mementos(repo, sha, ts, delta_ts):
 
 
 
+#### Compression dictionaries ####
+
+def __dictionary_tokens(repo, payload):
+    # Substrings of uncompressed blob data worth putting into a dictionary
+    if repo.encoding == Repo.TERMS:
+        # pairs of adjacent integers (header and term ids)
+        return [payload[i:i + 8] for i in range(0, len(payload) - 4, 4)]
+    return STMT_TOKEN_RE.findall(payload)
+
+def sample_snapshots(repo, samples):
+    # Uncompressed data of a random sample of the repo's snapshots
+    csets = (CSet
+        .select(CSet.hkey, CSet.time)
+        .where((CSet.repo == repo) & (CSet.type == CSet.SNAPSHOT))
+        .order_by(fn.Rand())
+        .limit(samples)
+        .tuples())
+    return [__decompress(repo, blobstore.get_many(repo, sha, [ts])[0])
+        for sha, ts in csets]
+
+def train_dictionary(repo, samples=DICT_SAMPLES, size=MAX_DICT_SIZE):
+    # Train a new compression dictionary from a random sample of the repo's
+    # snapshots. It becomes the current dictionary (used for all new blobs)
+    # only if it compresses the sample better than the current one.
+    # Returns the new version (or None) and the compressed sample sizes
+    # with the current and the new dictionary.
+    if repo.codec != ZLIB:
+        # Dictionaries are only supported by zlib
+        return None, 0, 0
+
+    payloads = sample_snapshots(repo, samples)
+
+    data = train(payloads, lambda p: __dictionary_tokens(repo, p), size)
+    current_len = sum(map(lambda p: len(__compress(repo, p)), payloads))
+    if not data:
+        return None, current_len, current_len
+
+    d = PresetDictionary(data, repo.level)
+    new_len = sum(map(lambda p: len(compression.compress(p, ZLIB, repo.level,
+        (1, d))), payloads))
+    if new_len >= current_len:
+        return None, current_len, new_len
+
+    version = (ZDict
+        .select(fn.Max(ZDict.version))
+        .where(ZDict.repo == repo)
+        .scalar() or 0) + 1
+    ZDict.create(repo=repo, version=version, data=data)
+    Repo.update(zdict=version).where(Repo.id == repo.id).execute()
+    repo.zdict = version
+    return version, current_len, new_len
+
+
+#### Delta-chain bases and heads ####
+
+def rebuild_bases(repo):
+    # (Re)compute the stored chain base of all csets of a repo from the
+    # order of its csets, e.g. for csets stored before bases were recorded.
+    # "Non-deltas" are their own base, deltas belong to the previous (or with
+    # the reverse-delta layout, the next) "non-delta" of their resource.
+    # (keeping `time`, see `__rebase`)
+    CSet.update(base=CSet.time, time=CSet.time).where(
+        CSet.repo == repo).execute()
+
+    csets = (CSet
+        .select(CSet.hkey, CSet.time, CSet.type)
+        .where(CSet.repo == repo)
+        .order_by(CSet.hkey, CSet.time)
+        .tuples())
+
+    sha = base = None
+    deltas = []
+    for hkey, ts, type in csets.iterator():
+        if hkey != sha:
+            if repo.layout != Repo.REVERSE:
+                __set_base(repo, sha, deltas, base)
+            sha, base, deltas = hkey, None, []
+        if type == CSet.DELTA:
+            deltas.append(ts)
+            continue
+        if repo.layout == Repo.REVERSE:
+            __set_base(repo, sha, deltas, ts)
+        else:
+            __set_base(repo, sha, deltas, base)
+        base, deltas = ts, []
+    if repo.layout != Repo.REVERSE:
+        __set_base(repo, sha, deltas, base)
+
+def __set_base(repo, sha, deltas, base):
+    # Deltas without a "non-delta" to belong to are left as they are
+    if deltas and base != None:
+        (CSet
+            .update(base=base, time=CSet.time)
+            .where(
+                (CSet.repo == repo) &
+                (CSet.hkey == sha) &
+                (CSet.time >= deltas[0]) &
+                (CSet.time <= deltas[-1]))
+            .execute())
+
+
+def rebuild_heads(repo):
+    # (Re)compute the heads of all resources of a repo from its csets
+    Head.delete().where(Head.repo == repo).execute()
+
+    mx = (CSet
+        .select(CSet.hkey, fn.Max(CSet.time).alias("maxtime"))
+        .where(CSet.repo == repo)
+        .group_by(CSet.hkey)
+        .alias("mx"))
+    heads = (CSet
+        .select(CSet.repo, CSet.hkey, CSet.time, CSet.type)
+        .join(mx, on=(
+            (CSet.hkey == mx.c.hkey_id) &
+            (CSet.time == mx.c.maxtime)))
+        .where(CSet.repo == repo))
+    Head.insert_from([Head.repo, Head.hkey, Head.time, Head.type],
+        heads).execute()
+
+def rebuild_spans(repo):
+    # (Re)compute the lifetimes of all resources of a repo from its csets
+    Span.delete().where(Span.repo == repo).execute()
+
+    csets = (CSet
+        .select(CSet.hkey, CSet.time, CSet.type)
+        .where(CSet.repo == repo)
+        .order_by(CSet.hkey, CSet.time)
+        .tuples())
+
+    for sha, group in itertools.groupby(csets.iterator(), lambda r: r[0]):
+        rows = map(lambda (since, until): {"repo": repo, "hkey": sha,
+            "since": since, "until": until},
+            __get_spans(map(lambda r: r[1:], group)))
+        if rows:
+            Span.insert_many(rows).execute()
+
+def rebuild_counters():
+    # (Re)compute the counters of all repos from their csets, e.g. in case
+    # they got out of sync (should not run along with changes)
+    totals = collections.defaultdict(lambda: collections.defaultdict(int))
+    csets = (CSet
+        .select(CSet.repo, CSet.type, fn.Count(SQL("*")), fn.Sum(CSet.len))
+        .group_by(CSet.repo, CSet.type)
+        .tuples())
+    for repo, type, count, length in csets.iterator():
+        totals[repo][CSET_COUNTERS[type]] += count
+        totals[repo]["bytes"] += int(length or 0)
+    keys = (CSet
+        .select(CSet.repo, fn.Count(fn.Distinct(CSet.hkey)))
+        .group_by(CSet.repo)
+        .tuples())
+    for repo, count in keys.iterator():
+        totals[repo]["resources"] += count
+
+    with database.atomic():
+        Counter.delete().execute()
+        rows = map(lambda (id, counts): dict(counts, repo=id),
+            totals.iteritems())
+        if rows:
+            Counter.insert_many(rows).execute()
+
+
 #### Repository management ####
 
 def remove_repo(repo):
@@ -590,6 +2292,10 @@ def remove_repo(repo):
     __cleanup_hmap()
     # remove repo
     __remove_repo(repo)
+    # forget cached terms and dictionaries of the repo
+    __term_ids.clear()
+    __term_vals.clear()
+    __dicts.clear()
 
 def __cleanup_hmap():
     # TODO delete all entries whose sha is not referenced in CSet any more
@@ -600,67 +2306,97 @@ def __remove_repo(repo):
     repo.delete_instance(recursive=True)
 
 def __remove_csets_repo(repo):
-    # remove blobs
-    q_blobs = Blob.delete().where(Blob.repo == repo)
-    q_blobs.execute()
+    # forget cached revisions and timemaps
+    revisions.delete_matching(lambda k: k[0] == repo.id)
+    timemaps.delete_matching(lambda k: k[0] == repo.id)
 
-    # remove csets
-    q_csets = CSet.delete().where(CSet.repo == repo)
-    q_csets.execute()
+    # remove csets and blobs
+    with __atomic():
+        q_csets = CSet.delete().where(CSet.repo == repo)
+        q_csets.execute()
+        blobstore.delete_repo(repo)
+        Head.delete().where(Head.repo == repo).execute()
+        Span.delete().where(Span.repo == repo).execute()
 
-def __remove_csets(repo, sha):
-    # remove blobs
-    q_blobs = Blob.delete().where(Blob.repo == repo, Blob.hkey == sha)
-    q_blobs.execute()
+        # no longer count the csets of the repo
+        Counter.delete().where(Counter.repo == repo.id).execute()
 
-    # remove csets
-    q_csets = CSet.delete().where(CSet.repo == repo, CSet.hkey == sha)
-    q_csets.execute()
+def __remove_csets(repo, sha):
+    # forget cached revisions and timemaps
+    revisions.delete_matching(lambda k: k[0] == repo.id and k[1] == sha)
+    timemaps.delete((repo.id, sha))
+
+    # remove csets and blobs
+    with __atomic():
+        __count_edit(repo, sha)
+        totals = __get_totals((CSet.repo == repo) & (CSet.hkey == sha))
+        q_csets = CSet.delete().where(CSet.repo == repo, CSet.hkey == sha)
+        q_csets.execute()
+        blobstore.delete_key(repo, sha)
+        Head.delete().where(Head.repo == repo, Head.hkey == sha).execute()
+        Span.delete().where(Span.repo == repo, Span.hkey == sha).execute()
+        if totals:
+            totals["resources"] = 1
+        __count(repo, **dict((k, -v) for k, v in totals.iteritems()))
 
 def __remove_cset(repo, sha, ts):
-    # remove cset
-    try:
-        cset = CSet.get(CSet.repo == repo, CSet.hkey == sha, CSet.time == ts)
-        count = cset.delete_instance()
-    except CSet.DoesNotExist:
-        return None
-    
-    # remove blob
-    try:
-        blob = Blob.get(Blob.repo == repo, Blob.hkey == sha, Blob.time == ts)
-        blob.delete_instance()
-    except Blob.DoesNotExist:
-        return None
+    revisions.delete((repo.id, sha, ts))
+    timemaps.delete((repo.id, sha))
+
+    # remove cset and blob (deletes do not have one)
+    with __atomic():
+        try:
+            cset = CSet.get(CSet.repo == repo, CSet.hkey == sha,
+                CSet.time == ts)
+        except CSet.DoesNotExist:
+            return None
+        cset.delete_instance()
+        if cset.type != CSet.DELETE:
+            blobstore.delete(repo, sha, ts)
+        __update_state(repo, sha, ts, cset.type, True)
+        __count(repo, bytes=-cset.len, **{CSET_COUNTERS[cset.type]: -1})
 
 
 def remove_revision(repo, key, ts):
     # (repo, hkey, time) is composite key for cset
     sha = __get_shasum(key)
-    return __remove_revision(repo, sha, ts)
+    with __writing(repo, [sha]):
+        return __remove_revision(repo, sha, ts)
 
 def __remove_revision(repo, sha, ts):
-    # keep next revision statements
-    stmts_next = set()
-    cset_next = __get_cset_next_after_ts(repo, sha, ts)
-    if cset_next != None:
-        # also recalculate snapshots in case that snapshot equals the last cset
-        if cset_next.type == CSet.DELTA or cset_next.type == CSet.SNAPSHOT:
-            # not last cset
-            chain_next = __get_chain_at_ts(repo, sha, cset_next.time)
-            stmts_next = __get_revision(repo, sha, chain_next)
-
-    # remove blob and cset
-    __remove_cset(repo, sha, ts)
-
+    __count_edit(repo, sha, ts)
+    if repo.layout == Repo.REVERSE:
+        cset_prev, stmts_prev = __get_state_before(repo, sha, ts)
+        __remove_cset(repo, sha, ts)
+        __reencode_before(repo, sha, cset_prev, stmts_prev)
+        return
+
+    if repo.layout != Repo.SKIP:
+        # keep the next revision (also recalculate a next snapshot in case
+        # that it equals the revision before the removed one)
+        cset_next, stmts_next = __get_state_after(repo, sha, ts, True)
+        # remove blob and cset
+        __remove_cset(repo, sha, ts)
+        __reencode_after(repo, sha, cset_next, stmts_next)
+    else:
+        # keep following revisions of the chain
+        following = __detach_following(repo, sha, ts)
+        if not following:
+            # also recalculate a next snapshot in case that it equals the
+            # revision before the removed one (along with its chain)
+            cset_next = __get_cset_next_after_ts(repo, sha, ts)
+            if cset_next != None and cset_next.type == CSet.SNAPSHOT:
+                chain_next = __get_chain_at_ts(repo, sha, cset_next.time, True)
+                following = [(cset_next.time, __get_revision(repo, sha, chain_next))]
+                following += __detach_following(repo, sha, cset_next.time)
+                __remove_cset(repo, sha, cset_next.time)
 
+        # remove blob and cset
+        __remove_cset(repo, sha, ts)
 
-    # if not last cset, re-compute next cset
-    if cset_next != None:
-        if cset_next.type == CSet.DELTA or cset_next.type == CSet.SNAPSHOT:
-            __remove_cset(repo, sha, cset_next.time)
-            chain = __get_chain_at_ts(repo, sha, cset_next.time)
-            __save_revision(repo, sha, chain, stmts_next, cset_next.time)
+        # re-compute following csets
+        __reattach(repo, sha, following)
 
     # if all csets removed, remove key from hmap
-    if (cset_next == None):
+    if __get_chain_last_cset(repo, sha) == None:
         __cleanup_hmap()
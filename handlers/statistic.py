@@ -1,4 +1,4 @@
-from models import User, Token, Repo, HMap, CSet, Blob, CommitMessage
+from models import User, Token, Repo, Counter, Blob, CommitMessage
 from peewee import IntegrityError, SQL, fn
 
 import logging
@@ -12,11 +12,27 @@ def get_user_count():
 def get_repo_count():
 	return Repo.select().count()
 
+COUNTERS = ("resources", "snapshots", "deltas", "deletes", "bytes")
+
+def get_counters(repo=None):
+	# Totals of a repo maintained by `revision_logic`, resp. the sums of the
+	# totals of all repos
+	if repo != None:
+		counter = Counter.select().where(Counter.repo == repo.id).first()
+		return counter or Counter(repo=repo.id)
+	sums = (Counter
+		.select(*map(lambda k: fn.Sum(getattr(Counter, k)), COUNTERS))
+		.where(Counter.repo != Counter.ALL)
+		.tuples()
+		.first())
+	return Counter(repo=Counter.ALL,
+		**dict(zip(COUNTERS, map(lambda v: int(v or 0), sums or ()))))
+
 def get_resource_count():
-	return HMap.select().count()
+	return get_counters().resources
 
 def get_revision_count():
-	return CSet.select().count()
+	return get_counters().revisions
 
 def get_all_users(page):
 	return User.select(User.name).paginate(page, INDEX_PAGE_SIZE)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import binascii
 import functools
 import random
 
@@ -15,12 +16,11 @@ from tornado.web import authenticated
 
 import peewee
 
-from peewee import fn
-
-from models import User, Repo, HMap, CSet, Token
+from models import User, Repo, Token
 from handlers import RequestHandler
 import revision_logic
 import statistic
+import compression
 
 logger = logging.getLogger('debug')
 
@@ -145,35 +145,48 @@ class RepoHandler(BaseHandler):
             else:
                 ts = now()
             if key and not timemap:
-                chain = revision_logic.get_chain_at_ts(repo, key, ts)
-                # use ts of cset instead of now(), to make prev work
-                if len(chain) != 0:
-                    ts = chain[-1].time
+                # neighbors (relative to the memento's cset) and commit
+                # message in one go
+                memento = revision_logic.get_memento(repo, key, ts)
 
-                cs_prev = revision_logic.get_cset_prev_before_ts(repo, key, ts)
-                cs_next = revision_logic.get_cset_next_after_ts(repo, key, ts)
+                cs_prev = memento.prev
+                cs_next = memento.next
                 if cs_prev:
-                    cs_prev_str = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_prev.time.strftime(QSDATEFMT)
+                    cs_prev_str = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_prev.strftime(QSDATEFMT)
                 else:
                     cs_prev_str = ""
                 if cs_next:
-                    cs_next_str = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_next.time.strftime(QSDATEFMT)
+                    cs_next_str = self.request.protocol + "://" + self.request.host + self.request.path + "?key=" + key + "&datetime=" + cs_next.strftime(QSDATEFMT)
                 else:
                     cs_next_str = "" 
-                commit_message = revision_logic.get_commit_message(repo, key, ts)
+                commit_message = memento.message
 
                 self.render("repo/memento.html", repo=repo, key=key, datetime=datetime, cs_next_str=cs_next_str, cs_prev_str=cs_prev_str, commit_message=commit_message)
             elif key and timemap:
                 self.render("repo/history.html", repo=repo, key=key)
             elif index:
-                cs = (CSet.select(fn.distinct(CSet.hkey)).where((CSet.repo == repo) & (CSet.time <= ts)).alias("cs"))
-                key_count = (HMap.select(HMap.val).join(cs, on=(HMap.sha == cs.c.hkey_id))).count()
-
-                page = int(self.get_query_argument("page", "1"))
+                key_count = revision_logic.get_key_count(repo, ts)
+
+                # Pages start after a cursor (`after`), the hkey of the last
+                # key of the previous page, as in the API
+                after = self.get_query_argument("after", None)
+                if after:
+                    try:
+                        after = binascii.unhexlify(after)
+                    except TypeError:
+                        raise HTTPError(reason="Invalid format of after param", status_code=400)
+
+                hm = list(revision_logic.get_repo_index(repo, ts, 1, after=after))
+
+                index_url = self.request.protocol + "://" + self.request.host + self.request.path + "?index=true"
+                if datetime:
+                    index_url += "&datetime=" + datetime
+                if len(hm) < revision_logic.INDEX_PAGE_SIZE:
+                    next_url = None
+                else:
+                    next_url = index_url + "&after=" + binascii.hexlify(hm[-1].sha)
 
-                hm = revision_logic.get_repo_index(repo, ts, page)
-                
-                self.render("repo/index.html", repo=repo, title=title, key_count=key_count, page_size=revision_logic.INDEX_PAGE_SIZE, hm=hm, current_page=page)
+                self.render("repo/index.html", repo=repo, title=title, key_count=key_count, hm=hm, index_url=index_url, next_url=next_url)
             else:
                 hm = list(revision_logic.get_repo_index(repo, ts, 1, 5))
                 # cs = (CSet.select(fn.distinct(CSet.hkey)).where(CSet.repo == repo).limit(5).alias("cs"))
@@ -214,17 +227,34 @@ class CreateRepoHandler(BaseHandler):
     def get(self):
         user = self.current_user
         title = "Create a new repository"
-        self.render("repo/new.html", title=title, user=user)
+        codecs = [(codec, name)
+            for codec, name in sorted(compression.CODECS.items())
+            if compression.available(codec)]
+        self.render("repo/new.html", title=title, user=user, codecs=codecs)
 
     @authenticated
     def post(self):
         reponame = self.get_argument("reponame", None)
         desc = self.get_argument("description", None)
+        try:
+            layout = int(self.get_argument("layout", Repo.FORWARD))
+            encoding = int(self.get_argument("encoding", Repo.TEXT))
+            codec = int(self.get_argument("codec", compression.ZLIB))
+            level = self.get_argument("level", "")
+            level = int(level) if level != "" else None
+        except ValueError:
+            self.redirect(self.reverse_url("web:create-repo"))
+            return
         user = self.current_user
-        if not reponame:
+        if (not reponame or
+            layout not in (Repo.FORWARD, Repo.SKIP, Repo.REVERSE) or
+            encoding not in (Repo.TEXT, Repo.TERMS) or
+            not compression.available(codec) or
+            (level != None and level not in compression.LEVELS[codec])):
             self.redirect(self.reverse_url("web:create-repo"))
             return
-        repo = Repo.create(user=user, name=reponame, desc=desc)
+        repo = Repo.create(user=user, name=reponame, desc=desc, layout=layout,
+            encoding=encoding, codec=codec, level=level)
         self.redirect(self.reverse_url("web:repo", user.name, repo.name))
 
 class DelRepoHandler(BaseHandler):
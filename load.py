@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# Import the history of resources into a repository directly, bypassing the
+# HTTP API, e.g. `python load.py user/repo dump.tnq --workers 8`.
+#
+# The input is either a stream (file or `-` for stdin) or a directory:
+#
+# - Streams consist of N-Quads, one statement per line, each prefixed with
+#   the time of its revision and a tab. The graph name of a statement is the
+#   key of the resource it describes. A line with just the time and a key in
+#   angle brackets marks the resource as deleted:
+#
+#   2015-06-11-09:45:00<TAB><s> <p> <o> <http://example.org/key> .
+#   2015-06-12-10:00:00<TAB><http://example.org/key>
+#
+#   The lines of each key must follow each other, in the order of time.
+#
+# - Directories contain a subdirectory per revision time (e.g. one per dump,
+#   named like `2015-06-11-09:45:00`) with a file per resource. The key of a
+#   resource is the path of its file below the subdirectory (without its
+#   extension) appended to `--prefix`. With `--deletes`, resources missing
+#   from a later subdirectory are marked as deleted at its time.
+#
+# Keys are partitioned among the worker processes by their hash, so that all
+# revisions of a resource are encoded by the same worker. The workers write
+# `--batch` resources per transaction using multi-row inserts. Resources
+# having revisions already only get later revisions appended, so that an
+# interrupted import can simply be run again.
+
+import argparse
+import collections
+import datetime
+import multiprocessing
+import os
+import Queue
+import re
+import sys
+import time
+import zlib
+
+from RDF import RedlandError
+
+from database import MDB as Database
+from blobstore import Blobstore
+
+from config import dbconf, bsconf
+
+import models
+from handlers import revision_logic
+
+# Revision time format (as in the API query strings)
+DATEFMT = "%Y-%m-%d-%H:%M:%S"
+
+# Graph name (the key) at the end of an N-Quads line
+GRAPH_RE = re.compile(r"<([^>]*)>\s*\.?\s*$")
+
+# Interval of progress reports in seconds
+REPORT_INTERVAL = 10
+
+def date(s):
+    return datetime.datetime.strptime(s, DATEFMT)
+
+def read_stream(f):
+    # Histories (key, [(time, N-Quads or None for a delete)]) from a stream
+    key = None
+    history = []
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        ts, quad = line.split("\t", 1)
+        m = GRAPH_RE.search(quad)
+        if m == None:
+            raise ValueError("Statement without graph name: %s" % quad)
+        k = m.group(1).decode("utf-8")
+        ts = date(ts)
+        if k != key:
+            if key != None:
+                yield key, history
+            key = k
+            history = []
+        if m.start() == 0:
+            history.append((ts, None))
+        elif history and history[-1][0] == ts and history[-1][1] != None:
+            history[-1][1].append(quad)
+        else:
+            history.append((ts, [quad]))
+    if key != None:
+        yield key, history
+
+def read_directory(path, prefix, deletes=False):
+    # Histories (key, [(time, file path or None for a delete)]) from a
+    # directory of revisions
+    dumps = sorted((date(name), os.path.join(path, name))
+        for name in os.listdir(path)
+        if os.path.isdir(os.path.join(path, name)))
+
+    histories = collections.defaultdict(list)
+    for ts, dump in dumps:
+        for root, subdirs, files in os.walk(dump):
+            for fname in files:
+                fpath = os.path.join(root, fname)
+                name = os.path.splitext(os.path.relpath(fpath, dump))[0]
+                key = prefix + name.decode("utf-8")
+                histories[key].append((ts, fpath))
+
+    for key in sorted(histories):
+        history = histories[key]
+        if deletes:
+            present = set(ts for ts, fpath in history)
+            first = history[0][0]
+            files = dict(history)
+            history = []
+            for ts, dump in dumps:
+                if ts < first:
+                    continue
+                if ts in present:
+                    history.append((ts, files[ts]))
+                elif history[-1][1] != None:
+                    history.append((ts, None))
+        yield key, history
+
+def parse(key, history, fmt):
+    # Statements of the revisions of a resource (read by a worker)
+    revisions = []
+    for ts, source in history:
+        if source == None:
+            stmts = None
+        elif isinstance(source, list):
+            graphs = revision_logic.parse_graphs("\n".join(source))
+            if graphs.keys() != [key]:
+                raise ValueError("Statements of other keys at %s" % ts)
+            stmts = graphs[key]
+        else:
+            with open(source) as f:
+                stmts = revision_logic.parse(f.read(), fmt)
+        revisions.append((ts, stmts))
+    return revisions
+
+def work(username, reponame, queue, reports, batch, fmt):
+    # Worker process: import the histories from `queue` in batches, reporting
+    # (keys, revisions, stored csets, failed keys) of each batch
+    database = Database(**dbconf)
+    blobstore = Blobstore(bsconf["nodes"], **bsconf["opts"])
+    models.initialize(database, blobstore)
+    repo = revision_logic.get_repo(username, reponame)
+
+    histories = {}
+    failed = []
+    count = 0
+    while True:
+        item = queue.get()
+        if item != None:
+            key, history = item
+            count += len(history)
+            try:
+                histories[key] = parse(key, history, fmt)
+            except (RedlandError, ValueError, IOError), e:
+                failed.append((key, str(getattr(e, "value", e))))
+
+        if len(histories) >= batch or item == None:
+            csets = 0
+            if histories:
+                results = revision_logic.import_revisions(repo, histories)
+                for key, result in results.iteritems():
+                    if isinstance(result, Exception):
+                        failed.append((key, str(result)))
+                    else:
+                        csets += result
+            reports.put((len(histories), count, csets, failed))
+            histories = {}
+            failed = []
+            count = 0
+
+        if item == None:
+            break
+    database.close()
+
+class Progress(object):
+    def __init__(self):
+        self.start = time.time()
+        self.reported = self.start
+        self.keys = self.revisions = self.csets = 0
+        self.failed = []
+
+    def add(self, report):
+        keys, revisions, csets, failed = report
+        self.keys += keys
+        self.revisions += revisions
+        self.csets += csets
+        self.failed += failed
+        for key, message in failed:
+            print >> sys.stderr, "failed: %s (%s)" % (key.encode("utf-8"),
+                message)
+        if time.time() - self.reported >= REPORT_INTERVAL:
+            self.report()
+
+    def report(self):
+        self.reported = time.time()
+        elapsed = max(self.reported - self.start, 0.001)
+        print ("%d resources, %d revisions, %d changesets in %ds "
+            "(%.1f revisions/s, %.1f changesets/s), %d failed" % (
+            self.keys, self.revisions, self.csets, elapsed,
+            self.revisions / elapsed, self.csets / elapsed,
+            len(self.failed)))
+        sys.stdout.flush()
+
+def load(args):
+    username, reponame = args.repo.split("/")
+    database = Database(**dbconf)
+    models.initialize(database, None)
+    repo = revision_logic.get_repo(username, reponame)
+    if repo == None:
+        sys.exit("Repository %s not found." % args.repo)
+    database.close()
+
+    if os.path.isdir(args.input):
+        histories = read_directory(args.input, args.prefix, args.deletes)
+    elif args.input == "-":
+        histories = read_stream(sys.stdin)
+    else:
+        histories = read_stream(open(args.input))
+
+    queues = []
+    workers = []
+    reports = multiprocessing.Queue()
+    for i in range(args.workers):
+        queue = multiprocessing.Queue(args.batch)
+        worker = multiprocessing.Process(target=work, args=(username,
+            reponame, queue, reports, args.batch, args.format))
+        worker.start()
+        queues.append(queue)
+        workers.append(worker)
+
+    progress = Progress()
+
+    def drain():
+        while not reports.empty():
+            progress.add(reports.get())
+        if not all(map(lambda w: w.is_alive(), workers)):
+            for w in workers:
+                w.terminate()
+            sys.exit("A worker process exited unexpectedly.")
+
+    try:
+        for key, history in histories:
+            i = (zlib.crc32(key.encode("utf-8")) & 0xffffffff) % args.workers
+            while True:
+                try:
+                    queues[i].put((key, history), timeout=1)
+                    break
+                except Queue.Full:
+                    # The worker is busy (or gone)
+                    drain()
+            drain()
+    except (ValueError, IOError):
+        for w in workers:
+            w.terminate()
+        raise
+
+    for queue in queues:
+        queue.put(None)
+    while any(map(lambda w: w.is_alive(), workers)) or not reports.empty():
+        try:
+            progress.add(reports.get(timeout=1))
+        except Queue.Empty:
+            pass
+    progress.report()
+    if progress.failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import resource histories into a repository.")
+    parser.add_argument("repo", metavar="user/repo",
+        help="repository to import into")
+    parser.add_argument("input",
+        help="N-Quads stream (`-` for stdin) or directory of revisions")
+    parser.add_argument("--workers", type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of worker processes")
+    parser.add_argument("--batch", type=int, default=500,
+        help="resources written per transaction")
+    parser.add_argument("--prefix", default="",
+        help="prefix of the keys of files in a directory")
+    parser.add_argument("--format", default="application/n-triples",
+        help="media type of the files in a directory")
+    parser.add_argument("--deletes", action="store_true",
+        help="mark resources missing from a later directory as deleted")
+
+    load(parser.parse_args())
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+# Maintenance commands, run e.g. `python manage.py copy-blobs`
+
+import argparse
+import sys
+
+from peewee import IntegrityError
+from playhouse.migrate import MySQLMigrator, migrate as run_migrations
+
+from database import MDB as Database
+from blobstore import Blobstore, TableBlobstore, SegmentBlobstore
+
+from config import dbconf, bsconf
+from models import *
+
+import models
+from handlers import revision_logic, statistic
+
+tables = [
+    User,
+    Token,
+    Repo,
+    HMap,
+    Term,
+    ZDict,
+    CSet,
+    Head,
+    Version,
+    Span,
+    Counter,
+    Blob,
+    CommitMessage,
+]
+
+def backfill_cset_base():
+    for repo in Repo.select():
+        print "computing chain bases of repo %d" % repo.id
+        revision_logic.rebuild_bases(repo)
+
+def backfill_heads():
+    for repo in Repo.select():
+        print "computing heads of repo %d" % repo.id
+        revision_logic.rebuild_heads(repo)
+
+def backfill_spans():
+    for repo in Repo.select():
+        print "computing lifetimes of resources in repo %d" % repo.id
+        revision_logic.rebuild_spans(repo)
+
+def backfill_counters():
+    print "counting csets of all repos"
+    revision_logic.rebuild_counters()
+
+# Tables and columns (without a default) derived from existing rows, which
+# are computed after creating them (columns are added as nullable first)
+backfills = {
+    (CSet, "base"): backfill_cset_base,
+    Head: backfill_heads,
+    Span: backfill_spans,
+    Counter: backfill_counters,
+}
+
+def redefine_column(model, field):
+    # Change the definition of an existing column to the one of `field`
+    database = models.dbproxy.obj
+    compiler = database.compiler()
+    sql, params = compiler.parse_node(compiler.field_definition(field))
+    database.execute_sql("ALTER TABLE %s MODIFY %s" % (
+        compiler.quote(model._meta.db_table), sql), params)
+
+def updates_itself(field, columns):
+    # Whether the TIMESTAMP column of `field` lacks its explicit default, e.g.
+    # when created without one, so that MySQL may set it to the current time
+    # by every UPDATE (see `models.TIMESTAMP_DEFAULT`)
+    if field.constraints is not TIMESTAMP_DEFAULT:
+        return False
+    default, extra = columns[field.db_column]
+    return ("current_timestamp" not in (default or "").lower() or
+        "on update" in (extra or "").lower())
+
+def migrate(args):
+    # Bring the schema of an existing database up to date: create missing
+    # tables and add columns (and their indexes) introduced since the tables
+    # were created.
+    database = models.dbproxy.obj
+    migrator = MySQLMigrator(database)
+    existing = database.get_tables()
+
+    for model in tables:
+        table = model._meta.db_table
+        if table not in existing:
+            print "creating table %s" % table
+            model.create_table()
+            if model in backfills:
+                backfills[model]()
+            continue
+
+        # column -> (default, extra)
+        columns = dict((row[0], (row[4], row[5])) for row in
+            database.execute_sql("SHOW COLUMNS FROM %s" %
+                database.compiler().quote(table)).fetchall())
+        added = set()
+        for field in model._meta.get_fields():
+            if field.db_column in columns:
+                if updates_itself(field, columns):
+                    print "redefining column %s.%s" % (table, field.db_column)
+                    redefine_column(model, field)
+                continue
+            print "adding column %s.%s" % (table, field.db_column)
+            backfill = backfills.get((model, field.name))
+            if backfill:
+                nullable = field.clone_base()
+                nullable.null = True
+                run_migrations(
+                    migrator.add_column(table, field.db_column, nullable))
+                backfill()
+                # (unlike `add_not_null`, with the default of the column)
+                redefine_column(model, field)
+            else:
+                run_migrations(
+                    migrator.add_column(table, field.db_column, field))
+            added.add(field.name)
+
+        for names, unique in model._meta.indexes:
+            if added.intersection(names):
+                print "adding index on %s(%s)" % (table, ", ".join(names))
+                run_migrations(migrator.add_index(table,
+                    [model._meta.fields[n].db_column for n in names], unique))
+
+def count(args):
+    # Recompute the counters of the statistics from scratch, in case they got
+    # out of sync with the csets (e.g. after changing the database manually).
+    revision_logic.rebuild_counters()
+    counter = statistic.get_counters()
+    print "%d resources, %d revisions (%d snapshots, %d deltas, %d deletes), %d bytes" % (
+        counter.resources, counter.revisions, counter.snapshots,
+        counter.deltas, counter.deletes, counter.bytes)
+
+def copy_blobs(args):
+    # Copy all rows of the `blob` table into the configured blobstore, e.g.
+    # when switching an existing installation over to segment files. Blobs
+    # copied before are skipped, so an interrupted copy can be repeated.
+    if isinstance(models.bsproxy.obj, TableBlobstore):
+        sys.exit("No dedicated blobstore configured (set BLOBSTORE_PATH).")
+
+    count = 0
+    for repo, sha, ts, data in TableBlobstore(Blob).items():
+        try:
+            models.bsproxy.put(repo, sha, ts, data)
+        except IntegrityError:
+            pass
+        count += 1
+        if count % 10000 == 0:
+            print "%d blobs copied" % count
+    print "%d blobs copied" % count
+
+    if args.delete:
+        Blob.delete().execute()
+
+def compact_blobs(args):
+    # Reclaim the space of deleted blobs in the segment files (see
+    # `SegmentBlobstore.compact`)
+    if not isinstance(models.bsproxy.obj, SegmentBlobstore):
+        sys.exit("No dedicated blobstore configured (set BLOBSTORE_PATH).")
+
+    reclaimed = models.bsproxy.compact(args.min_garbage)
+    print "%d bytes reclaimed" % reclaimed
+
+def train_dicts(args):
+    # (Re)train the compression dictionaries of all or the given repos.
+    # Blobs stored so far keep using the dictionary they were written with.
+    repos = Repo.select(Repo, User).join(User)
+    for name in args.repos:
+        username, reponame = name.split("/")
+        repo = revision_logic.get_repo(username, reponame)
+        if repo == None:
+            sys.exit("Repository %s not found." % name)
+
+    for repo in repos:
+        name = "%s/%s" % (repo.user.name, repo.name)
+        if args.repos and name not in args.repos:
+            continue
+        version, current_len, new_len = revision_logic.train_dictionary(
+            repo, args.samples, args.size)
+        if version:
+            print "%s: dictionary version %d, sample %d -> %d bytes" % (
+                name, version, current_len, new_len)
+        else:
+            print "%s: kept dictionary version %d" % (name, repo.zdict)
+
+commands = {
+    "migrate": migrate,
+    "count": count,
+    "copy-blobs": copy_blobs,
+    "compact-blobs": compact_blobs,
+    "train-dicts": train_dicts,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("migrate",
+        help="create missing tables and columns in an existing database")
+
+    subparsers.add_parser("count",
+        help="recompute the counters of all repositories from scratch")
+
+    p = subparsers.add_parser("copy-blobs",
+        help="copy blobs from the database into the configured blobstore")
+    p.add_argument("--delete", action="store_true",
+        help="empty the blob table afterwards")
+
+    p = subparsers.add_parser("compact-blobs",
+        help="reclaim the space of deleted blobs in the segment files")
+    p.add_argument("--min-garbage", type=float, default=0.5,
+        help="min. share of deleted data in the segments to compact them")
+
+    p = subparsers.add_parser("train-dicts",
+        help="train compression dictionaries from samples of snapshots")
+    p.add_argument("repos", nargs="*", metavar="user/repo",
+        help="repositories to train (default: all)")
+    p.add_argument("--samples", type=int,
+        default=revision_logic.DICT_SAMPLES,
+        help="number of snapshots sampled per repository")
+    p.add_argument("--size", type=int,
+        default=revision_logic.MAX_DICT_SIZE,
+        help="max. dictionary size in bytes")
+
+    args = parser.parse_args()
+
+    database = Database(**dbconf)
+    blobstore = Blobstore(bsconf["nodes"], **bsconf["opts"])
+    models.initialize(database, blobstore)
+
+    commands[args.command](args)
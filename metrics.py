@@ -0,0 +1,33 @@
+import collections
+import threading
+
+# Process-local counters and gauges of internal events, e.g. cache hits.
+# They are reported (per process) by the `/api/_stats` endpoint.
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_gauges = {}
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+def value(name):
+    return _counters[name]
+
+def gauge(name, fn):
+    # Register a function returning the current value of `name`
+    _gauges[name] = fn
+
+def ratio(hits, total):
+    return total and float(hits) / total or 0.0
+
+def snapshot():
+    with _lock:
+        values = dict(_counters)
+    for name, fn in _gauges.items():
+        values[name] = fn()
+    return values
+
+gauge("estimate.hit_rate", lambda: ratio(value("estimate.hits"),
+    value("estimate.hits") + value("estimate.fallbacks")))
@@ -1,8 +1,10 @@
 from peewee import *
 from database import *
+from blobstore import TableBlobstore
 import datetime
 
 dbproxy = Proxy()
+bsproxy = Proxy()
 
 class Base(Model):
     class Meta:
@@ -31,31 +33,131 @@ class Repo(Base):
     user = ForeignKeyField(User, related_name="repos", null=False)
     name = CharField(null=False, index=True)
     desc = CharField(max_length=255)
+    layout = MSQLTinyIntegerField(unsigned=True, null=False, default=0)
+    encoding = MSQLTinyIntegerField(unsigned=True, null=False, default=0)
+    # Blob compression codec and level (see `compression`; None: default)
+    codec = MSQLTinyIntegerField(unsigned=True, null=False, default=0)
+    level = MSQLTinyIntegerField(unsigned=True, null=True)
+    # Version of the current compression dictionary (0: none)
+    zdict = MSQLSmallIntegerField(unsigned=True, null=False, default=0)
 
     class Meta:
         indexes = [(("user", "name"), True)]
 
+    # Delta-chain layouts (see `revision_logic`)
+    FORWARD = 0
+    SKIP = 1
+    REVERSE = 2
+
+    # Statement encodings of blobs (see `revision_logic`)
+    TEXT = 0
+    TERMS = 1
+
 class HMap(Base):
     sha = MSQLBinaryField(length=20, primary_key=True)
     val = CharField(max_length=2048, null=False)
 
+class Term(Base):
+    id = PrimaryKeyField()
+    repo = ForeignKeyField(Repo, related_name="terms", null=False)
+    sha = MSQLBinaryField(length=20, null=False)
+    val = MSQLMediumBlobField(null=False)
+
+    class Meta:
+        indexes = [(("repo", "sha"), True)]
+
+class ZDict(Base):
+    repo = ForeignKeyField(Repo, related_name="zdicts", null=False)
+    version = MSQLSmallIntegerField(unsigned=True, null=False)
+    data = BlobField(null=False)
+
+    class Meta:
+        primary_key = CompositeKey("repo", "version")
+
+# Explicit default of TIMESTAMP columns which are not set automatically:
+# without `explicit_defaults_for_timestamp` (the default before MySQL 8 and
+# MariaDB 10.10), the first TIMESTAMP column of a table would otherwise be set
+# to the current time by every UPDATE of its row, and further ones would
+# default to the zero date (rejected with NO_ZERO_DATE).
+TIMESTAMP_DEFAULT = [SQL("DEFAULT CURRENT_TIMESTAMP")]
+
 class CSet(Base):
     repo = ForeignKeyField(Repo, related_name="csets", null=False)
     hkey = ForeignKeyField(HMap, null=False)
-    time = MSQLTimestampField(precision=0, null=False)
+    time = MSQLTimestampField(precision=0, null=False,
+        constraints=TIMESTAMP_DEFAULT)
     type = MSQLTinyIntegerField(unsigned=True, null=False)
     len  = MSQLMediumIntegerField(unsigned=True, null=False)
     # created_at = DateTimeField(default=datetime.datetime.now)
-    # base = MSQLTimestampField(precision=3, null=False)
+    # time of the snapshot (or delete) the delta-chain of this cset starts
+    # with, i.e. its own time for "non-deltas"
+    base = MSQLTimestampField(precision=0, null=False,
+        constraints=TIMESTAMP_DEFAULT)
 
     class Meta:
         primary_key = CompositeKey("repo", "hkey", "time")
+        indexes = [(("repo", "hkey", "base", "time"), False)]
 
     SNAPSHOT = 0
     DELTA = 1
     DELETE = 2
 
-# TODO: Store blobs in a dedicated blobstore? (benchmark)
+class Head(Base):
+    # latest cset of each resource (its current state), maintained along with
+    # the csets by `revision_logic`
+    repo = ForeignKeyField(Repo, related_name="heads", null=False)
+    hkey = ForeignKeyField(HMap, null=False)
+    time = MSQLTimestampField(precision=0, null=False)
+    type = MSQLTinyIntegerField(unsigned=True, null=False)
+
+    class Meta:
+        primary_key = CompositeKey("repo", "hkey")
+        indexes = [(("repo", "time"), False)]
+
+class Version(Base):
+    # number of changes to the history of a resource other than appending
+    # csets, which may have changed existing mementos (part of their ETags),
+    # maintained by `revision_logic`. Unlike the head, it is kept when all
+    # csets of the resource are removed.
+    repo = ForeignKeyField(Repo, related_name="versions", null=False)
+    hkey = ForeignKeyField(HMap, null=False)
+    edits = MSQLIntegerField(unsigned=True, null=False, default=0)
+
+    class Meta:
+        primary_key = CompositeKey("repo", "hkey")
+
+class Span(Base):
+    # lifetime [since, until) of a resource, from a snapshot or delta after a
+    # delete (or none) up to the next delete (or None while it exists),
+    # maintained along with the csets by `revision_logic`
+    repo = ForeignKeyField(Repo, related_name="spans", null=False)
+    hkey = ForeignKeyField(HMap, null=False)
+    since = MSQLTimestampField(precision=0, null=False,
+        constraints=TIMESTAMP_DEFAULT)
+    until = MSQLTimestampField(precision=0, null=True, constraints=[SQL("NULL")])
+
+    class Meta:
+        # resources are listed in the order of their hkey (the primary key)
+        primary_key = CompositeKey("repo", "hkey", "since")
+
+class Counter(Base):
+    # totals of the csets of a repo for the statistics, maintained along with
+    # the csets by `revision_logic`. The totals of all repos (repo ALL) are
+    # summed up when read, so that writes to different repos do not update a
+    # shared row.
+    repo = MSQLIntegerField(unsigned=True, primary_key=True)
+    resources = MSQLBigIntegerField(null=False, default=0)
+    snapshots = MSQLBigIntegerField(null=False, default=0)
+    deltas = MSQLBigIntegerField(null=False, default=0)
+    deletes = MSQLBigIntegerField(null=False, default=0)
+    # stored blob data in bytes
+    bytes = MSQLBigIntegerField(null=False, default=0)
+
+    ALL = 0
+
+    @property
+    def revisions(self):
+        return self.snapshots + self.deltas + self.deletes
 
 class CommitMessage(Base):
     repo = ForeignKeyField(Repo, related_name="commitMessages", null=False)
@@ -77,3 +179,4 @@ class Blob(Base):
 
 def initialize(database, blobstore):
     dbproxy.initialize(database)
+    bsproxy.initialize(blobstore or TableBlobstore(Blob))
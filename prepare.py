@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from database import MDB as Database
+from blobstore import Blobstore
 
 from config import dbconf, bsconf
 from models import *
@@ -9,14 +10,20 @@ import models
 
 if __name__ == "__main__":
     database = Database(**dbconf)
-    blobstore = None # Blobstore(bsconf.nodes, **bsconf.opts)
+    blobstore = Blobstore(bsconf["nodes"], **bsconf["opts"])
     models.initialize(database, blobstore)
     database.create_tables([
         User,
         Token,
         Repo,
         HMap,
+        Term,
+        ZDict,
         CSet,
+        Head,
+        Version,
+        Span,
+        Counter,
         Blob,
         CommitMessage,
     ])
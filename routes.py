@@ -24,6 +24,7 @@ routes = [
     url(r"/settings/tokens/([0-9]+)/del", handlers.web.DelTokenHandler,
         name="web:del-token"),
     url(r"/([^/]+)", handlers.web.UserHandler, name="web:user"),
+    url(r"/api/_stats", handlers.api.StatsHandler, name="api:stats"),
     url(r"/api/([^/]+)", handlers.api.UserHandler, name="api:user"),
     url(r"/([^/]+)/([^/]+)", handlers.web.RepoHandler, name="web:repo"),
     url(r"/([^/]+)/([^/]+)/del", handlers.web.DelRepoHandler, name="web:del-repo"),
@@ -51,6 +52,8 @@ routes = [
 # GET   /:user/:repo                    Repository access
 # POST  /:user/:repo/del                Delete repository
 #
+# GET   /api/_stats                     Internal counters (per process)
+#
 # PUT   /api/:user/:repo?key=URI
 # PUT   /api/:user/:repo?key=URI&datetime=DATETIME
 #
@@ -11,6 +11,12 @@ from database import MDB as Database
 from config import settings, dbconf, bsconf
 from models import *
 import models
+from blobstore import SegmentBlobstore
+from handlers import revision_logic
+import compression
+import metrics
+
+from concurrent.futures import ProcessPoolExecutor
 
 import unittest
 import requests
@@ -19,6 +25,11 @@ import datetime
 import time
 
 import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import zlib
 
 database = Database(**dbconf)
 blobstore = None # Blobstore(bsconf.nodes, **bsconf.opts)
@@ -36,6 +47,8 @@ def seed():
 	repo1 = Repo.create(user=user1, name="repo1", desc="important description")
 	repo2 = Repo.create(user=user2, name="repo2", desc="important description")
 	repo3 = Repo.create(user=user1, name="lov_test", desc="important description")
+	Repo.create(user=user1, name="batch", desc="important description")
+	Repo.create(user=user1, name="caching", desc="important description")
 	# i = 0 
 	# tailrToken = "123456"
 	# header = {'Authorization':"token "+tailrToken, 'Content-Type':"application/n-triples"}
@@ -1015,6 +1028,1751 @@ class Authorized(unittest.TestCase):
 
 
 
+# Delta-chain layouts and statement encodings: revisions are reconstructed
+# as stored, also after changes in the middle of the history
+class Storage(unittest.TestCase):
+
+	user = User.get(User.name == "user1")
+	key = "http://example.org/storage"
+
+	# statements shared by all revisions (so that deltas are stored)
+	shared = set([
+		'<http://example.org/s> <http://example.org/p%d> "shared %d" .' % (i, i)
+		for i in range(20)])
+
+	@staticmethod
+	def time(hour):
+		return datetime.datetime(2015, 1, 1, hour)
+
+	@classmethod
+	def state(cls, n):
+		return cls.shared | set([
+			'<http://example.org/s> <http://example.org/n> <http://example.org/o%d> .' % n,
+			'<http://example.org/s> <http://example.org/l> "literal %d"@en .' % n,
+			'<http://example.org/s> <http://example.org/d> "%d"^^<http://www.w3.org/2001/XMLSchema#integer> .' % n])
+
+	def revision(self, repo, ts):
+		chain = revision_logic.get_chain_at_ts(repo, self.key, ts)
+		if len(chain) == 0 or chain[0].type == CSet.DELETE:
+			return None
+		return revision_logic.get_revision(repo, self.key, chain)
+
+	def assertHistory(self, repo, history):
+		# `history` maps hours to states (None for deletes)
+		for hour in range(24):
+			times = [h for h in sorted(history) if h <= hour]
+			expected = times and history[times[-1]] or None
+			self.assertEqual(self.revision(repo, self.time(hour)), expected)
+
+	def checkHistory(self, layout, encoding):
+		repo = Repo.create(user=self.user, desc="",
+			name="storage_%d_%d" % (layout, encoding),
+			layout=layout, encoding=encoding)
+		history = {}
+		for n in range(10):
+			history[2 * n] = self.state(n)
+			revision_logic.insert_revision(repo, self.key, self.state(n),
+				self.time(2 * n))
+		self.assertHistory(repo, history)
+
+		# insert in the middle of a delta-chain
+		history[5] = self.state(20)
+		revision_logic.insert_revision(repo, self.key, self.state(20),
+			self.time(5))
+		self.assertHistory(repo, history)
+
+		# delete in the middle of the history
+		history[9] = None
+		revision_logic.save_revision_delete(repo, self.key, self.time(9))
+		self.assertHistory(repo, history)
+
+		# remove revisions in the middle and at the start
+		for hour in (12, 0):
+			del history[hour]
+			revision_logic.remove_revision(repo, self.key, self.time(hour))
+			self.assertHistory(repo, history)
+
+		# replace the delete
+		history[9] = self.state(21)
+		revision_logic.insert_revision(repo, self.key, self.state(21),
+			self.time(9))
+		self.assertHistory(repo, history)
+
+		revision_logic.remove_repo(repo)
+
+	def test000_forward_layout(self):
+		self.checkHistory(Repo.FORWARD, Repo.TEXT)
+
+	def test001_skip_layout(self):
+		self.checkHistory(Repo.SKIP, Repo.TEXT)
+
+	def test002_reverse_layout(self):
+		self.checkHistory(Repo.REVERSE, Repo.TEXT)
+
+	def test010_forward_layout_with_terms(self):
+		self.checkHistory(Repo.FORWARD, Repo.TERMS)
+
+	def test011_skip_layout_with_terms(self):
+		self.checkHistory(Repo.SKIP, Repo.TERMS)
+
+	def test012_reverse_layout_with_terms(self):
+		self.checkHistory(Repo.REVERSE, Repo.TERMS)
+
+	def checkTimes(self, layout):
+		# Changing the bases of csets (when inserting in the middle of a
+		# delta-chain, or rebuilding them) keeps their times
+		repo = Repo.create(user=self.user, desc="", name="storage_times_%d" % layout, layout=layout)
+		for n in range(4):
+			revision_logic.insert_revision(repo, self.key, self.state(n), self.time(2 * n))
+		other = set(['<http://example.org/s> <http://example.org/other> "%d" .' % i for i in range(30)])
+		revision_logic.insert_revision(repo, self.key, other, self.time(3))
+		expected = map(self.time, (0, 2, 3, 4, 6))
+		csets = list(CSet.select().where(CSet.repo == repo).order_by(CSet.time))
+		self.assertEqual(map(lambda c: c.time, csets), expected)
+		times = set(map(lambda c: c.time, csets))
+		for cset in csets:
+			self.assertTrue(cset.base in times)
+		revision_logic.rebuild_bases(repo)
+		self.assertEqual(map(lambda c: (c.time, c.base), CSet.select().where(CSet.repo == repo).order_by(CSet.time)),
+			map(lambda c: (c.time, c.base), csets))
+		self.assertHistory(repo, {0: self.state(0), 2: self.state(1), 3: other, 4: self.state(2), 6: self.state(3)})
+		revision_logic.remove_repo(repo)
+
+	def test020_forward_layout_keeps_times(self):
+		self.checkTimes(Repo.FORWARD)
+
+	def test021_skip_layout_keeps_times(self):
+		self.checkTimes(Repo.SKIP)
+
+	def test022_reverse_layout_keeps_times(self):
+		self.checkTimes(Repo.REVERSE)
+
+	def checkLayout(self, repo, expected):
+		# `expected` maps hours to the type and base (hour) of their csets
+		self.assertEqual(map(lambda c: (c.time, c.type, c.base),
+			CSet.select().where(CSet.repo == repo).order_by(CSet.time)),
+			[(self.time(hour), type, self.time(base)) for hour, (type, base) in sorted(expected.items())])
+
+	def test030_reverse_layout_csets(self):
+		# The head of a reverse-delta history is a snapshot, earlier states
+		# are deltas against later ones
+		repo = Repo.create(user=self.user, desc="", name="storage_reverse_csets", layout=Repo.REVERSE)
+		# shared statements which do not compress well, so that deltas are
+		# clearly smaller than snapshots
+		shared = set(['<http://example.org/s> <http://example.org/q%d> "%s" .' % (i, hashlib.sha1(str(i)).hexdigest())
+			for i in range(100)])
+		state = lambda n: shared | self.state(n)
+		D, S, X = CSet.DELTA, CSet.SNAPSHOT, CSet.DELETE
+		history = {}
+		for n in range(4):
+			history[2 * n] = state(n)
+			revision_logic.insert_revision(repo, self.key, state(n), self.time(2 * n))
+		self.checkLayout(repo, {0: (D, 6), 2: (D, 6), 4: (D, 6), 6: (S, 6)})
+		self.assertEqual(len(revision_logic.get_chain_at_ts(repo, self.key, self.time(7))), 1)
+		self.assertHistory(repo, history)
+
+		# insert in the middle of the history
+		history[3] = state(10)
+		revision_logic.insert_revision(repo, self.key, state(10), self.time(3))
+		self.checkLayout(repo, {0: (D, 6), 2: (D, 6), 3: (D, 6), 4: (D, 6), 6: (S, 6)})
+		self.assertHistory(repo, history)
+
+		# a delete in the middle of the history makes the state before it
+		# a snapshot, which the deltas before it are based on
+		history[5] = None
+		revision_logic.save_revision_delete(repo, self.key, self.time(5))
+		self.checkLayout(repo, {0: (D, 4), 2: (D, 4), 3: (D, 4), 4: (S, 4), 5: (X, 5), 6: (S, 6)})
+		self.assertHistory(repo, history)
+
+		# so does removing that snapshot
+		del history[4]
+		revision_logic.remove_revision(repo, self.key, self.time(4))
+		self.checkLayout(repo, {0: (D, 3), 2: (D, 3), 3: (S, 3), 5: (X, 5), 6: (S, 6)})
+		self.assertHistory(repo, history)
+		self.assertEqual(len(revision_logic.get_chain_at_ts(repo, self.key, self.time(7))), 1)
+
+		revision_logic.remove_repo(repo)
+
+
+# Blobs written with earlier compression envelopes can still be read
+class Envelopes(unittest.TestCase):
+
+	data = "<http://example.org/s> <http://example.org/p> \"o\" .\n" * 1000
+	dictionary = compression.PresetDictionary(
+		"<http://example.org/s> <http://example.org/p> ")
+
+	def decompressed(self, blob, dictionaries=None):
+		data = compression.decompress(blob, dictionaries)
+		self.assertEqual("".join(compression.decompress_chunks(blob,
+			dictionaries, 100)), data)
+		return data
+
+	def test000_headerless(self):
+		blob = zlib.compress(self.data)
+		self.assertEqual(self.decompressed(blob), self.data)
+		self.assertEqual(compression.zlib_stream(blob), blob)
+
+	def test002_version2(self):
+		for codec in compression.CODECS:
+			if not compression.available(codec):
+				continue
+			blob = compression.compress(self.data, codec)
+			self.assertEqual(blob[:1], "\x02")
+			self.assertEqual(self.decompressed(blob), self.data)
+
+	def test003_version2_with_dictionary(self):
+		blob = compression.compress(self.data,
+			dictionary=(3, self.dictionary))
+		self.assertEqual(self.decompressed(blob, {3: self.dictionary}.get),
+			self.data)
+		self.assertEqual(compression.zlib_stream(blob), None)
+
+	def test004_version2_zlib_stream(self):
+		blob = compression.compress(self.data)
+		self.assertEqual(zlib.decompress(compression.zlib_stream(blob)),
+			self.data)
+
+
+# Canonical N-Triples/N-Quads are parsed without Redland, with the same result
+class Canonical(unittest.TestCase):
+
+	ntriples = "\n".join([
+		'<http://example.org/s> <http://example.org/p> <http://example.org/o> .',
+		'<http://example.org/s>  <http://example.org/p>\t<http://example.org/o2>  .',
+		'<http://example.org/s> <http://example.org/p> "plain" .',
+		'<http://example.org/s> <http://example.org/p> "" .',
+		'<http://example.org/s> <http://example.org/p> "tagged"@en .',
+		'<http://example.org/s> <http://example.org/p> "tagged"@en-gb .',
+		'<http://example.org/s> <http://example.org/p> "1"^^<http://www.w3.org/2001/XMLSchema#integer> .',
+		'<http://example.org/s> <http://example.org/p> "a \\"quote\\", a \\\\ and a\\ttab\\nand lines\\r" .',
+		'<urn:isbn:0451450523> <http://example.org/p> "#not a comment" .',
+		'',
+		'# a comment',
+	])
+
+	nquads = "\n".join([
+		'<http://example.org/s> <http://example.org/p> <http://example.org/o> <http://example.org/a> .',
+		'<http://example.org/s> <http://example.org/p> "tagged"@en <http://example.org/a> .',
+		'<http://example.org/s> <http://example.org/p> "1"^^<http://www.w3.org/2001/XMLSchema#integer> <http://example.org/b> .',
+	])
+
+	not_canonical = [
+		'_:b0 <http://example.org/p> <http://example.org/o> .',
+		'<http://example.org/s> <http://example.org/p> _:b0 .',
+		'<http://example.org/s> <http://example.org/p> "string"^^<http://www.w3.org/2001/XMLSchema#string> .',
+		'<http://example.org/s> <http://example.org/p> "tagged"@EN .',
+		'<http://example.org/s> <http://example.org/p> "\\u00e9" .',
+		'<http://example.org/s> <http://example.org/p> "\xc3\xa9" .',
+		'<http://example.org/s> <http://example.org/p> <http://example.org/o> . # comment',
+		'<http://example.org/s><http://example.org/p><http://example.org/o>.',
+		'<s> <http://example.org/p> <http://example.org/o> .',
+		'<http://example.org/s> <http://example.org/p> <http://example.org/o>',
+	]
+
+	def test000_ntriples_as_redland(self):
+		stmts = revision_logic.parse_canonical(self.ntriples)
+		self.assertNotEqual(stmts, None)
+		self.assertEqual(stmts, revision_logic.parse(self.ntriples,
+			"application/n-triples", False))
+
+	def test001_nquads_as_redland(self):
+		graphs = revision_logic.parse_canonical(self.nquads, True)
+		self.assertNotEqual(graphs, None)
+		self.assertEqual(dict(graphs), dict(revision_logic.parse_graphs(
+			self.nquads, False)))
+
+	def test002_not_canonical(self):
+		for line in self.not_canonical:
+			self.assertEqual(revision_logic.parse_canonical(
+				self.ntriples + "\n" + line), None, line)
+
+	def test003_not_canonical_left_to_redland(self):
+		# (blank nodes are renamed by Redland on each parse)
+		stmts = revision_logic.parse(self.ntriples + "\n" + self.not_canonical[0],
+			"application/n-triples")
+		canonical = revision_logic.parse_canonical(self.ntriples)
+		self.assertEqual(len(stmts), len(canonical) + 1)
+		self.assertTrue(canonical < stmts)
+
+	def test004_triples_without_graph_in_nquads(self):
+		self.assertEqual(revision_logic.parse_canonical(
+			self.nquads + "\n" + self.ntriples, True), None)
+
+
+# Blobs in segment files
+class Segments(unittest.TestCase):
+
+	repo = Repo.get(Repo.name == "repo1")
+	sha = hashlib.sha1("http://example.org/segments").digest()
+
+	@staticmethod
+	def time(second):
+		return datetime.datetime(2015, 1, 1, 0, 0, second)
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.blobstore = SegmentBlobstore(self.path, segment_size=1024)
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test000_put(self):
+		self.blobstore.put(self.repo, self.sha, self.time(1), "one")
+		self.blobstore.put_many(self.repo, [(self.sha, self.time(2), "two"),
+			(self.sha, self.time(3), "three")])
+		self.assertEqual(self.blobstore.get_many(self.repo, self.sha,
+			[self.time(3), self.time(1)]), ["three", "one"])
+
+	def test001_put_existing(self):
+		self.blobstore.put(self.repo, self.sha, self.time(1), "one")
+		with self.assertRaises(IntegrityError):
+			self.blobstore.put(self.repo, self.sha, self.time(1), "two")
+		self.assertEqual(self.blobstore.get_many(self.repo, self.sha,
+			[self.time(1)]), ["one"])
+
+	def test002_delete(self):
+		self.blobstore.put(self.repo, self.sha, self.time(1), "one")
+		self.blobstore.delete(self.repo, self.sha, self.time(1))
+		with self.assertRaises(KeyError):
+			self.blobstore.get_many(self.repo, self.sha, [self.time(1)])
+		self.blobstore.put(self.repo, self.sha, self.time(1), "again")
+		self.assertEqual(self.blobstore.get_many(self.repo, self.sha,
+			[self.time(1)]), ["again"])
+
+	def test003_rescan(self):
+		for second in range(50):
+			self.blobstore.put(self.repo, self.sha, self.time(second),
+				"blob %d" % second * 10)
+		for second in range(0, 50, 2):
+			self.blobstore.delete(self.repo, self.sha, self.time(second))
+		self.blobstore.compact()
+
+		blobstore = SegmentBlobstore(self.path, segment_size=1024)
+		for second in range(50):
+			if second % 2:
+				self.assertEqual(blobstore.get_many(self.repo, self.sha,
+					[self.time(second)]), ["blob %d" % second * 10])
+			else:
+				with self.assertRaises(KeyError):
+					blobstore.get_many(self.repo, self.sha, [self.time(second)])
+
+	def test004_rollback(self):
+		self.blobstore.put(self.repo, self.sha, self.time(1), "one")
+		try:
+			with self.blobstore.atomic(database):
+				self.blobstore.delete(self.repo, self.sha, self.time(1))
+				self.blobstore.put(self.repo, self.sha, self.time(2), "two")
+				raise ValueError
+		except ValueError:
+			pass
+		self.assertEqual(self.blobstore.get_many(self.repo, self.sha,
+			[self.time(1)]), ["one"])
+		with self.assertRaises(KeyError):
+			self.blobstore.get_many(self.repo, self.sha, [self.time(2)])
+
+	def segment(self):
+		return os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+
+	def test005_corrupt_tail_cut_off(self):
+		self.blobstore.put(self.repo, self.sha, self.time(1), "one")
+		self.blobstore.put(self.repo, self.sha, self.time(2), "two")
+		with open(self.segment(), "r+b") as f:
+			f.seek(-1, os.SEEK_END)
+			f.write("x")
+
+		blobstore = SegmentBlobstore(self.path, segment_size=1024)
+		self.assertEqual(blobstore.get_many(self.repo, self.sha,
+			[self.time(1)]), ["one"])
+		with self.assertRaises(KeyError):
+			blobstore.get_many(self.repo, self.sha, [self.time(2)])
+		blobstore.put(self.repo, self.sha, self.time(2), "again")
+		blobstore = SegmentBlobstore(self.path, segment_size=1024)
+		self.assertEqual(blobstore.get_many(self.repo, self.sha,
+			[self.time(1), self.time(2)]), ["one", "again"])
+
+	def test006_corrupt_blob_not_read(self):
+		self.blobstore.put(self.repo, self.sha, self.time(1), "one")
+		with open(self.segment(), "r+b") as f:
+			f.seek(-1, os.SEEK_END)
+			f.write("x")
+		with self.assertRaises(IOError):
+			self.blobstore.get_many(self.repo, self.sha, [self.time(1)])
+
+
+# Pushing revisions of many resources at once
+class Batch(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/batch"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-quads"}
+	params = {'datetime': "2015-01-01-00:00:00"}
+	params2 = {'datetime': "2015-01-02-00:00:00"}
+
+	payload = "\n".join([
+		"<http://example.org/s> <http://example.org/p> <http://example.org/o> <http://example.org/a> .",
+		"<http://example.org/s> <http://example.org/p> <http://example.org/o> <http://example.org/b> ."])
+	payload2 = "\n".join([
+		"<http://example.org/s> <http://example.org/p> <http://example.org/o2> <http://example.org/a> .",
+		"<http://example.org/s> <http://example.org/p> <http://example.org/o> <http://example.org/b> ."])
+
+	def test000_post(self):
+		r = requests.post(self.apiURI, params=self.params, headers=self.header, data=self.payload)
+		self.assertEqual(r.status_code, 200)
+		result = r.json()
+		self.assertEqual(result["keys"], {"http://example.org/a": "saved", "http://example.org/b": "saved"})
+		self.assertEqual((result["saved"], result["unchanged"], result["failed"]), (2, 0, 0))
+
+	def test001_post_changes(self):
+		r = requests.post(self.apiURI, params=self.params2, headers=self.header, data=self.payload2)
+		self.assertEqual(r.status_code, 200)
+		result = r.json()
+		self.assertEqual(result["keys"], {"http://example.org/a": "saved", "http://example.org/b": "unchanged"})
+		self.assertEqual((result["saved"], result["unchanged"], result["failed"]), (1, 1, 0))
+
+	def test002_get_saved(self):
+		r = requests.get(self.apiURI, params={'key': "http://example.org/a", 'datetime': "2015-01-01-12:00:00"})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.text.strip(), "<http://example.org/s> <http://example.org/p> <http://example.org/o> .")
+
+	def test003_post_not_nquads(self):
+		header = dict(self.header, **{'Content-Type': "text/turtle"})
+		r = requests.post(self.apiURI, params=self.params, headers=header, data=self.payload)
+		self.assertEqual(r.status_code, 415)
+
+
+# Validators and caching headers of mementos
+class Caching(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/caching"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/caching"
+	params = {'key': key, 'datetime': "2015-01-01-00:00:00"}
+	params2 = {'key': key, 'datetime': "2015-01-03-00:00:00"}
+	params_inbetween = {'key': key, 'datetime': "2015-01-02-00:00:00"}
+	params_latest = {'key': key}
+	modified = "Thu, 01 Jan 2015 00:00:00 GMT"
+
+	payload = "<http://example.org/s> <http://example.org/p> <http://example.org/o> ."
+	payload2 = "<http://example.org/s> <http://example.org/p> <http://example.org/o2> ."
+	payload3 = "<http://example.org/s> <http://example.org/p> <http://example.org/o3> ."
+
+	def test000_put(self):
+		r = requests.put(self.apiURI, params=self.params, headers=self.header, data=self.payload)
+		self.assertEqual(r.status_code, 200)
+		r = requests.put(self.apiURI, params=self.params2, headers=self.header, data=self.payload2)
+		self.assertEqual(r.status_code, 200)
+
+	def test010_memento_headers(self):
+		r = requests.get(self.apiURI, params=self.params)
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue(r.headers.get("ETag"))
+		self.assertEqual(r.headers.get("Last-Modified"), self.modified)
+		self.assertEqual(r.headers.get("Cache-Control"), "public, max-age=31536000")
+
+	def test011_latest_memento_not_cached(self):
+		r = requests.get(self.apiURI, params=self.params_latest)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers.get("Cache-Control"), "no-cache")
+
+	def test012_etag_per_memento(self):
+		r = requests.get(self.apiURI, params=self.params)
+		r2 = requests.get(self.apiURI, params=self.params2)
+		self.assertNotEqual(r.headers.get("ETag"), r2.headers.get("ETag"))
+
+	def test013_etag_per_content_coding(self):
+		r = requests.get(self.apiURI, params=self.params, headers={'Accept-Encoding': "identity"})
+		r2 = requests.get(self.apiURI, params=self.params, headers={'Accept-Encoding': "gzip"})
+		self.assertEqual(r2.headers.get("Content-Encoding"), "gzip")
+		self.assertNotEqual(r.headers.get("ETag"), r2.headers.get("ETag"))
+		self.assertEqual(r.text, r2.text)
+
+	def test020_if_none_match(self):
+		etag = requests.get(self.apiURI, params=self.params).headers.get("ETag")
+		r = requests.get(self.apiURI, params=self.params, headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 304)
+		self.assertEqual(r.text, "")
+		r = requests.get(self.apiURI, params=self.params, headers={'If-None-Match': '"other"'})
+		self.assertEqual(r.status_code, 200)
+
+	def test021_if_modified_since(self):
+		r = requests.get(self.apiURI, params=self.params, headers={'If-Modified-Since': self.modified})
+		self.assertEqual(r.status_code, 304)
+		r = requests.get(self.apiURI, params=self.params, headers={'If-Modified-Since': "Wed, 31 Dec 2014 00:00:00 GMT"})
+		self.assertEqual(r.status_code, 200)
+
+	def test022_head_if_none_match(self):
+		etag = requests.head(self.apiURI, params=self.params).headers.get("ETag")
+		r = requests.head(self.apiURI, params=self.params, headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 304)
+
+	def test030_insert_changes_etag(self):
+		etag = requests.get(self.apiURI, params=self.params).headers.get("ETag")
+		r = requests.put(self.apiURI, params=self.params_inbetween, headers=self.header, data=self.payload3)
+		self.assertEqual(r.status_code, 200)
+		r = requests.get(self.apiURI, params=self.params, headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 200)
+
+	def test031_recreate_changes_etag(self):
+		etag = requests.get(self.apiURI, params=self.params).headers.get("ETag")
+		for params in (self.params2, self.params_inbetween, self.params):
+			r = requests.delete(self.apiURI, params=dict(params, update="true"), headers=self.header)
+			self.assertEqual(r.status_code, 200)
+		r = requests.put(self.apiURI, params=self.params, headers=self.header, data=self.payload2)
+		self.assertEqual(r.status_code, 200)
+		r = requests.get(self.apiURI, params=self.params, headers={'If-None-Match': etag})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.text.strip(), self.payload2)
+
+	@staticmethod
+	def deflate_state(n):
+		# the second state is stored as a delta
+		return set(['<http://example.org/s> <http://example.org/p%d> "%d" .' % (i, i) for i in range(50)] +
+			['<http://example.org/s> <http://example.org/n> "%d" .' % n])
+
+	def get_deflate(self, datestr, etag=None):
+		headers = {'Accept-Encoding': "deflate"}
+		if etag:
+			headers['If-None-Match'] = etag
+		return requests.get(self.apiURI, params={'key': self.key + "/deflate", 'datetime': datestr},
+			headers=headers, stream=True)
+
+	def test040_deflate_passed_through(self):
+		for n, datestr in enumerate(("2015-01-01-00:00:00", "2015-01-02-00:00:00")):
+			r = requests.put(self.apiURI, params={'key': self.key + "/deflate", 'datetime': datestr},
+				headers=self.header, data="\n".join(self.deflate_state(n)))
+			self.assertEqual(r.status_code, 200)
+		passthrough = requests.get("http://localhost:5000/api/_stats").json().get("revisions.passthrough", 0)
+		r = self.get_deflate("2015-01-01-00:00:00")
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers.get("Content-Encoding"), "deflate")
+		self.assertEqual(requests.get("http://localhost:5000/api/_stats").json()["revisions.passthrough"], passthrough + 1)
+		body = zlib.decompress(r.raw.read(decode_content=False))
+		r2 = requests.get(self.apiURI, params={'key': self.key + "/deflate", 'datetime': "2015-01-01-00:00:00"},
+			headers={'Accept-Encoding': "identity"})
+		self.assertEqual(set(body.splitlines()), set(r2.content.splitlines()))
+		self.assertEqual(set(body.splitlines()), self.deflate_state(0))
+		etag = r.headers.get("ETag")
+		self.assertTrue(etag.endswith('-deflate"'))
+		r = self.get_deflate("2015-01-01-00:00:00", etag)
+		self.assertEqual(r.status_code, 304)
+
+	def test041_deflate_recompressed(self):
+		r = self.get_deflate("2015-01-02-00:00:00")
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers.get("Content-Encoding"), "deflate")
+		self.assertEqual(set(zlib.decompress(r.raw.read(decode_content=False)).splitlines()), self.deflate_state(1))
+		etag = r.headers.get("ETag")
+		self.assertTrue(etag.endswith('-deflate-recompressed"'))
+		r = self.get_deflate("2015-01-02-00:00:00", etag)
+		self.assertEqual(r.status_code, 304)
+
+
+# Blobs are compressed with a dictionary trained from the repo's snapshots
+class Dictionaries(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/dictionaries"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	params = {'datetime': "2015-01-01-00:00:00"}
+	params2 = {'datetime': "2015-01-02-00:00:00"}
+
+	@classmethod
+	def setUpClass(cls):
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="dictionaries", desc="")
+
+	@staticmethod
+	def key(n):
+		return "http://example.org/dictionaries/%d" % n
+
+	@classmethod
+	def payload(cls, n, version):
+		return "\n".join(['<%s> <http://xmlns.com/foaf/0.1/%s> "%s of %d (%d)" .' % (cls.key(n), p, p, n, version)
+			for p in ("name", "nick", "title", "homepage", "mbox", "phone")])
+
+	def blob(self, n, datestr):
+		sha = hashlib.sha1(self.key(n)).digest()
+		ts = datetime.datetime.strptime(datestr, "%Y-%m-%d-%H:%M:%S")
+		return Blob.get(Blob.repo == self.repo, Blob.hkey == sha, Blob.time == ts).data
+
+	def test000_put(self):
+		for n in range(20):
+			r = requests.put(self.apiURI, params=dict(self.params, key=self.key(n)), headers=self.header, data=self.payload(n, 1))
+			self.assertEqual(r.status_code, 200)
+		self.assertEqual(compression.ENVELOPE.unpack_from(self.blob(0, self.params['datetime'])),
+			(2, compression.ZLIB, 0))
+
+	def test001_train(self):
+		version, current_len, new_len = revision_logic.train_dictionary(self.repo)
+		self.assertEqual(version, 1)
+		self.assertTrue(new_len < current_len)
+		self.assertEqual(Repo.get(Repo.id == self.repo.id).zdict, 1)
+
+	def test002_put_with_dictionary(self):
+		for n in range(20):
+			r = requests.put(self.apiURI, params=dict(self.params2, key=self.key(n)), headers=self.header, data=self.payload(n, 2))
+			self.assertEqual(r.status_code, 200)
+		self.assertEqual(compression.ENVELOPE.unpack_from(self.blob(0, self.params2['datetime'])),
+			(2, compression.ZLIB, 1))
+
+	def test003_get_before_and_after_training(self):
+		for n in range(20):
+			for params, version in ((self.params, 1), (self.params2, 2)):
+				r = requests.get(self.apiURI, params=dict(params, key=self.key(n)))
+				self.assertEqual(r.status_code, 200)
+				self.assertEqual(set(r.text.splitlines()), set(self.payload(n, version).splitlines()))
+
+
+# Small changes are stored as deltas, new states as snapshots
+class Estimates(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/estimates"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/estimates"
+	times = ["2015-01-01-00:00:00", "2015-01-02-00:00:00", "2015-01-03-00:00:00"]
+
+	@classmethod
+	def setUpClass(cls):
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="estimates", desc="")
+
+	@staticmethod
+	def state(name, changed=None):
+		return ['<http://example.org/%s> <http://example.org/p%d> "%s %d" .' % (name, i, name, i == changed and -1 or i)
+			for i in range(50)]
+
+	def put(self, n, lines):
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': self.times[n]}, headers=self.header, data="\n".join(lines))
+		self.assertEqual(r.status_code, 200)
+		ts = datetime.datetime.strptime(self.times[n], "%Y-%m-%d-%H:%M:%S")
+		return Authorized.getCSetForRepoAtTime(self.repo, ts, self.key).type
+
+	def test000_first_state_is_snapshot(self):
+		self.assertEqual(self.put(0, self.state("a")), CSet.SNAPSHOT)
+
+	def test001_small_change_is_delta(self):
+		self.assertEqual(self.put(1, self.state("a", 7)), CSet.DELTA)
+
+	def test002_new_state_is_snapshot(self):
+		self.assertEqual(self.put(2, self.state("b")), CSet.SNAPSHOT)
+
+	def test003_get(self):
+		for n, lines in enumerate([self.state("a"), self.state("a", 7), self.state("b")]):
+			r = requests.get(self.apiURI, params={'key': self.key, 'datetime': self.times[n]})
+			self.assertEqual(set(r.text.splitlines()), set(lines))
+
+
+# Mementos and deltas are reconstructed from the chain fetched along with its
+# blobs, with the forward and the skip-delta layout
+class Chains(unittest.TestCase):
+
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/chains"
+	layouts = {"chains": Repo.FORWARD, "chains_skip": Repo.SKIP}
+
+	@classmethod
+	def setUpClass(cls):
+		for name, layout in cls.layouts.iteritems():
+			Repo.create(user=User.get(User.name == "user1"), name=name, desc="", layout=layout)
+
+	@staticmethod
+	def uri(name):
+		return "http://localhost:5000/api/user1/" + name
+
+	@staticmethod
+	def datestr(n):
+		return "2015-01-%02d-00:00:00" % (n + 1)
+
+	@staticmethod
+	def state(n):
+		# every revision adds a statement to the previous one
+		return ['<http://example.org/chains> <http://example.org/p%d> "%d" .' % (i, i)
+			for i in range(50 + n)]
+
+	def test000_put(self):
+		for name in self.layouts:
+			for n in range(6):
+				r = requests.put(self.uri(name), params={'key': self.key, 'datetime': self.datestr(n)},
+					headers=self.header, data="\n".join(self.state(n)))
+				self.assertEqual(r.status_code, 200)
+
+	def test001_get(self):
+		for name in self.layouts:
+			for n in range(6):
+				r = requests.get(self.uri(name), params={'key': self.key, 'datetime': self.datestr(n)})
+				self.assertEqual(r.status_code, 200)
+				self.assertEqual(set(r.text.splitlines()), set(self.state(n)))
+
+	def test002_delta_of_memento(self):
+		for name in self.layouts:
+			for n in range(1, 6):
+				r = requests.get(self.uri(name), params={'key': self.key, 'datetime': self.datestr(n), 'delta': "true"})
+				self.assertEqual(r.status_code, 200)
+				self.assertEqual(r.text.splitlines(), ["A " + self.state(n)[-1]])
+
+	def test003_delta_between_mementos(self):
+		for name in self.layouts:
+			r = requests.get(self.uri(name), params={'key': self.key, 'datetime': self.datestr(5), 'delta': self.datestr(1)})
+			self.assertEqual(r.status_code, 200)
+			self.assertEqual(set(r.text.splitlines()),
+				set(map(lambda s: "A " + s, self.state(5)[51:])))
+
+
+# The neighbors and the commit message of a memento are fetched along with it
+class Neighbors(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/neighbors"
+	webURI = "http://localhost:5000/user1/neighbors"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/neighbors"
+	times = ["2015-01-01-00:00:00", "2015-01-02-00:00:00", "2015-01-03-00:00:00", "2015-01-04-00:00:00"]
+	rfc_times = ["Thu, 01 Jan 2015 00:00:00 GMT", "Fri, 02 Jan 2015 00:00:00 GMT",
+		"Sat, 03 Jan 2015 00:00:00 GMT", "Sun, 04 Jan 2015 00:00:00 GMT"]
+	message = "second revision of neighbors"
+
+	@classmethod
+	def setUpClass(cls):
+		Repo.create(user=User.get(User.name == "user1"), name="neighbors", desc="")
+
+	def links(self, n):
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': self.times[n]})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers.get("Memento-Datetime"), self.rfc_times[n])
+		link_header = parse_link_header(r.headers['Link'])
+		return dict((rel, Authorized.get_datetime_for_memento_rel(link_header, rel))
+			for rel in ("first", "prev", "next", "last"))
+
+	def test000_put(self):
+		for n, datestr in enumerate(self.times):
+			params = {'key': self.key, 'datetime': datestr}
+			if n == 1:
+				params['m'] = self.message
+			r = requests.put(self.apiURI, params=params, headers=self.header,
+				data='<http://example.org/neighbors> <http://example.org/p> "%d" .' % n)
+			self.assertEqual(r.status_code, 200)
+
+	def test001_first_memento(self):
+		links = self.links(0)
+		self.assertEqual(links["first"], [self.rfc_times[0]])
+		self.assertEqual(links["prev"], None)
+		self.assertEqual(links["next"], [self.rfc_times[1]])
+		self.assertEqual(links["last"], [self.rfc_times[3]])
+
+	def test002_memento_in_between(self):
+		links = self.links(2)
+		self.assertEqual(links["first"], [self.rfc_times[0]])
+		self.assertEqual(links["prev"], [self.rfc_times[1]])
+		self.assertEqual(links["next"], [self.rfc_times[3]])
+		self.assertEqual(links["last"], [self.rfc_times[3]])
+
+	def test003_last_memento(self):
+		links = self.links(3)
+		self.assertEqual(links["first"], [self.rfc_times[0]])
+		self.assertEqual(links["prev"], [self.rfc_times[2]])
+		self.assertEqual(links["next"], None)
+		self.assertEqual(links["last"], [self.rfc_times[3]])
+
+	def test004_between_mementos(self):
+		# The memento in effect at a time without a cset of its own
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': "2015-01-02-12:00:00"})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers.get("Memento-Datetime"), self.rfc_times[1])
+		link_header = parse_link_header(r.headers['Link'])
+		self.assertEqual(Authorized.get_datetime_for_memento_rel(link_header, "next"), [self.rfc_times[2]])
+
+	def test005_before_first_memento(self):
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': "2014-12-31-00:00:00"})
+		self.assertEqual(r.status_code, 404)
+
+	def test010_commit_message(self):
+		r = requests.get(self.webURI, params={'key': self.key, 'datetime': self.times[1]})
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue(self.message in r.text)
+		r = requests.get(self.webURI, params={'key': self.key, 'datetime': self.times[2]})
+		self.assertEqual(r.status_code, 200)
+		self.assertFalse(self.message in r.text)
+
+
+# Timemaps of resources with many mementos are paged, closed pages are cached
+class Timemaps(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/timemaps"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/timemaps"
+	start = datetime.datetime(2015, 1, 1)
+	count = 2 * revision_logic.TIMEMAP_PAGE_SIZE + 500
+
+	@classmethod
+	def setUpClass(cls):
+		# a memento per minute, imported directly rather than pushed one by one
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="timemaps", desc="")
+		history = [(cls.time(n), revision_logic.parse_canonical(
+			'<http://example.org/timemaps> <http://example.org/p> "%d" .' % n))
+			for n in range(cls.count)]
+		revision_logic.import_revisions(cls.repo, {cls.key: history})
+
+	@classmethod
+	def time(cls, n):
+		return cls.start + datetime.timedelta(minutes=n)
+
+	@staticmethod
+	def stats():
+		return requests.get("http://localhost:5000/api/_stats").json()
+
+	def page(self, url=None, params={}):
+		r = requests.get(url or self.apiURI, params=url == None and dict(params, key=self.key, timemap="true") or {},
+			headers={'Accept': "application/json"})
+		self.assertEqual(r.status_code, 200)
+		links = parse_link_header(r.headers.get('Link')) or {}
+		rels = dict((rel, uri) for uri, v in links.items() for rel in v['rel'])
+		times = map(lambda m: datetime.datetime.strptime(m["datetime"], "%Y-%m-%dT%H:%M:%S"),
+			r.json()["mementos"]["list"])
+		return times, rels.get("prev"), rels.get("next"), r.text
+
+	def test000_latest_page(self):
+		times, prev, next, body = self.page()
+		self.assertEqual(len(times), revision_logic.TIMEMAP_PAGE_SIZE)
+		self.assertEqual(times[0], self.time(self.count - 1))
+		self.assertEqual(times, sorted(times, reverse=True))
+		self.assertEqual(prev, None)
+		self.assertTrue(next)
+
+	def test001_follow_next(self):
+		times = []
+		prev = None
+		next = "first"
+		pages = 0
+		while next:
+			page, prev, next, body = self.page(next != "first" and next or None)
+			times += page
+			pages += 1
+		self.assertEqual(pages, 3)
+		self.assertEqual(times, [self.time(n) for n in reversed(range(self.count))])
+		# the oldest page links back to newer mementos
+		self.assertTrue(prev)
+		page, prev, next, body = self.page(prev)
+		self.assertEqual(page[-1], self.time(500))
+		self.assertEqual(len(page), revision_logic.TIMEMAP_PAGE_SIZE)
+
+	def test002_link_format(self):
+		r = requests.get(self.apiURI, params={'key': self.key, 'timemap': "true"},
+			headers={'Accept': "application/link-format"})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.text.count('rel="memento'), revision_logic.TIMEMAP_PAGE_SIZE)
+		self.assertTrue('rel="memento last"' in r.text)
+		self.assertTrue('rel="next"' in r.text)
+
+	def test010_closed_page_cached(self):
+		before = self.time(self.count - revision_logic.TIMEMAP_PAGE_SIZE).isoformat().replace("T", "-")
+		times, prev, next, body = self.page(params={'before': before})
+		hits = self.stats().get("timemaps.hits", 0)
+		times2, prev2, next2, body2 = self.page(params={'before': before})
+		self.assertEqual(self.stats().get("timemaps.hits", 0), hits + 1)
+		self.assertEqual(body2, body)
+		self.assertEqual(times2[0], self.time(self.count - revision_logic.TIMEMAP_PAGE_SIZE - 1))
+
+	def test011_insert_invalidates_cached_page(self):
+		before = self.time(self.count - revision_logic.TIMEMAP_PAGE_SIZE).isoformat().replace("T", "-")
+		self.page(params={'before': before})
+		inserted = self.time(self.count - revision_logic.TIMEMAP_PAGE_SIZE - 2) + datetime.timedelta(seconds=30)
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': inserted.isoformat().replace("T", "-")},
+			headers=self.header, data='<http://example.org/timemaps> <http://example.org/p> "inserted" .')
+		self.assertEqual(r.status_code, 200)
+		times, prev, next, body = self.page(params={'before': before})
+		self.assertTrue(inserted in times)
+		self.assertEqual(len(times), revision_logic.TIMEMAP_PAGE_SIZE)
+
+	def test012_misses(self):
+		before = self.time(self.count - revision_logic.TIMEMAP_PAGE_SIZE - 1).isoformat().replace("T", "-")
+		stats = self.stats()
+		times, prev, next, body = self.page(params={'before': before})
+		stats2 = self.stats()
+		self.assertTrue(stats2["timemaps.misses"] > stats.get("timemaps.misses", 0))
+		self.assertEqual(stats2.get("timemaps.hits", 0), stats.get("timemaps.hits", 0))
+		self.page(params={'before': before})
+		stats3 = self.stats()
+		self.assertEqual(stats3["timemaps.hits"], stats2.get("timemaps.hits", 0) + 1)
+		self.assertEqual(stats3["timemaps.misses"], stats2["timemaps.misses"])
+		self.assertTrue(stats3["timemaps.entries"] > 0)
+		self.assertTrue(stats3["timemaps.bytes"] > 0)
+
+	def test013_evictions(self):
+		# the cache of this process, whose metrics are those /api/_stats
+		# reports for server processes
+		cache = revision_logic.timemaps
+		max_bytes = cache.max_bytes
+		page, edits = revision_logic.get_cached_timemap_page(self.repo, self.key, "page")
+		revision_logic.cache_timemap_page(self.repo, self.key, "page", "body", 4, edits)
+		self.assertEqual(revision_logic.get_cached_timemap_page(self.repo, self.key, "page"), ("body", edits))
+		evictions = metrics.snapshot().get("timemaps.evictions", 0)
+		entries = len(cache.entries)
+		try:
+			cache.resize(0)
+		finally:
+			cache.resize(max_bytes)
+		self.assertEqual(metrics.snapshot()["timemaps.evictions"], evictions + entries)
+		self.assertEqual(revision_logic.get_cached_timemap_page(self.repo, self.key, "page"), (None, edits))
+
+
+# The latest cset of each resource is maintained by all write paths
+class Heads(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/heads"
+	webURI = "http://localhost:5000/user1/heads"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+
+	@classmethod
+	def setUpClass(cls):
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="heads", desc="")
+
+	@staticmethod
+	def key(name):
+		return "http://example.org/heads/" + name
+
+	def put(self, name, datestr, value):
+		r = requests.put(self.apiURI, params={'key': self.key(name), 'datetime': datestr}, headers=self.header,
+			data='<%s> <http://example.org/p> "%s" .' % (self.key(name), value))
+		self.assertEqual(r.status_code, 200)
+
+	def delete(self, name, datestr, update=False):
+		params = {'key': self.key(name), 'datetime': datestr}
+		if update:
+			params['update'] = "true"
+		r = requests.delete(self.apiURI, params=params, headers=self.header)
+		self.assertEqual(r.status_code, 200)
+
+	def heads(self):
+		return dict((str(h.hkey_id), (h.time, h.type)) for h in
+			Head.select().where(Head.repo == self.repo))
+
+	def head(self, name):
+		return self.heads().get(hashlib.sha1(self.key(name)).digest())
+
+	def index(self):
+		r = requests.get(self.apiURI, params={'index': "true"}, headers={'Accept': "text/plain"})
+		self.assertEqual(r.status_code, 200)
+		return set(r.text.splitlines())
+
+	def test000_put(self):
+		for name in ("a", "b", "c"):
+			self.put(name, "2015-01-02-00:00:00", name)
+		self.assertEqual(self.head("a"), (datetime.datetime(2015, 1, 2), CSet.SNAPSHOT))
+		self.assertEqual(self.index(), set(map(self.key, ("a", "b", "c"))))
+
+	def test001_append(self):
+		self.put("a", "2015-01-03-00:00:00", "a2")
+		self.assertEqual(self.head("a")[0], datetime.datetime(2015, 1, 3))
+
+	def test002_insert_before_head(self):
+		self.put("a", "2015-01-01-00:00:00", "a0")
+		self.assertEqual(self.head("a")[0], datetime.datetime(2015, 1, 3))
+
+	def test003_delete(self):
+		self.delete("b", "2015-01-03-00:00:00")
+		self.assertEqual(self.head("b"), (datetime.datetime(2015, 1, 3), CSet.DELETE))
+		self.assertEqual(self.index(), set(map(self.key, ("a", "c"))))
+
+	def test004_remove_head(self):
+		self.delete("a", "2015-01-03-00:00:00", True)
+		self.assertEqual(self.head("a")[0], datetime.datetime(2015, 1, 2))
+		self.delete("b", "2015-01-03-00:00:00", True)
+		self.assertEqual(self.head("b"), (datetime.datetime(2015, 1, 2), CSet.SNAPSHOT))
+		self.assertEqual(self.index(), set(map(self.key, ("a", "b", "c"))))
+
+	def test005_remove_only_cset(self):
+		self.delete("c", "2015-01-02-00:00:00", True)
+		self.assertEqual(self.head("c"), None)
+		self.assertEqual(self.index(), set(map(self.key, ("a", "b"))))
+
+	def test010_same_as_rebuilt(self):
+		heads = self.heads()
+		revision_logic.rebuild_heads(self.repo)
+		self.assertEqual(self.heads(), heads)
+
+	def test020_web_index(self):
+		r = requests.get(self.webURI, params={'index': "true"})
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue('Keys <span class="text-muted">(2)</span>' in r.text)
+		self.assertTrue(self.key("a") in r.text)
+		self.assertFalse(self.key("c") in r.text)
+
+	def test021_web_samples(self):
+		r = requests.get(self.webURI)
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue(self.key("a") in r.text)
+		self.assertTrue(self.key("b") in r.text)
+
+
+# Indexes at past times are served from the lifetimes of the resources, also
+# after changes in the middle of their histories
+class Index(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/index"
+	pagesURI = "http://localhost:5000/api/user1/index_pages"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	count = 2 * revision_logic.INDEX_PAGE_SIZE + 500
+	# resources existing at the start of each day
+	expected = {
+		"2015-01-01-00:00:00": "c",
+		"2015-01-02-00:00:00": "ac",
+		"2015-01-03-00:00:00": "abcd",
+		"2015-01-04-00:00:00": "cd",
+		"2015-01-05-00:00:00": "bcd",
+		"2015-01-06-00:00:00": "abcd",
+	}
+
+	@classmethod
+	def setUpClass(cls):
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="index", desc="")
+		# many resources, the first ones created a day before the others
+		repo = Repo.create(user=User.get(User.name == "user1"), name="index_pages", desc="")
+		revision_logic.import_revisions(repo, dict((cls.page_key(n), [(
+			datetime.datetime(2015, 1, n < cls.count - 1000 and 1 or 3),
+			revision_logic.parse_canonical('<%s> <http://example.org/p> "%d" .' % (cls.page_key(n), n)))])
+			for n in range(cls.count)))
+
+	@staticmethod
+	def key(name):
+		return "http://example.org/index/" + name
+
+	@staticmethod
+	def page_key(n):
+		return "http://example.org/index_pages/%d" % n
+
+	@staticmethod
+	def datestr(day):
+		return "2015-01-%02d-00:00:00" % day
+
+	def put(self, name, day):
+		r = requests.put(self.apiURI, params={'key': self.key(name), 'datetime': self.datestr(day)}, headers=self.header,
+			data='<%s> <http://example.org/p> "%d" .' % (self.key(name), day))
+		self.assertEqual(r.status_code, 200)
+
+	def delete(self, name, day, update=False):
+		params = {'key': self.key(name), 'datetime': self.datestr(day)}
+		if update:
+			params['update'] = "true"
+		r = requests.delete(self.apiURI, params=params, headers=self.header)
+		self.assertEqual(r.status_code, 200)
+
+	def index(self, uri, params):
+		r = requests.get(uri, params=dict(params, index="true"), headers={'Accept': "text/plain"})
+		self.assertEqual(r.status_code, 200)
+		links = parse_link_header(r.headers.get('Link')) or {}
+		next = [link for link, v in links.items() if "next" in v['rel']]
+		return r.text.splitlines(), next and next[0] or None
+
+	def spans(self):
+		return sorted((str(s.hkey_id), s.since, s.until) for s in
+			Span.select().where(Span.repo == self.repo))
+
+	def test000_push(self):
+		self.put("a", 2)
+		self.delete("a", 4)
+		self.put("a", 6)
+		self.put("b", 3)
+		self.put("b", 5)
+		self.put("c", 5)
+		self.put("d", 2)
+		self.put("d", 3)
+
+	def test001_insert_in_the_middle(self):
+		# before the first cset, a delete between csets and the removal of
+		# the first cset
+		self.put("c", 1)
+		self.delete("b", 4)
+		self.delete("d", 2, True)
+
+	def test002_index_at_past_times(self):
+		for datestr, names in self.expected.iteritems():
+			keys, next = self.index(self.apiURI, {'datetime': datestr})
+			self.assertEqual(set(keys), set(map(self.key, names)), datestr)
+			self.assertEqual(next, None)
+
+	def test003_current_index(self):
+		keys, next = self.index(self.apiURI, {})
+		self.assertEqual(set(keys), set(map(self.key, "abcd")))
+
+	def test004_same_as_rebuilt(self):
+		spans = self.spans()
+		revision_logic.rebuild_spans(self.repo)
+		self.assertEqual(self.spans(), spans)
+
+	def span(self, name):
+		return [(s.since, s.until) for s in Span.select().where(
+			(Span.repo == self.repo) & (Span.hkey == hashlib.sha1(self.key(name)).digest()))]
+
+	def test005_delete_keeps_since(self):
+		self.put("e", 7)
+		self.delete("e", 9)
+		self.assertEqual(self.span("e"), [(datetime.datetime(2015, 1, 7), datetime.datetime(2015, 1, 9))])
+		# the delete is removed again
+		self.delete("e", 9, True)
+		self.assertEqual(self.span("e"), [(datetime.datetime(2015, 1, 7), None)])
+
+	def test006_imported_delete_keeps_since(self):
+		key = self.key("f")
+		stmts = revision_logic.parse_canonical('<%s> <http://example.org/p> "f" .' % key)
+		revision_logic.import_revisions(self.repo, {key: [(datetime.datetime(2015, 1, 7), stmts)]})
+		revision_logic.import_revisions(self.repo, {key: [(datetime.datetime(2015, 1, 7), stmts),
+			(datetime.datetime(2015, 1, 9), None)]})
+		self.assertEqual(self.span("f"), [(datetime.datetime(2015, 1, 7), datetime.datetime(2015, 1, 9))])
+
+	def test010_follow_next(self):
+		keys = []
+		page, next = self.index(self.pagesURI, {})
+		while True:
+			self.assertEqual(page, sorted(page, key=lambda k: hashlib.sha1(k).digest()))
+			keys += page
+			if not next:
+				break
+			page, next = self.index(next, {})
+		self.assertEqual(len(keys), self.count)
+		self.assertEqual(set(keys), set(map(self.page_key, range(self.count))))
+
+	def test011_follow_next_at_past_time(self):
+		page, next = self.index(self.pagesURI, {'datetime': self.datestr(2)})
+		self.assertEqual(len(page), revision_logic.INDEX_PAGE_SIZE)
+		self.assertTrue("datetime=" + self.datestr(2) in next)
+		page2, next = self.index(next, {})
+		self.assertEqual(next, None)
+		self.assertEqual(set(page + page2), set(map(self.page_key, range(self.count - 1000))))
+
+	def test012_numbered_pages(self):
+		page, next = self.index(self.pagesURI, {})
+		page2, next = self.index(next, {})
+		numbered, next = self.index(self.pagesURI, {'page': "2"})
+		self.assertEqual(numbered, page2)
+
+
+# Counters of the csets of each repo, maintained by all write paths
+class Counters(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/counters"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+
+	@classmethod
+	def setUpClass(cls):
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="counters", desc="")
+
+	@staticmethod
+	def key(name):
+		return "http://example.org/counters/" + name
+
+	@staticmethod
+	def state(name, n):
+		return "\n".join(['<http://example.org/counters/%s> <http://example.org/p%d> "%d" .' % (name, i, i)
+			for i in range(30 + n)])
+
+	def put(self, name, datestr, n):
+		r = requests.put(self.apiURI, params={'key': self.key(name), 'datetime': datestr},
+			headers=self.header, data=self.state(name, n))
+		self.assertEqual(r.status_code, 200)
+
+	def delete(self, name, datestr, update=False):
+		params = {'key': self.key(name), 'datetime': datestr}
+		if update:
+			params['update'] = "true"
+		r = requests.delete(self.apiURI, params=params, headers=self.header)
+		self.assertEqual(r.status_code, 200)
+
+	def counter(self):
+		counter = Counter.select().where(Counter.repo == self.repo.id).first() or Counter(repo=self.repo.id)
+		return dict((k, getattr(counter, k)) for k in ("resources", "snapshots", "deltas", "deletes", "bytes"))
+
+	def totals(self):
+		# the counters as computed from the csets
+		csets = list(CSet.select().where(CSet.repo == self.repo))
+		return {
+			"resources": len(set(map(lambda c: str(c.hkey_id), csets))),
+			"snapshots": len(filter(lambda c: c.type == CSet.SNAPSHOT, csets)),
+			"deltas": len(filter(lambda c: c.type == CSet.DELTA, csets)),
+			"deletes": len(filter(lambda c: c.type == CSet.DELETE, csets)),
+			"bytes": sum(map(lambda c: c.len, csets)),
+		}
+
+	def test000_put(self):
+		for n in range(3):
+			self.put("a", "2015-01-0%d-00:00:00" % (n + 2), n)
+		self.put("b", "2015-01-02-00:00:00", 0)
+		counter = self.counter()
+		self.assertEqual(counter["resources"], 2)
+		self.assertEqual(counter["snapshots"] + counter["deltas"], 4)
+		self.assertEqual(counter, self.totals())
+
+	def test001_insert(self):
+		self.put("a", "2015-01-01-00:00:00", 5)
+		self.put("b", "2015-01-03-12:00:00", 1)
+		self.assertEqual(self.counter(), self.totals())
+
+	def test002_delete(self):
+		self.delete("b", "2015-01-05-00:00:00")
+		self.delete("a", "2015-01-03-12:00:00")
+		counter = self.counter()
+		self.assertEqual(counter["deletes"], 2)
+		self.assertEqual(counter, self.totals())
+
+	def test003_post(self):
+		header = dict(self.header, **{'Content-Type': "application/n-quads"})
+		payload = "\n".join([
+			"<http://example.org/s> <http://example.org/p> <http://example.org/o> <%s> ." % self.key("c"),
+			"<http://example.org/s> <http://example.org/p> <http://example.org/o> <%s> ." % self.key("b")])
+		r = requests.post(self.apiURI, params={'datetime': "2015-01-06-00:00:00"}, headers=header, data=payload)
+		self.assertEqual(r.status_code, 200)
+		counter = self.counter()
+		self.assertEqual(counter["resources"], 3)
+		self.assertEqual(counter, self.totals())
+
+	def test004_remove(self):
+		self.delete("a", "2015-01-03-12:00:00", True)
+		self.delete("c", "2015-01-06-00:00:00", True)
+		counter = self.counter()
+		self.assertEqual(counter["resources"], 2)
+		self.assertEqual(counter, self.totals())
+
+	def test010_same_as_rebuilt(self):
+		counter = self.counter()
+		revision_logic.rebuild_counters()
+		self.assertEqual(self.counter(), counter)
+
+	def test011_statistics_page(self):
+		resources = sum(map(lambda c: c.resources, Counter.select().where(Counter.repo != Counter.ALL)))
+		r = requests.get("http://localhost:5000/statistic")
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue('<span class="counter">%d</span> resources versioned' % resources in r.text)
+
+	def test020_remove_repo(self):
+		revision_logic.remove_repo(self.repo)
+		self.assertEqual(Counter.select().where(Counter.repo == self.repo.id).count(), 0)
+
+
+# Histories imported with `load.py` (bypassing the API) are served as pushed
+class Importer(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/importer"
+	dirURI = "http://localhost:5000/api/user1/importer_dir"
+	times = ["2015-01-01-00:00:00", "2015-01-02-00:00:00", "2015-01-03-00:00:00", "2015-01-04-00:00:00"]
+
+	@classmethod
+	def setUpClass(cls):
+		user = User.get(User.name == "user1")
+		cls.repo = Repo.create(user=user, name="importer", desc="")
+		cls.dir_repo = Repo.create(user=user, name="importer_dir", desc="")
+		cls.tmp = tempfile.mkdtemp()
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.tmp)
+
+	@staticmethod
+	def key(n):
+		return "http://example.org/importer/%d" % n
+
+	@classmethod
+	def history(cls, n, times):
+		# (time, statements or None for a delete) of a resource
+		history = []
+		for i, datestr in enumerate(times):
+			if n == 3 and i == 1:
+				history.append((datestr, None))
+			elif n != 5 or i > 0:
+				history.append((datestr, ['<%s> <http://example.org/p%d> "%d" .' % (cls.key(n), j, j * i)
+					for j in range(20)]))
+		return history
+
+	@classmethod
+	def histories(cls, times):
+		return dict((cls.key(n), cls.history(n, times)) for n in range(10))
+
+	def load(self, name, *args):
+		# run the importer, returns the number of stored csets
+		count = CSet.select().where(CSet.repo == Repo.get(Repo.name == name)).count()
+		self.assertEqual(subprocess.call([sys.executable, os.path.join(parentdir, "load.py"),
+			"user1/" + name] + list(args) + ["--workers", "2", "--batch", "3"], cwd=parentdir), 0)
+		return CSet.select().where(CSet.repo == Repo.get(Repo.name == name)).count() - count
+
+	def stream(self, times):
+		path = os.path.join(self.tmp, "import.tnq")
+		with open(path, "w") as f:
+			for key, history in sorted(self.histories(times).items()):
+				for datestr, stmts in history:
+					if stmts == None:
+						f.write("%s\t<%s>\n" % (datestr, key))
+						continue
+					for stmt in stmts:
+						f.write("%s\t%s <%s> .\n" % (datestr, stmt[:-2], key))
+		return path
+
+	def assertMementos(self, uri, histories):
+		for key, history in histories.items():
+			for datestr, stmts in history:
+				r = requests.get(uri, params={'key': key, 'datetime': datestr})
+				if stmts == None:
+					self.assertEqual(r.status_code, 404)
+				else:
+					self.assertEqual(r.status_code, 200)
+					self.assertEqual(set(r.text.splitlines()), set(stmts))
+			r = requests.get(uri, params={'key': key, 'timemap': "true"}, headers={'Accept': "application/json"})
+			self.assertEqual(len(r.json()["mementos"]["list"]), len(history))
+
+	def test000_import_stream(self):
+		self.assertEqual(self.load("importer", self.stream(self.times[:3])),
+			sum(map(len, self.histories(self.times[:3]).values())))
+
+	def test001_get(self):
+		self.assertMementos(self.apiURI, self.histories(self.times[:3]))
+
+	def test002_import_again(self):
+		self.assertEqual(self.load("importer", self.stream(self.times[:3])), 0)
+
+	def test003_import_later_revisions(self):
+		self.assertEqual(self.load("importer", self.stream(self.times)), 10)
+		self.assertMementos(self.apiURI, self.histories(self.times))
+
+	def test010_import_directory(self):
+		# a dump per time, the resource 3 is missing from the second one
+		path = os.path.join(self.tmp, "dumps")
+		for i, datestr in enumerate(self.times[:3]):
+			os.makedirs(os.path.join(path, datestr, "importer"))
+		for key, history in self.histories(self.times[:3]).items():
+			for datestr, stmts in history:
+				if stmts != None:
+					with open(os.path.join(path, datestr, key[len("http://example.org/"):] + ".nt"), "w") as f:
+						f.write("\n".join(stmts))
+		self.assertEqual(self.load("importer_dir", path, "--prefix", "http://example.org/", "--deletes"),
+			sum(map(len, self.histories(self.times[:3]).values())))
+		self.assertMementos(self.dirURI, self.histories(self.times[:3]))
+
+
+# Requests are served concurrently, writes of the same resource one after another
+class Concurrency(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/concurrency"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/concurrency"
+
+	@classmethod
+	def setUpClass(cls):
+		Repo.create(user=User.get(User.name == "user1"), name="concurrency", desc="")
+
+	@staticmethod
+	def datestr(n):
+		return "2015-01-%02d-00:00:00" % (n + 1)
+
+	@classmethod
+	def state(cls, n, size=20):
+		return ['<%s> <http://example.org/p%d> "%d" .' % (cls.key, i, i * n) for i in range(size)]
+
+	@staticmethod
+	def parallel(fns):
+		# run the functions in threads, returns their results
+		results = [None] * len(fns)
+		def run(i):
+			results[i] = fns[i]()
+		threads = [threading.Thread(target=run, args=(i,)) for i in range(len(fns))]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return results
+
+	def put(self, key, datestr, lines):
+		return lambda: requests.put(self.apiURI, params={'key': key, 'datetime': datestr},
+			headers=self.header, data="\n".join(lines)).status_code
+
+	def test000_concurrent_puts_of_a_key(self):
+		# pushed in no particular order
+		order = [5, 2, 8, 0, 9, 1, 7, 3, 6, 4]
+		results = self.parallel([self.put(self.key, self.datestr(n), self.state(n)) for n in order])
+		self.assertEqual(results, [200] * len(order))
+		for n in range(len(order)):
+			r = requests.get(self.apiURI, params={'key': self.key, 'datetime': self.datestr(n)})
+			self.assertEqual(r.status_code, 200)
+			self.assertEqual(set(r.text.splitlines()), set(self.state(n)))
+		r = requests.get(self.apiURI, params={'key': self.key, 'timemap': "true"}, headers={'Accept': "application/json"})
+		self.assertEqual(len(r.json()["mementos"]["list"]), len(order))
+
+	def test001_concurrent_puts_of_keys(self):
+		keys = [self.key + "/%d" % n for n in range(10)]
+		results = self.parallel([self.put(key, self.datestr(0), ['<%s> <http://example.org/p> "x" .' % key])
+			for key in keys])
+		self.assertEqual(results, [200] * len(keys))
+		for key in keys:
+			r = requests.get(self.apiURI, params={'key': key})
+			self.assertEqual(r.text.strip(), '<%s> <http://example.org/p> "x" .' % key)
+
+	def test002_get_during_large_put(self):
+		done = {}
+		def put():
+			status = self.put(self.key + "/large", self.datestr(0), self.state(1, 50000))()
+			done["put"] = time.time()
+			return status
+		def get():
+			# wait for the large payload being processed
+			time.sleep(0.5)
+			status = requests.get(self.apiURI, params={'key': self.key, 'datetime': self.datestr(0)}).status_code
+			done["get"] = time.time()
+			return status
+		self.assertEqual(self.parallel([put, get]), [200, 200])
+		self.assertTrue(done["get"] < done["put"])
+
+	def test003_executor_metrics(self):
+		stats = requests.get("http://localhost:5000/api/_stats").json()
+		self.assertEqual(stats["executor.queued"], 0)
+		self.assertTrue("executor.running" in stats)
+
+
+# Server processes lock the resources they change, and validate their caches
+# against changes by other processes (here the test itself)
+class Workers(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/workers"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/workers"
+	times = ["2015-01-01-00:00:00", "2015-01-02-00:00:00"]
+
+	@classmethod
+	def setUpClass(cls):
+		cls.repo = Repo.create(user=User.get(User.name == "user1"), name="workers", desc="")
+
+	@classmethod
+	def state(cls, value):
+		return '<%s> <http://example.org/p> "%s" .' % (cls.key, value)
+
+	def get(self, n):
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': self.times[n]})
+		self.assertEqual(r.status_code, 200)
+		return r.text.strip(), r.headers.get("ETag")
+
+	def test000_put(self):
+		for n, value in enumerate(("a", "b")):
+			r = requests.put(self.apiURI, params={'key': self.key, 'datetime': self.times[n]},
+				headers=self.header, data=self.state(value))
+			self.assertEqual(r.status_code, 200)
+
+	def test001_cache_validated_against_edits(self):
+		text, etag = self.get(0)
+		self.assertEqual(self.get(0), (text, etag))
+		self.assertEqual(text, self.state("a"))
+		# replaced by another process
+		ts = datetime.datetime(2015, 1, 1)
+		revision_logic.remove_revision(self.repo, self.key, ts)
+		revision_logic.insert_revision(self.repo, self.key, revision_logic.parse_canonical(self.state("c")), ts)
+		text, etag2 = self.get(0)
+		self.assertEqual(text, self.state("c"))
+		self.assertNotEqual(etag2, etag)
+		self.assertEqual(self.get(1)[0], self.state("b"))
+
+	def test002_put_waits_for_lock(self):
+		name = "%d:%s" % (self.repo.id, hashlib.sha1(self.key).hexdigest())
+		self.assertEqual(database.lock([name], 1), [name])
+		result = {}
+		def put():
+			result["status"] = requests.put(self.apiURI, params={'key': self.key, 'datetime': "2015-01-03-00:00:00"},
+				headers=self.header, data=self.state("d")).status_code
+		thread = threading.Thread(target=put)
+		try:
+			thread.start()
+			time.sleep(1)
+			self.assertTrue(thread.is_alive())
+		finally:
+			database.unlock([name])
+		thread.join()
+		self.assertEqual(result["status"], 200)
+		r = requests.get(self.apiURI, params={'key': self.key})
+		self.assertEqual(r.text.strip(), self.state("d"))
+
+
+# Large payloads are parsed by a process pool, with the same result
+class Parsers(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/parsers"
+	header = {'Authorization':"token 123456", 'Content-Type':"text/turtle"}
+	key = "http://example.org/parsers"
+
+	@classmethod
+	def setUpClass(cls):
+		Repo.create(user=User.get(User.name == "user1"), name="parsers", desc="")
+
+	@staticmethod
+	def turtle(count):
+		return "@prefix ex: <http://example.org/> .\n" + "\n".join(
+			['ex:parsers ex:p%d "%s" .' % (i, "x" * 100) for i in range(count)])
+
+	@staticmethod
+	def ntriples(count):
+		return set(['<http://example.org/parsers> <http://example.org/p%d> "%s" .' % (i, "x" * 100)
+			for i in range(count)])
+
+	@staticmethod
+	def parsed():
+		return requests.get("http://localhost:5000/api/_stats").json().get("parsers.payloads", 0)
+
+	def test000_pool_round_trip(self):
+		nquads = "\n".join(['<http://example.org/s> <http://example.org/p> "%d"@en <http://example.org/%d> .' % (i, i % 3)
+			for i in range(100)])
+		with ProcessPoolExecutor(1) as parsers:
+			joined = parsers.submit(revision_logic.parse_joined, self.turtle(100), "text/turtle").result()
+			self.assertEqual(revision_logic.split(joined), revision_logic.parse(self.turtle(100), "text/turtle"))
+			self.assertEqual(revision_logic.split(joined), self.ntriples(100))
+			graphs = parsers.submit(revision_logic.parse_graphs_joined, nquads).result()
+			self.assertEqual(dict((key, revision_logic.split(joined)) for key, joined in graphs.items()),
+				dict(revision_logic.parse_graphs(nquads)))
+
+	def test001_pool_error(self):
+		with ProcessPoolExecutor(1) as parsers:
+			future = parsers.submit(revision_logic.parse_joined, "ex:parsers ex:p", "text/turtle")
+			with self.assertRaises(revision_logic.RDF.RedlandError) as cm:
+				future.result()
+			self.assertTrue(cm.exception.value)
+
+	def test010_put_large_payload(self):
+		payload = self.turtle(3000)
+		self.assertTrue(len(payload) > 256 * 1024)
+		parsed = self.parsed()
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': "2015-01-01-00:00:00"},
+			headers=self.header, data=payload)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(self.parsed(), parsed + 1)
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': "2015-01-01-00:00:00"})
+		self.assertEqual(set(r.text.splitlines()), self.ntriples(3000))
+
+	def test011_put_small_payload(self):
+		parsed = self.parsed()
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': "2015-01-02-00:00:00"},
+			headers=self.header, data=self.turtle(10))
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(self.parsed(), parsed)
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': "2015-01-02-00:00:00"})
+		self.assertEqual(set(r.text.splitlines()), self.ntriples(10))
+
+	def test012_put_large_invalid_payload(self):
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': "2015-01-03-00:00:00"},
+			headers=self.header, data=self.turtle(3000) + "\nex:parsers ex:p")
+		self.assertEqual(r.status_code, 500)
+		self.assertTrue("Error while parsing payload" in r.reason)
+
+
+# Reconstructed revisions are cached per process (reported by /api/_stats),
+# changes of a history invalidate the cached revisions they affect
+class Revisions(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/revisions"
+	key = "http://example.org/revisions"
+	sha = hashlib.sha1(key).digest()
+
+	@classmethod
+	def setUpClass(cls):
+		cls.user = User.get(User.name == "user1")
+		cls.repo = cls.history("revisions")
+
+	@classmethod
+	def history(cls, name, layout=Repo.FORWARD):
+		# states at hours 0, 2, 4 and 6 (a snapshot followed by deltas)
+		repo = Repo.create(user=cls.user, name=name, desc="", layout=layout)
+		for n in range(4):
+			revision_logic.insert_revision(repo, cls.key, cls.state(n), cls.time(2 * n))
+		return repo
+
+	@staticmethod
+	def time(hour):
+		return datetime.datetime(2015, 1, 1, hour)
+
+	@classmethod
+	def state(cls, n):
+		return set(['<%s> <http://example.org/p%d> "%d" .' % (cls.key, i, i) for i in range(20)] +
+			['<%s> <http://example.org/n> "%d" .' % (cls.key, n)])
+
+	@staticmethod
+	def stats():
+		return requests.get("http://localhost:5000/api/_stats").json()
+
+	def get(self, hour):
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': "2015-01-01-%02d:00:00" % hour},
+			headers={'Accept-Encoding': "identity"})
+		self.assertEqual(r.status_code, 200)
+		return set(r.text.splitlines())
+
+	def revision(self, repo, hour):
+		chain = revision_logic.get_chain_at_ts(repo, self.key, self.time(hour))
+		return revision_logic.get_revision(repo, self.key, chain)
+
+	def base(self, repo, hour):
+		return revision_logic.get_chain_at_ts(repo, self.key, self.time(hour))[0].time
+
+	def cached(self, repo, hour):
+		return (repo.id, self.sha, self.time(hour)) in revision_logic.revisions.entries
+
+	def test000_hits_and_misses(self):
+		stats = self.stats()
+		self.assertEqual(self.get(2), self.state(1))
+		stats2 = self.stats()
+		self.assertEqual(stats2["revisions.misses"], stats.get("revisions.misses", 0) + 1)
+		self.assertEqual(stats2.get("revisions.hits", 0), stats.get("revisions.hits", 0))
+		self.assertEqual(self.get(2), self.state(1))
+		stats3 = self.stats()
+		self.assertEqual(stats3["revisions.hits"], stats2.get("revisions.hits", 0) + 1)
+		self.assertEqual(stats3["revisions.misses"], stats2["revisions.misses"])
+		self.assertTrue(stats3["revisions.entries"] > 0)
+		self.assertTrue(stats3["revisions.bytes"] > 0)
+		self.assertTrue(0 < stats3["revisions.hit_rate"] < 1)
+
+	def test001_evictions(self):
+		# the cache of this process, whose metrics are those /api/_stats
+		# reports for server processes
+		cache = revision_logic.revisions
+		max_bytes = cache.max_bytes
+		evictions = metrics.snapshot().get("revisions.evictions", 0)
+		try:
+			self.revision(self.repo, 4)
+			self.revision(self.repo, 6)
+			# only leave room for the recently used revision
+			entries = len(cache.entries)
+			cache.resize(cache.entries[(self.repo.id, self.sha, self.time(6))][1])
+		finally:
+			cache.resize(max_bytes)
+		self.assertEqual(len(cache.entries), 1)
+		self.assertEqual(metrics.snapshot()["revisions.evictions"], evictions + entries - 1)
+		self.assertFalse(self.cached(self.repo, 4))
+		self.assertTrue(self.cached(self.repo, 6))
+		misses = metrics.value("revisions.misses")
+		self.assertEqual(self.revision(self.repo, 4), self.state(2))
+		self.assertEqual(metrics.value("revisions.misses"), misses + 1)
+
+	def test010_insert_invalidates(self):
+		repo = self.history("revisions_insert")
+		self.assertEqual(self.revision(repo, 2), self.state(1))
+		revision_logic.insert_revision(repo, self.key, self.state(10), self.time(2))
+		self.assertEqual(self.revision(repo, 2), self.state(10))
+		revision_logic.remove_repo(repo)
+
+	def test011_delete_invalidates(self):
+		repo = self.history("revisions_delete")
+		self.assertEqual(self.revision(repo, 4), self.state(2))
+		revision_logic.save_revision_delete(repo, self.key, self.time(4))
+		self.assertEqual(self.revision(repo, 4), set())
+		self.assertEqual(self.revision(repo, 6), self.state(3))
+		revision_logic.remove_repo(repo)
+
+	def test012_remove_invalidates(self):
+		repo = self.history("revisions_remove")
+		self.assertEqual(self.revision(repo, 2), self.state(1))
+		revision_logic.remove_revision(repo, self.key, self.time(2))
+		self.assertFalse(self.cached(repo, 2))
+		self.assertEqual(self.revision(repo, 2), self.state(0))
+		revision_logic.insert_revision(repo, self.key, self.state(10), self.time(2))
+		self.assertEqual(self.revision(repo, 2), self.state(10))
+		revision_logic.remove_repo(repo)
+
+	def test013_rebase_invalidates(self):
+		# the deltas after an insert in the middle of their chain move to
+		# a new one, with the same states
+		repo = self.history("revisions_rebase")
+		self.assertEqual(self.revision(repo, 4), self.state(2))
+		self.assertEqual(self.revision(repo, 6), self.state(3))
+		other = set(['<%s> <http://example.org/other> "%d" .' % (self.key, i) for i in range(30)])
+		revision_logic.insert_revision(repo, self.key, other, self.time(3))
+		self.assertNotEqual(self.base(repo, 6), self.time(0))
+		self.assertEqual(self.revision(repo, 3), other)
+		self.assertEqual(self.revision(repo, 4), self.state(2))
+		self.assertEqual(self.revision(repo, 6), self.state(3))
+		revision_logic.remove_repo(repo)
+
+
+# Pushed N-Triples are parsed in batches while they arrive
+class Streaming(unittest.TestCase):
+
+	apiURI = "http://localhost:5000/api/user1/streaming"
+	header = {'Authorization':"token 123456", 'Content-Type':"application/n-triples"}
+	key = "http://example.org/streaming"
+
+	# several batches of `revision_logic.PARSE_BATCH_SIZE`
+	lines = ['<http://example.org/s> <http://example.org/p%d> "%s" .' % (i, "x" * 100)
+		for i in range(4000)]
+
+	@classmethod
+	def setUpClass(cls):
+		Repo.create(user=User.get(User.name == "user1"), name="streaming", desc="")
+
+	@staticmethod
+	def chunks(payload, size=16384):
+		for i in range(0, len(payload), size):
+			yield payload[i:i + size]
+
+	def put(self, lines, datetime):
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': datetime},
+			headers=self.header, data=self.chunks("\n".join(lines)))
+		self.assertEqual(r.status_code, 200)
+		r = requests.get(self.apiURI, params={'key': self.key, 'datetime': datetime})
+		self.assertEqual(r.status_code, 200)
+		return r.content.splitlines()
+
+	def test000_put_in_chunks(self):
+		self.assertEqual(set(self.put(self.lines, "2015-01-01-00:00:00")), set(self.lines))
+
+	def test001_blank_node_across_batches(self):
+		first = '_:b0 <http://example.org/first> "first" .'
+		last = '_:b0 <http://example.org/last> "last" .'
+		lines = self.put([first] + self.lines + [last], "2015-01-02-00:00:00")
+		subjects = dict((line.split(" ")[1], line.split(" ")[0])
+			for line in lines if line.startswith("_:"))
+		self.assertEqual(len(subjects), 2)
+		self.assertEqual(subjects["<http://example.org/first>"],
+			subjects["<http://example.org/last>"])
+		self.assertEqual(set(lines) - set(self.lines), set([
+			first.replace("_:b0", subjects["<http://example.org/first>"]),
+			last.replace("_:b0", subjects["<http://example.org/first>"])]))
+
+	def test002_post_in_chunks(self):
+		keys = ["http://example.org/streaming/%d" % n for n in range(3)]
+		quads = [line[:-2] + " <%s> ." % key for key in keys for line in self.lines]
+		header = dict(self.header, **{'Content-Type': "application/n-quads"})
+		r = requests.post(self.apiURI, params={'datetime': "2015-01-01-00:00:00"},
+			headers=header, data=self.chunks("\n".join(quads)))
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.json()["saved"], len(keys))
+		for key in keys:
+			r = requests.get(self.apiURI, params={'key': key, 'datetime': "2015-01-01-00:00:00"})
+			self.assertEqual(set(r.content.splitlines()), set(self.lines))
+
+	def test003_put_invalid_in_chunks(self):
+		# the error is in a later batch than the first
+		lines = self.lines + ["<http://example.org/s> <http://example.org/p"] + self.lines
+		r = requests.put(self.apiURI, params={'key': self.key, 'datetime': "2015-01-03-00:00:00"},
+			headers=self.header, data=self.chunks("\n".join(lines)))
+		self.assertEqual(r.status_code, 500)
+		r = requests.get(self.apiURI, params={'key': self.key, 'timemap': "true"}, headers={'Accept': "application/json"})
+		self.assertEqual(len(r.json()["mementos"]["list"]), 2)
+
+	def large(self, changed=None):
+		# compresses to more than `revision_logic.STREAM_THRESHOLD`
+		return ['<http://example.org/large> <http://example.org/%s> "%s" .' % (
+			hashlib.sha1(str(i)).hexdigest(), i == changed and "changed" or hashlib.sha1(str(-i)).hexdigest())
+			for i in range(40000)]
+
+	def get_large(self, datestr, coding):
+		r = requests.get(self.apiURI, params={'key': "http://example.org/large", 'datetime': datestr},
+			headers={'Accept-Encoding': coding}, stream=True)
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(r.headers.get("Transfer-Encoding"), "chunked")
+		self.assertEqual(r.headers.get("Content-Length"), None)
+		if coding != "identity":
+			self.assertEqual(r.headers.get("Content-Encoding"), coding)
+		return r.content.splitlines()
+
+	def test010_get_large_in_chunks(self):
+		lines = self.large()
+		r = requests.put(self.apiURI, params={'key': "http://example.org/large", 'datetime': "2015-01-01-00:00:00"},
+			headers=self.header, data=self.chunks("\n".join(lines)))
+		self.assertEqual(r.status_code, 200)
+		for coding in ("identity", "gzip", "deflate"):
+			self.assertEqual(set(self.get_large("2015-01-01-00:00:00", coding)), set(lines))
+
+	def test011_get_large_with_delta_in_chunks(self):
+		lines = self.large(7)
+		r = requests.put(self.apiURI, params={'key': "http://example.org/large", 'datetime': "2015-01-02-00:00:00"},
+			headers=self.header, data=self.chunks("\n".join(lines)))
+		self.assertEqual(r.status_code, 200)
+		for coding in ("identity", "gzip", "deflate"):
+			self.assertEqual(set(self.get_large("2015-01-02-00:00:00", coding)), set(lines))
+
+
 class Unauthorized(unittest.TestCase):
 	def setUp(self):
 		pass